@@ -0,0 +1,349 @@
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+
+from net_protocol import (
+    HEADER, HEADER_SIZE, MAX_CLIENT_MESSAGE, MAX_MESSAGE_SIZE, MSG_DEBUG, MSG_STATE, ProtocolError, SendBuffer,
+    encode_object, release_parts, unpack_object,
+)
+from udp_transport import DATAGRAM, KIND_RELIABLE, KIND_UNRELIABLE, MSG_HELLO, POLL_INTERVAL, UdpConnection
+
+# --- asyncioのサーバ ---
+# 接続ごとにスレッドを立てる代わりに、1つのスレッドのイベントループで全員分の受信を待つ。
+# 送信（send）はtickスレッドから呼ばれるので、ループに書き込みを頼むだけにしてある。
+#
+# 読むのが遅いクライアントに送り続けると書き込み待ちがどんどん溜まるので、接続ごとに送信キューを持つ。
+# スナップショット・観測者向けのデバッグ情報は新しいのが来たら古いのは要らないので、まだ送っていない分は種類ごとに最新の1つに置き換える。
+# エフェクト・出来事などは捨てられないので、溜まりすぎたらその相手を切断する。
+#
+# スナップショットは send_parts で SendBuffer（共通部分・送り先ごとの部分）のまま受け取り、
+# ヘッダと一緒に sendmsg で1回に送る（つなげたbytesを作らない）。送り終わったらバッファをプールに返す。
+SEND_BUFFER_HIGH = 16 * 1024          # 書き込み待ちがこれを超えたら、送れるようになるまで次を出さない
+MAX_RELIABLE_BACKLOG = 1024 * 1024    # 捨てられないメッセージがこれ以上溜まった相手は切断する
+LATEST_ONLY_TYPES = {MSG_STATE, MSG_DEBUG}   # 最新の1つだけ送ればよいメッセージ
+
+
+def _views(parts, header=None):
+    views = [] if header is None else [memoryview(header)]
+    for part in parts:
+        views.append(memoryview(part.data)[:part.length] if isinstance(part, SendBuffer) else memoryview(part))
+    return views
+
+
+def _release_views(views):
+    # バッファを次のtickで書き換えられるように、作ったmemoryviewは全部手放す
+    for view in reversed(views):
+        view.release()
+
+
+def _raw_socket(transport):
+    # asyncioのトランスポートはsendmsgを持たないので、同じソケットを複製して送信だけこちらで行う
+    sock = transport.get_extra_info("socket").dup()
+    sock.setblocking(False)
+    return sock
+
+
+class StreamConnection:
+    # FramedConnectionのasyncio版。受信はawaitで待つ
+    def __init__(self, reader, writer, loop, max_size=MAX_MESSAGE_SIZE):
+        self.reader = reader
+        self.max_size = max_size    # サーバ側ではクライアントから来る大きさの上限（MAX_CLIENT_MESSAGE）
+        self.writer = writer
+        self.loop = loop
+        self.closed = False
+        self.reliable = deque()     # 順番どおり必ず送るメッセージ (種類, [部分, ...])
+        self.reliable_bytes = 0
+        self.latest = {}            # 種類 → まだ送っていない最新のスナップショットなど
+        self.coalesced = 0          # 送る前に新しいもので置き換えられた数
+        self.dropped = 0            # 送れないまま捨てたメッセージの数（切断したときに残っていた分など）
+        self.sock = _raw_socket(writer.transport)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_HIGH)
+        self._header = bytearray(HEADER_SIZE)   # 送信中のメッセージのヘッダ（1つずつ送るので使い回せる）
+        self._wakeup = asyncio.Event()
+        self._sender = loop.create_task(self._send_loop())
+
+    # --- 送信（どのスレッドからでも呼べる） ---
+    def send(self, msg_type, payload):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        self.loop.call_soon_threadsafe(self._enqueue, msg_type, [payload])
+
+    def send_object(self, msg_type, obj):
+        self.send(msg_type, encode_object(msg_type, obj))
+
+    def send_parts(self, msg_type, parts):
+        # parts: [SendBuffer か bytes, ...] をつなげたものを1つのメッセージとして送る
+        if self.closed:
+            raise ConnectionError("connection closed")
+        for part in parts:
+            if isinstance(part, SendBuffer):
+                part.retain()
+        self.loop.call_soon_threadsafe(self._enqueue, msg_type, parts)
+
+    def _enqueue(self, msg_type, parts):
+        if self.closed:
+            self.dropped += 1
+            release_parts(parts)
+            return
+        if msg_type in LATEST_ONLY_TYPES:
+            old = self.latest.get(msg_type)
+            if old is not None:
+                self.coalesced += 1
+                release_parts(old)
+            self.latest[msg_type] = parts
+        else:
+            self.reliable.append((msg_type, parts))
+            self.reliable_bytes += sum(len(part) for part in parts)
+            if self.reliable_bytes > MAX_RELIABLE_BACKLOG:
+                self._close()   # 読んでくれない相手のために溜め続けない
+                return
+        self._wakeup.set()
+
+    async def _send_loop(self):
+        # 1つずつ送り切る。相手が読まずに送れない間に来たスナップショットは上書きされる
+        try:
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while not self.closed:
+                    if self.reliable:
+                        msg_type, parts = self.reliable.popleft()
+                        self.reliable_bytes -= sum(len(part) for part in parts)
+                    elif self.latest:
+                        msg_type = next(iter(self.latest))
+                        parts = self.latest.pop(msg_type)
+                    else:
+                        break
+                    try:
+                        await self._send_message(msg_type, parts)
+                    finally:
+                        release_parts(parts)
+        except OSError:
+            self._close()
+
+    async def _send_message(self, msg_type, parts):
+        HEADER.pack_into(self._header, 0, sum(len(part) for part in parts), msg_type)
+        views = _views(parts, self._header)
+        pending = views
+        try:
+            while True:
+                try:
+                    sent = self.sock.sendmsg(pending)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                # 送れた分を先頭から外す
+                while pending and sent >= len(pending[0]):
+                    sent -= len(pending[0])
+                    pending = pending[1:]
+                if not pending:
+                    return
+                if sent:
+                    rest = pending[0][sent:]
+                    views.append(rest)
+                    pending = [rest] + pending[1:]
+                await self._writable()
+        finally:
+            _release_views(views)
+
+    async def _writable(self):
+        fd = self.sock.fileno()
+        ready = self.loop.create_future()
+        self.loop.add_writer(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            self.loop.remove_writer(fd)
+
+    # --- 受信（ループ上で await する） ---
+    async def recv_message(self):
+        # メッセージが1つ届くまで待つ。切断されたらNone
+        try:
+            header = await self.reader.readexactly(HEADER_SIZE)
+            length, msg_type = HEADER.unpack(header)
+            if length > self.max_size:
+                raise ProtocolError(f"message too large: {length}")
+            payload = await self.reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.closed = True
+            return None
+        return msg_type, payload
+
+    async def recv_object(self, expected_type):
+        return unpack_object(await self.recv_message(), expected_type)
+
+    def close(self):
+        self.closed = True
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self.closed = True
+        self.dropped += len(self.reliable) + len(self.latest)
+        for _, parts in self.reliable:
+            release_parts(parts)
+        for parts in self.latest.values():
+            release_parts(parts)
+        self.reliable.clear()
+        self.reliable_bytes = 0
+        self.latest.clear()
+        self._wakeup.set()
+        # 送信中なら止めて、memoryviewを手放してから複製したソケットを閉じる
+        self._sender.cancel()
+        self._sender.add_done_callback(lambda _: self.sock.close())
+        self.writer.close()
+
+
+class DatagramConnection(UdpConnection):
+    # UdpConnectionのasyncio版。受け取ったメッセージはasyncio.Queueに入る
+    # raw_sock があればスナップショットはそこから sendmsg で送る
+    def __init__(self, transport, addr, loop, raw_sock=None):
+        super().__init__(transport, addr, owns_socket=False)
+        self.loop = loop
+        self.inbox = asyncio.Queue()
+        self.raw_sock = raw_sock
+        self.latest = {}            # StreamConnectionと同じく、種類 → まだ送っていない最新のもの
+        self.coalesced = 0
+        self.dropped = 0
+        self._header = bytearray(DATAGRAM.size)
+
+    def send(self, msg_type, payload):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        self.loop.call_soon_threadsafe(self._send_on_loop, msg_type, [payload])
+
+    def send_parts(self, msg_type, parts):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        for part in parts:
+            if isinstance(part, SendBuffer):
+                part.retain()
+        self.loop.call_soon_threadsafe(self._send_on_loop, msg_type, parts)
+
+    def _send_on_loop(self, msg_type, parts):
+        if self.closed:
+            self.dropped += 1
+            release_parts(parts)
+        elif msg_type in LATEST_ONLY_TYPES:
+            # ループが遅れて何tick分も溜まっていたら、最後の1つだけ送る
+            if not self.latest:
+                self.loop.call_soon(self._flush_latest)
+            old = self.latest.get(msg_type)
+            if old is not None:
+                self.coalesced += 1
+                release_parts(old)
+            self.latest[msg_type] = parts
+        else:
+            # 再送付きのチャネルは捨てない（再送用にデータグラムを覚えておくのでbytesにまとめる）
+            views = _views(parts)
+            UdpConnection.send(self, msg_type, b"".join(views))
+            _release_views(views)
+            release_parts(parts)
+
+    def _flush_latest(self):
+        latest, self.latest = self.latest, {}
+        for msg_type, parts in latest.items():
+            self._send_latest(msg_type, parts)
+
+    def _send_latest(self, msg_type, parts):
+        try:
+            if self.closed or self.sock.get_write_buffer_size() > SEND_BUFFER_HIGH:
+                self.dropped += 1   # 送信バッファが詰まっているときは次のスナップショットに任せる
+                return
+            DATAGRAM.pack_into(self._header, 0, KIND_UNRELIABLE, 0, msg_type)
+            views = _views(parts, self._header)
+            try:
+                if self.raw_sock is None:
+                    self._send_raw(b"".join(views))
+                else:
+                    self.raw_sock.sendmsg(views, (), 0, self.addr)
+                    self.last_send = time.time()
+            except (BlockingIOError, InterruptedError):
+                self.dropped += 1
+            except OSError:
+                pass   # UDPなので送れなくても次のスナップショットに任せる
+            finally:
+                _release_views(views)
+        finally:
+            release_parts(parts)
+
+    async def recv_message(self):
+        while True:
+            if not self.inbox.empty():
+                return self.inbox.get_nowait()
+            if self.closed:
+                return None
+            try:
+                return await asyncio.wait_for(self.inbox.get(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def recv_object(self, expected_type):
+        return unpack_object(await self.recv_message(), expected_type)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(UdpConnection.close, self)
+
+
+class DatagramServer(asyncio.DatagramProtocol):
+    # 1つのUDPソケットで全員分を受けて、送り元アドレスごとのDatagramConnectionに振り分ける
+    def __init__(self, loop, on_connect):
+        self.loop = loop
+        self.on_connect = on_connect
+        self.transport = None
+        self.raw_sock = None
+        self.peers = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.raw_sock = _raw_socket(transport)
+
+    def datagram_received(self, data, addr):
+        if len(data) > DATAGRAM.size + MAX_CLIENT_MESSAGE:
+            return   # クライアントがこんなに大きいものを送ることはない
+        conn = self.peers.get(addr)
+        if conn is None:
+            # 知らない相手からはHELLOだけ受け付ける
+            if len(data) < DATAGRAM.size:
+                return
+            kind, seq, msg_type = DATAGRAM.unpack_from(data)
+            if kind != KIND_RELIABLE or seq != 1 or msg_type != MSG_HELLO:
+                return
+            conn = DatagramConnection(self.transport, addr, self.loop, self.raw_sock)
+            self.peers[addr] = conn
+            self.loop.create_task(self.on_connect(conn, addr))
+        conn.handle_datagram(data)
+
+    async def update_forever(self):
+        # 再送と切断判定
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            now = time.time()
+            for addr, conn in list(self.peers.items()):
+                conn.update(now)
+                if conn.closed:
+                    del self.peers[addr]
+
+
+async def serve(host, port, transport, handle_client):
+    # handle_client(conn, addr) は接続ごとに1つのタスクとして動く
+    loop = asyncio.get_running_loop()
+    if transport == "udp":
+        _, protocol = await loop.create_datagram_endpoint(
+            lambda: DatagramServer(loop, handle_client), local_addr=(host, port))
+        await protocol.update_forever()
+    else:
+        async def on_stream(reader, writer):
+            conn = StreamConnection(reader, writer, loop, max_size=MAX_CLIENT_MESSAGE)
+            await handle_client(conn, writer.get_extra_info("peername"))
+
+        server = await asyncio.start_server(on_stream, host, port, reuse_address=True)
+        async with server:
+            await server.serve_forever()
+
+
+def start_in_thread(host, port, transport, handle_client):
+    # pygameの描画はメインスレッドのままにして、ネットワークは別スレッドのループで動かす
+    thread = threading.Thread(target=asyncio.run, args=(serve(host, port, transport, handle_client),), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,60 @@
+import pickle
+import sys
+import time
+
+from net_protocol import (
+    INPUT, KEY_COUNT, MSG_JOB, ProtocolError, decode_input, decode_object, encode_input, encode_object,
+)
+
+# クライアントから届くメッセージ（入力・職業）の読み込みを、以前のpickle版と比べる
+# 使い方: python bench_input.py [回数]
+
+
+def bench(label, func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"  {label:<14} {elapsed * 1e9:8.0f} ns")
+    return elapsed
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    keys = [i % 3 == 0 for i in range(KEY_COUNT)]
+    mouse_pos = (512, 384)
+
+    # 以前のクライアントが送っていた形
+    pickled_input = pickle.dumps({"keys": keys, "mouse_pos": mouse_pos})
+    packed_input = encode_input(1234, keys, mouse_pos, 1200, 0.1)
+    pickled_job = pickle.dumps("Warrior")
+    packed_job = encode_object(MSG_JOB, "Warrior")
+
+    print(f"input bytes: pickle {len(pickled_input)}, struct {len(packed_input)}")
+    pickle_dec = bench("pickle input", lambda: pickle.loads(pickled_input), repeat)
+    struct_dec = bench("struct input", lambda: decode_input(packed_input), repeat)
+    print(f"  decode ratio   {struct_dec / pickle_dec:8.2f}")
+
+    print(f"job bytes: pickle {len(pickled_job)}, utf-8 {len(packed_job)}")
+    pickle_dec = bench("pickle job", lambda: pickle.loads(pickled_job), repeat)
+    struct_dec = bench("utf-8 job", lambda: decode_object(MSG_JOB, packed_job), repeat)
+    print(f"  decode ratio   {struct_dec / pickle_dec:8.2f}")
+
+    # 壊れたメッセージはすべてProtocolErrorで弾かれる
+    malformed = [packed_input[:-1], packed_input + b"\0", b"", INPUT.pack(1, 0xFFFF, 0, 0, 0, 0)]
+    rejected = 0
+    for payload in malformed:
+        try:
+            decode_input(payload)
+        except ProtocolError:
+            rejected += 1
+    for payload in [b"", b"\xff\xfe", b"x" * 100, b"War\nrior", pickled_job]:
+        try:
+            decode_object(MSG_JOB, payload)
+        except ProtocolError:
+            rejected += 1
+    print(f"malformed rejected: {rejected}/{len(malformed) + 5}")
+
+
+if __name__ == "__main__":
+    main()
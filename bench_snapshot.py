@@ -0,0 +1,166 @@
+import pickle
+import random
+import sys
+import time
+
+from entities import SkillState
+from snapshot_codec import (
+    COMMON_SKILLS, SKILLS_FIELD, SnapshotHistory, clear_caches, decode_snapshot, encode_client_part,
+    encode_snapshot, encode_world, make_flags, make_record, pack_skills, record_to_state, skill_entries,
+    write_client_part, write_world,
+)
+
+# pickle版とバイナリ版のゲーム状態のサイズ・速度比較
+# 使い方: python bench_snapshot.py [プレイヤー数]
+
+JOB_SKILLS = {
+    "Warrior": ["wave_strike", "chargeBoost", "all_death_damage"],
+    "Wizard": ["heal", "strength_buff", "resistance_buff", "Element_aura"],
+    "Assassin": ["criticalAttackMulti", "shadow_move", "dummy"],
+    "Sniper": ["far_snipe", "claymore_trap", "over_heat"],
+    "Berserker": ["berserked", "boost"],
+}
+
+
+def sample_records(count):
+    records = {}
+    for pid in range(count):
+        job = random.choice(list(JOB_SKILLS))
+        common = {name: SkillState(name, cooldown=random.randint(0, 900)) for name in ["jump_skill", "stun"]}
+        job_skill = {name: SkillState(name, active=random.random() < 0.2, cooldown=random.randint(0, 1200))
+                     for name in JOB_SKILLS[job]}
+        records[pid] = make_record(
+            random.randint(0, 3200), random.randint(0, 3200), job,
+            random.uniform(0, 4500), 4500, 40, random.uniform(0, 500),
+            make_flags(True, False, False, True),
+            "run", 3, "normal", "fire", (400, 300),
+            pack_skills(common, job_skill, JOB_SKILLS[job]),
+        )
+    return records
+
+
+def next_tick(records):
+    # 1tick分の変化: 3人に1人くらいが動いていて、クールダウン中のスキルが減る
+    # 変わらなかった人はサーバ（broadcast）と同じく前のtickのrecordをそのまま使う
+    moved = {}
+    for pid, record in records.items():
+        if pid % 3 == 0 or record[SKILLS_FIELD + 2] > 0:   # 最初のスキルのクールダウン
+            record = list(record)
+            if pid % 3 == 0:
+                record[0] += 4
+                record[9] = (record[9] + 1) % 8
+            if record[SKILLS_FIELD + 2] > 0:
+                record[SKILLS_FIELD + 2] -= 1
+            record = tuple(record)
+        moved[pid] = record
+    return moved
+
+
+def as_pickle_state(records, traps):
+    # 今までサーバが送っていたdictと同じ形（スキルは共通/職業ごとのdict。エフェクトは別メッセージになったので除く）
+    state = {}
+    for pid, record in records.items():
+        skills = {"common": {}, "job": {}}
+        for name, active, cooldown in skill_entries(record_to_state(record)["skills"]):
+            skills["common" if name in COMMON_SKILLS else "job"][name] = {"active": active, "cooldown": cooldown}
+        state[pid] = {**record_to_state(record), "skills": skills}
+    state["traps"] = [{"x": x, "y": y, "radius": r} for x, y, r in traps]
+    return state
+
+
+def bench(label, func, repeat, per=1, rounds=5):
+    # per: 1回の呼び出しで何tick分を処理するか（1tickあたりで表示する）
+    # ほかのプロセスに邪魔されるとぶれるので、rounds回測って一番速かったものを使う（timeitと同じ）
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = (time.perf_counter() - start) / repeat / per
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {label:<14} {best * 1e6:8.1f} us")
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    repeat = 2000
+    records = sample_records(count)
+    traps = [(100, 200, 60)]
+    state = as_pickle_state(records, traps)
+
+    pickled = pickle.dumps(state)
+    packed = encode_snapshot(1, records, traps)
+    moved = next_tick(records)
+    delta = encode_snapshot(2, moved, traps, 1, records)
+    print(f"players: {count}")
+    print(f"  pickle bytes   {len(pickled):8d}")
+    print(f"  binary bytes   {len(packed):8d}  ({len(packed) / len(pickled):.0%})")
+    print(f"  delta bytes    {len(delta):8d}  ({len(delta) / len(pickled):.0%})")
+
+    print("cold (キャッシュなし)")
+    def binary_encode_cold():
+        clear_caches()
+        encode_snapshot(1, records, traps)
+
+    def binary_decode_cold():
+        clear_caches()
+        decode_snapshot(packed, SnapshotHistory(1))
+
+    pickle_enc = bench("pickle encode", lambda: pickle.dumps(state), repeat)
+    binary_enc = bench("binary encode", binary_encode_cold, repeat)
+    pickle_dec = bench("pickle decode", lambda: pickle.loads(pickled), repeat)
+    binary_dec = bench("binary decode", binary_decode_cold, repeat)
+    print(f"  encode ratio   {binary_enc / pickle_enc:8.2f}")
+    print(f"  decode ratio   {binary_dec / pickle_dec:8.2f}")
+
+    print("steady (毎tick前のtickを基準にした差分。同じものを何度も測るとキャッシュに当たるだけなので、続くtickを順に)")
+    ticks = [records]
+    for _ in range(repeat):
+        ticks.append(next_tick(ticks[-1]))
+    # ticks[i] はスナップショット番号 i + 1（ticks[0] が packed）
+    payloads = [encode_snapshot(i + 1, ticks[i], traps, i, ticks[i - 1]) for i in range(1, len(ticks))]
+
+    def delta_encode():
+        clear_caches()
+        for i in range(1, len(ticks)):
+            encode_snapshot(i + 1, ticks[i], traps, i, ticks[i - 1])
+
+    def delta_decode():
+        history = SnapshotHistory(4)
+        decode_snapshot(packed, history)
+        for data in payloads:
+            decode_snapshot(data, history)
+
+    binary_enc = bench("delta encode", delta_encode, 1, len(payloads))
+    binary_dec = bench("delta decode", delta_decode, 1, len(payloads))
+    print(f"  encode ratio   {binary_enc / pickle_enc:8.2f}")
+    print(f"  decode ratio   {binary_dec / pickle_dec:8.2f}")
+
+    print(f"fan-out ({count}人に送る1tick分)")
+    def per_client():
+        for _ in range(count):
+            encode_snapshot(2, moved, traps, 1, records)
+
+    def shared():
+        world = encode_world(2, moved, 1, records)
+        for _ in range(count):
+            world + encode_client_part(0, traps)
+
+    # サーバと同じく、使い回すバッファに書いて共通部分と送り先ごとの部分をつなげずに渡す
+    world_buf = bytearray()
+    client_bufs = [bytearray() for _ in range(count)]
+
+    def reused():
+        write_world(world_buf, 2, moved, 1, records)
+        for buf in client_bufs:
+            write_client_part(buf, 0, traps)
+
+    per_client_enc = bench("per client", per_client, repeat)
+    shared_enc = bench("shared", shared, repeat)
+    reused_enc = bench("reused buffer", reused, repeat)
+    print(f"  shared ratio   {shared_enc / per_client_enc:8.2f}")
+    print(f"  reused ratio   {reused_enc / per_client_enc:8.2f}")
+
+if __name__ == "__main__":
+    main()
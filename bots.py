@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import random
+import time
+from collections import deque
+
+from async_server import DatagramConnection, StreamConnection
+from net_protocol import (
+    KEY_COUNT, MSG_EFFECTS, MSG_EVENT, MSG_INPUT, MSG_JOB, MSG_MAP, MSG_PLAYER_ID, MSG_STATE,
+    ProtocolError, encode_input, expect_message,
+)
+from snapshot_codec import JOBS, SnapshotHistory, decode_snapshot, snapshot_seq_of
+from udp_transport import MSG_HELLO, POLL_INTERVAL, UdpConnection
+
+# --- 負荷テスト用のボット ---
+# pygameを使わずにクライアントと同じ通信（ID・マップ名の受信 → 職業送信 → 入力を送り続ける）をするボットを
+# N人ぶん1つのイベントループで動かして、入力が反映されるまでの往復時間・スナップショットの大きさ・
+# サーバのtickの揺れを集計する。
+# 使い方:
+#   python server.py
+#   python bots.py --count 50 --duration 30
+#   python bots.py --transport udp --script bot_script.txt
+# スクリプトは1行に「フレーム数 キー名+キー名」（例: "30 right+punch"、"#"以降はコメント）で、最後まで行ったら繰り返す。
+
+SCREEN_SIZE = (992, 800)   # client.py の画面サイズ（マウス座標はこの範囲）
+
+# client.py の key_list と同じ並び
+KEY_NAMES = {
+    "left": 0, "right": 1, "jump": 2, "down": 3, "punch": 4, "shield": 5, "jump_skill": 6,
+    "stun": 7, "heal": 8, "skill1": 9, "skill2": 10, "skill3": 11, "respawn": 12,
+}
+KEY_RESPAWN = KEY_NAMES["respawn"]
+
+
+def load_script(path):
+    # [(フレーム数, 押すキー番号のリスト), ...]
+    steps = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].split()
+            if not line:
+                continue
+            try:
+                frames = int(line[0])
+                keys = [KEY_NAMES[name] for name in line[1].split("+")] if len(line) > 1 else []
+            except (ValueError, KeyError) as e:
+                raise SystemExit(f"{path}:{line_no}: 読めない行です ({e})")
+            steps.append((frames, keys))
+    if not steps:
+        raise SystemExit(f"{path}: 空のスクリプトです")
+    return steps
+
+
+class ScriptBrain:
+    # スクリプトどおりにキーを押す。ボットごとに開始位置をずらして全員が同じ動きにならないようにする
+    def __init__(self, steps, rng):
+        self.steps = steps
+        self.frame = rng.randrange(sum(frames for frames, _ in steps))
+        self.rng = rng
+
+    def next_input(self):
+        keys = [False] * KEY_COUNT
+        frame = self.frame % sum(frames for frames, _ in self.steps)
+        for frames, pressed in self.steps:
+            if frame < frames:
+                for key in pressed:
+                    keys[key] = True
+                break
+            frame -= frames
+        self.frame += 1
+        return keys, (self.rng.randrange(SCREEN_SIZE[0]), self.rng.randrange(SCREEN_SIZE[1]))
+
+
+class RandomBrain:
+    # 左右に歩き回りながら、攻撃・スキル(9〜11)・シールド・ジャンプをランダムに使う
+    def __init__(self, rng):
+        self.rng = rng
+        self.direction = None
+        self.walk_frames = 0
+        self.shield_frames = 0
+        self.mouse_pos = (0, 0)
+
+    def next_input(self):
+        rng = self.rng
+        keys = [False] * KEY_COUNT
+        if self.walk_frames <= 0:
+            self.direction = rng.choice([None, "left", "right"])
+            self.walk_frames = rng.randint(20, 90)
+            self.mouse_pos = (rng.randrange(SCREEN_SIZE[0]), rng.randrange(SCREEN_SIZE[1]))
+        self.walk_frames -= 1
+        if self.direction:
+            keys[KEY_NAMES[self.direction]] = True
+
+        if self.shield_frames > 0:
+            self.shield_frames -= 1
+            keys[KEY_NAMES["shield"]] = True
+        elif rng.random() < 0.005:
+            self.shield_frames = rng.randint(10, 60)
+
+        keys[KEY_NAMES["jump"]] = rng.random() < 0.02
+        keys[KEY_NAMES["punch"]] = rng.random() < 0.1
+        for name in ("skill1", "skill2", "skill3"):
+            keys[KEY_NAMES[name]] = rng.random() < 0.01
+        for name in ("jump_skill", "stun", "heal"):
+            keys[KEY_NAMES[name]] = rng.random() < 0.003
+        return keys, self.mouse_pos
+
+
+class Samples:
+    # 全ボット分をまとめた計測値（途中経過用の区間と、最後に出す全体の2つを持つ）
+    def __init__(self):
+        self.rtts = []              # 入力を送ってからそれを反映したスナップショットが届くまで(秒)
+        self.snapshot_sizes = []
+        self.tick_intervals = []    # スナップショットに入っているサーバ時刻の間隔(秒/tick)
+        self.inputs = 0
+        self.effects = 0
+        self.events = 0
+        self.decode_errors = 0
+        self.started = time.time()
+
+    def merge(self, other):
+        self.rtts.extend(other.rtts)
+        self.snapshot_sizes.extend(other.snapshot_sizes)
+        self.tick_intervals.extend(other.tick_intervals)
+        self.inputs += other.inputs
+        self.effects += other.effects
+        self.events += other.events
+        self.decode_errors += other.decode_errors
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.disconnected = 0
+        self.total = Samples()
+        self.window = Samples()
+
+    def next_window(self):
+        window = self.window
+        self.total.merge(window)
+        self.window = Samples()
+        return window
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def summary(stats, samples, tick_rate):
+    elapsed = max(1e-9, time.time() - samples.started)
+    rtts = [r * 1000 for r in samples.rtts]
+    sizes = samples.snapshot_sizes
+    # 理想の間隔 1/tick_rate からのずれ
+    jitter = [abs(i - 1 / tick_rate) * 1000 for i in samples.tick_intervals]
+    lines = [
+        f"bots {stats.connected} connected, {stats.failed} failed, {stats.disconnected} disconnected | "
+        f"inputs {samples.inputs / elapsed:.0f}/s  snapshots {len(sizes) / elapsed:.0f}/s  "
+        f"effects {samples.effects}  events {samples.events}  decode errors {samples.decode_errors}",
+        f"  rtt ms       p50 {percentile(rtts, 50):7.1f}  p90 {percentile(rtts, 90):7.1f}  "
+        f"p99 {percentile(rtts, 99):7.1f}  max {max(rtts, default=0):7.1f}  (n={len(rtts)})",
+        f"  snapshot B   avg {sum(sizes) / max(1, len(sizes)):7.1f}  p50 {percentile(sizes, 50):7.0f}  "
+        f"p99 {percentile(sizes, 99):7.0f}  max {max(sizes, default=0):7d}  "
+        f"({sum(sizes) * 8 / elapsed / 1000:.1f} kbit/s total)",
+        f"  tick jitter  p50 {percentile(jitter, 50):7.2f}  p90 {percentile(jitter, 90):7.2f}  "
+        f"p99 {percentile(jitter, 99):7.2f}  max {max(jitter, default=0):7.2f} ms  "
+        f"(nominal {1000 / tick_rate:.2f} ms)",
+    ]
+    return "\n".join(lines)
+
+
+# --- 接続 ---
+class BotDatagramProtocol(asyncio.DatagramProtocol):
+    # ボット1人分のUDPソケット。届いたデータグラムをDatagramConnectionに渡す
+    def __init__(self):
+        self.conn = None
+
+    def datagram_received(self, data, addr):
+        if self.conn is not None:
+            self.conn.handle_datagram(data)
+
+
+class BotDatagramConnection(DatagramConnection):
+    # サーバと違ってソケットはボットごとに1つなので、閉じるときにソケットも閉じる
+    def close(self):
+        UdpConnection.close(self)
+        self.sock.close()
+
+
+async def keep_alive(conn):
+    # 再送と切断判定（クライアントの poll の代わり）
+    while not conn.closed:
+        await asyncio.sleep(POLL_INTERVAL)
+        conn.update(time.time())
+
+
+async def open_connection(args):
+    loop = asyncio.get_running_loop()
+    if args.transport == "udp":
+        transport, protocol = await loop.create_datagram_endpoint(
+            BotDatagramProtocol, remote_addr=(args.host, args.port))
+        conn = BotDatagramConnection(transport, transport.get_extra_info("peername"), loop)
+        protocol.conn = conn
+        conn.send(MSG_HELLO, b"")
+        loop.create_task(keep_alive(conn))
+        return conn
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    return StreamConnection(reader, writer, loop)
+
+
+# --- ボット本体 ---
+async def receive_loop(conn, bot, stats):
+    history = SnapshotHistory(64)   # client.py と同じ
+    while True:
+        message = await conn.recv_message()
+        if message is None:
+            return
+        msg_type, payload = message
+        samples = stats.window
+        if msg_type == MSG_STATE:
+            # UDPだと順番が入れ替わることがあるので、古いものは捨てる
+            if snapshot_seq_of(payload) <= bot["ack"]:
+                continue
+            try:
+                seq, state = decode_snapshot(payload, history)
+            except ValueError:
+                # 差分の基準が手元にない → ack 0 で全項目を送り直してもらう
+                samples.decode_errors += 1
+                bot["ack"] = 0
+                continue
+            now = time.time()
+            samples.snapshot_sizes.append(len(payload))
+            if bot["last_tick"] is not None:
+                last_seq, last_time = bot["last_tick"]
+                samples.tick_intervals.append((state["server_time"] - last_time) / (seq - last_seq))
+            bot["last_tick"] = (seq, state["server_time"])
+            bot["ack"] = seq
+            pending = bot["pending"]
+            while pending and pending[0][0] <= state["input_seq"]:
+                samples.rtts.append(now - pending.popleft()[1])
+            me = state.get(bot["player_id"])
+            bot["alive"] = me is None or me["alive"]
+        elif msg_type == MSG_EFFECTS:
+            samples.effects += 1
+        elif msg_type == MSG_EVENT:
+            samples.events += 1
+
+
+async def run_bot(index, args, stats, steps):
+    rng = random.Random(None if args.seed is None else args.seed + index)
+    brain = ScriptBrain(steps, rng) if steps else RandomBrain(rng)
+    try:
+        conn = await open_connection(args)
+        player_id = await conn.recv_object(MSG_PLAYER_ID)
+        expect_message(await conn.recv_message(), MSG_MAP)   # 描画しないのでマップのファイルは受け取らない
+        conn.send_object(MSG_JOB, args.job or rng.choice(JOBS))
+    except (OSError, ConnectionError, ProtocolError) as e:
+        stats.failed += 1
+        print(f"bot {index}: 接続できません: {e}")
+        return
+    stats.connected += 1
+    bot = {"player_id": player_id, "ack": 0, "last_tick": None, "alive": True,
+           "pending": deque(maxlen=args.input_rate * 5)}   # 反映待ちの (入力番号, 送った時刻)
+    receiver = asyncio.get_running_loop().create_task(receive_loop(conn, bot, stats))
+    input_seq = 0
+    interval = 1 / args.input_rate
+    next_send = time.time()
+    deadline = next_send + args.duration
+    try:
+        while time.time() < deadline and not receiver.done():
+            keys, mouse_pos = brain.next_input()
+            keys[KEY_RESPAWN] = not bot["alive"]   # 死んでいたら復活を申請し続ける
+            input_seq += 1
+            conn.send(MSG_INPUT, encode_input(input_seq, keys, mouse_pos, bot["ack"]))
+            bot["pending"].append((input_seq, time.time()))
+            stats.window.inputs += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.time()))
+    except ConnectionError:
+        pass
+    finally:
+        if receiver.done():
+            stats.disconnected += 1
+            if not receiver.cancelled() and receiver.exception():
+                print(f"bot {index}: {receiver.exception()!r}")
+        receiver.cancel()
+        conn.close()
+
+
+async def report_forever(stats, args):
+    while True:
+        await asyncio.sleep(args.report_interval)
+        print(f"[{time.strftime('%H:%M:%S')}] {summary(stats, stats.next_window(), args.tick_rate)}")
+
+
+async def main(args):
+    steps = load_script(args.script) if args.script else None
+    stats = Stats()
+    reporter = asyncio.get_running_loop().create_task(report_forever(stats, args))
+    bots = []
+    for index in range(args.count):
+        bots.append(asyncio.create_task(run_bot(index, args, stats, steps)))
+        await asyncio.sleep(args.ramp / max(1, args.count))   # 一斉に接続しないように少しずつ
+    await asyncio.gather(*bots)
+    reporter.cancel()
+    stats.next_window()
+    print(f"[total] {summary(stats, stats.total, args.tick_rate)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="サーバの負荷テスト用ボット（pygame不要）")
+    parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--count", type=int, default=10, help="同時に動かすボットの数")
+    parser.add_argument("--duration", type=float, default=30, help="各ボットが入力を送り続ける秒数")
+    parser.add_argument("--ramp", type=float, default=1.0, help="全員が接続し終わるまでの秒数")
+    parser.add_argument("--input-rate", type=int, default=60, help="1秒あたりの入力送信回数（クライアントのFPS）")
+    parser.add_argument("--tick-rate", type=int, default=60, help="サーバの --tick-rate（揺れの基準）")
+    parser.add_argument("--job", choices=JOBS, default=None, help="全員の職業（省略時はランダム）")
+    parser.add_argument("--script", default=None, help="入力スクリプトのファイル（省略時はランダムに動く）")
+    parser.add_argument("--report-interval", type=float, default=5.0, help="途中経過を表示する間隔(秒)")
+    parser.add_argument("--seed", type=int, default=None, help="乱数の種（同じ動きを再現する）")
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,161 +1,29 @@
 import socket
 import pygame
-import pickle
 import json
 import os
 import time
 import sys
 import os
-
-def resource_path(relative_path):
-    try:
-        base_path = sys._MEIPASS  # PyInstallerが実行ファイルを展開する一時フォルダ
-    except Exception:
-        base_path = os.path.abspath(".")
-
-    return os.path.join(base_path, relative_path)
-
-
-# ----- Mapクラス -----
-class Map:
-    def __init__(self, map_data):
-        self.tile_width = map_data["tilewidth"]
-        self.tile_height = map_data["tileheight"]
-        self.width = map_data["width"]
-        self.height = map_data["height"]
-        self.layers = map_data["layers"]
-
-        self.tilesets = []
-        for tileset in map_data["tilesets"]:
-            image_path = os.path.join("map", os.path.basename(tileset["image"]))
-            image = pygame.image.load(image_path).convert_alpha()
-            columns = image.get_width() // self.tile_width
-            self.tilesets.append({
-                "firstgid": tileset["firstgid"],
-                "image": image,
-                "columns": columns
-            })
-
-    def get_tile(self, index):
-        if index == 0:
-            return None
-        for tileset in reversed(self.tilesets):
-            if index >= tileset["firstgid"]:
-                local_index = index - tileset["firstgid"]
-                max_index = (tileset["image"].get_width() // self.tile_width) * (tileset["image"].get_height() // self.tile_height)
-                if local_index < 0 or local_index >= max_index:
-                    return None
-                x = (local_index % tileset["columns"]) * self.tile_width
-                y = (local_index // tileset["columns"]) * self.tile_height
-                return tileset["image"].subsurface(pygame.Rect(x, y, self.tile_width, self.tile_height))
-        return None
-
-    def draw(self, surface, offset_x, offset_y):
-        start_col = int(offset_x // self.tile_width)
-        start_row = int(offset_y // self.tile_height)
-        end_col = int((offset_x + WIDTH) // self.tile_width) + 1
-        end_row = int((offset_y + HEIGHT) // self.tile_height) + 1
-
-        for layer in self.layers:
-            if layer["type"] == "tilelayer":
-                for row in range(start_row, min(end_row, self.height)):
-                    for col in range(start_col, min(end_col, self.width)):
-                        tile_index = layer["data"][row * self.width + col]
-                        tile = self.get_tile(tile_index)
-                        if tile:
-                            surface.blit(tile, (
-                                col * self.tile_width - offset_x,
-                                row * self.tile_height - offset_y
-                            ))
-
-
-class Animation:
-    def __init__(self, image_path, frame_width, frame_height, num_frames, speed):
-        sheet = pygame.image.load(image_path).convert_alpha()
-        self.frames = []
-        for i in range(num_frames):
-            rect = pygame.Rect(i * frame_width, 0, frame_width, frame_height)
-            frame = sheet.subsurface(rect).copy()
-            self.frames.append(frame)
-        self.num_frames = num_frames
-        self.index = 0
-        self.speed = speed  # 1フレームあたり何秒？
-        self.last_update = time.time()
-
-    def get_frame(self):
-        current_time = pygame.time.get_ticks()
-        if current_time - self.last_update >= self.speed * 1000:
-            self.index = (self.index + 1) % self.num_frames
-            self.last_update = current_time
-        return self.frames[self.index]
-
-
-# === クライアント用エフェクトアニメーションクラス ===
-class ClientEffectAnimation:
-    def __init__(self, image_path, frame_width, frame_height, num_frames, speed=0.1, scale=1.0):
-        sheet = pygame.image.load(image_path).convert_alpha()
-        self.frames = []
-        self.speed = speed
-        self.frame_count = num_frames
-        self.scale = scale  # ← 追加
-
-        for i in range(num_frames):
-            rect = pygame.Rect(i * frame_width, 0, frame_width, frame_height)
-            frame = sheet.subsurface(rect).copy()
-            if scale != 1.0:
-                frame = pygame.transform.scale(frame, (int(frame_width * scale), int(frame_height * scale)))
-            self.frames.append(frame)
-
-    def get_frame(self, elapsed):
-        frame_index = int(elapsed / self.speed)
-        if frame_index < self.frame_count:
-            return self.frames[frame_index]
-        return None
-
-#シールドのアニメーション(最後まで行ったら最後で止める)
-class HoldLastFrameAnimation:
-    def __init__(self, sheet_path, frame_width, frame_height, num_frames, speed, scale=1.0):
-        self.sheet = pygame.image.load(sheet_path).convert_alpha()
-        self.frames = []
-        for i in range(num_frames):
-            rect = pygame.Rect(i * frame_width, 0, frame_width, frame_height)
-            frame = self.sheet.subsurface(rect).copy()
-            if scale != 1.0:
-                frame = pygame.transform.scale(frame, (int(frame_width * scale), int(frame_height * scale)))
-            self.frames.append(frame)
-
-        self.num_frames = num_frames
-        self.speed = speed
-        self.start_time = None
-
-    def start(self):
-        self.start_time = time.time()
-
-    def get_frame(self):
-        if self.start_time is None:
-            return self.frames[0]
-        elapsed = time.time() - self.start_time
-        index = int(elapsed / self.speed)
-        if index >= self.num_frames:
-            return self.frames[-1]  # 最後のフレームで止まる
-        return self.frames[index]
-
-
-def load_map(path):
-    with open(path, "r") as f:
-        return json.load(f)
-
-
-def draw_health_bar(surface, x, y, hp, max_hp=100, width=40, height=5):
-    ratio = hp / max_hp
-    pygame.draw.rect(surface, (255, 0, 0), (x, y - 10, width, height))
-    pygame.draw.rect(surface, (0, 255, 0), (x, y - 10, width * ratio, height))
-
-
-def draw_shield_gage(surface, x, y, gage, max_gage=500, width=40, height=5):
-    ratio = max(0, min(gage / max_gage, 1))  # 0～1の範囲にクランプ
-    pygame.draw.rect(surface, (100, 100, 100), (x, y - 15, width, height))  # 背景
-    pygame.draw.rect(surface, (0, 200, 255), (x, y - 15, width * ratio, height))  # 青ゲージ
+import argparse
+from net_protocol import (
+    FramedConnection, MSG_PLAYER_ID, MSG_MAP, MSG_JOB, MSG_INPUT, MSG_STATE, MSG_EFFECTS, MSG_EVENT,
+    MSG_PING, MSG_PONG, MSG_SESSION, MSG_RESUME, ProtocolError,
+    encode_input, expect_message,
+)
+from map_transfer import decode_manifest, fetch_map
+from clock_sync import ClockSync
+from snapshot_codec import (
+    SnapshotHistory, decode_snapshot, decode_effects, decode_event, snapshot_seq_of,
+    EVENT_DEATH, EVENT_RESPAWN, interpolated, record_to_state, skill_entries, skill_active, any_skill_active,
+)
+from udp_transport import UdpConnection
+from movement import GRAVITY, PLAYER_SIZE, Body, walk, fall, collide_map
+from render import (
+    Map, HoldLastFrameAnimation, resource_path, load_map, draw_health_bar, draw_shield_gage,
+    create_animations, load_effect_animations,
+)
+from collections import deque
 
 
 def draw_name(surface, x, y, player_id, width=40, height=40):
@@ -172,7 +40,7 @@ def draw_fixed_skill_ui(surface, player_skills, shield_gage=0):
     base_y = HEIGHT - size - 20
 
     # 通常スキルアイコン表示
-    for i, (name, skill) in enumerate(player_skills.items()):
+    for i, (name, active, cooldown) in enumerate(player_skills):
         icon = skill_icon_images.get(name, None)
         x = base_x + i * (size + spacing)
         y = base_y
@@ -181,7 +49,6 @@ def draw_fixed_skill_ui(surface, player_skills, shield_gage=0):
         icon_draw = icon.copy() if icon else pygame.Surface((size, size))
         icon_draw.fill((150, 150, 150)) if icon is None else None
 
-        cooldown = skill.get("cooldown", 0)
         icon_draw.set_alpha(100 if cooldown > 0 else 255)
 
         surface.blit(icon_draw, rect)
@@ -234,7 +101,8 @@ def get_sprite(sheet, col, row, width, height):
     return sprite
 
 
-def select_job():
+def select_job(conn):
+    # 選んでいる間もサーバとの接続を保つ（UDPは何も届かないと切断とみなされる）
     selecting = True
     selected_job = None
     font_large = pygame.font.SysFont(None, 40)
@@ -248,6 +116,8 @@ def select_job():
             text = font_large.render(f"{i+1}: {job}", True, color)
             screen.blit(text, (WIDTH//2 - text.get_width()//2, 200 + i*60))
         pygame.display.flip()
+        conn.keep_alive()
+        clock.tick(30)
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -297,49 +167,81 @@ HOST = '127.0.0.1'
 #HOST = '192.168.33.28'
 PORT = 5050
 
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client.connect((HOST, PORT))
+parser = argparse.ArgumentParser()
+parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp",
+                    help="サーバと同じものを指定する")
+parser.add_argument("--host", default=HOST)
+parser.add_argument("--port", type=int, default=PORT,
+                    help="netsim.py を挟むときはそのポート（既定5051）")
+parser.add_argument("--map-cache", default="map_cache",
+                    help="サーバから受け取ったマップを置くフォルダ（中身のハッシュで管理）")
+args = parser.parse_args()
+HOST, PORT = args.host, args.port
+RESUME_TIMEOUT = 30.0   # 接続が切れてから再接続を試み続ける秒数（サーバの猶予と同じくらい）
+RECONNECT_INTERVAL = 1.0
+STATE_TIMEOUT = 3.0     # これだけスナップショットが届かなければ接続が切れたとみなす
+
+
+def connect():
+    if args.transport == "udp":
+        return UdpConnection.connect(HOST, PORT)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect((HOST, PORT))
+    return FramedConnection(client)
+
+
+def resume_session(token):
+    # つなぎ直して合言葉を送り、同じプレイヤーに戻る。職業選択とマップの読み込みは済んでいるので飛ばす
+    deadline = time.time() + RESUME_TIMEOUT
+    while time.time() < deadline:
+        new_conn = None
+        try:
+            new_conn = connect()
+            new_conn.recv_object(MSG_PLAYER_ID)   # 新しく振られた番号は使わない
+            expect_message(new_conn.recv_message(), MSG_MAP)
+            new_conn.send(MSG_RESUME, token)
+            payload = expect_message(new_conn.recv_message(), MSG_RESUME)
+        except (OSError, ConnectionError, ProtocolError) as e:
+            print(f"再接続失敗: {e}")
+            if new_conn is not None:
+                new_conn.close()   # 失敗した接続のソケットを残さない
+            time.sleep(RECONNECT_INTERVAL)
+            continue
+        if not payload:
+            new_conn.close()   # サーバの猶予が過ぎていた
+            return None
+        return new_conn
+    return None
+
+
+conn = connect()
 
 print("① ID受信待ち...")
-my_player_id = pickle.loads(client.recv(16))
+my_player_id = conn.recv_object(MSG_PLAYER_ID)
 print(f"→ ID受信完了: {my_player_id}")
 
-print("② マップ名受信待ち...")
-map_data_name = pickle.loads(client.recv(1024))
-print(f"→ マップ名受信: {map_data_name}")
+print("② マップ受信待ち...")
+manifest = decode_manifest(expect_message(conn.recv_message(), MSG_MAP))
+map_files = fetch_map(conn, manifest, args.map_cache, udp=args.transport == "udp")   # キャッシュにないファイルだけ受け取る
+map_data_name = manifest["files"][0]["name"]
+print(f"→ マップ受信: {map_data_name} ({manifest['hash'].hex()[:12]})")
 
 print("③ 職業選択へ")
-selected_job = select_job()
+selected_job = select_job(conn)
 print(f"→ 選択された職業: {selected_job}")
 
 print("④ 職業を送信中...")
-client.send(pickle.dumps(selected_job))
+conn.send_object(MSG_JOB, selected_job)
 print("→ 職業送信完了")
 
 
-map_data = load_map(map_data_name)
-game_map = Map(map_data)
+map_data = load_map(map_files[map_data_name])
+game_map = Map(map_data, map_files)
 prev_hps = {}  # プレイヤーごとの前のHP記録
 font_large = pygame.font.SysFont(None, 30)
 
 
-element_effects = [
-    "fire", "water", "lightning",
-    "earth", "wind", "ice"
-]
-
-effect_animations = {
-    "stun": ClientEffectAnimation(resource_path("img/effects/stun.png"), 192, 192, 10, 0.05),
-    "wave_strike": ClientEffectAnimation(resource_path("img/effects/wave_strike.png"), 64, 64, 1, 0.08),
-    "all_death_damage": ClientEffectAnimation(resource_path("img/effects/all_death_damage.png"), 120, 120, 7, 0.08),
-    "normal_slash": ClientEffectAnimation(resource_path("img/effects/normal_slash.png"), 120, 120, 5, 0.08),
-    "criticalAttackMulti": ClientEffectAnimation(resource_path("img/effects/criticalAttackMulti.png"), 640, 480, 24, 0.08, scale=0.3),
-    "shadow_move": ClientEffectAnimation(resource_path("img/effects/shadow_move.png"), 320, 120, 8, 0.1),
-    "charge_boost": ClientEffectAnimation(resource_path("img/effects/charge_boost.png"), 120, 120, 5, 0.08),
-    "claymore_trap": ClientEffectAnimation(resource_path("img/effects/claymore_trap.png"), 320, 120, 6, 0.1),
-    "Element_aura": ClientEffectAnimation(resource_path("img/effects/Element_aura.png"), 120, 120, 8, 0.1),
-    **{name: ClientEffectAnimation(resource_path(f"img/effects/{name}.png"), 120, 120, 8, 0.1) for name in element_effects}
-}
+effect_animations = load_effect_animations()
 
 
 
@@ -414,20 +316,92 @@ shield_animations = {}
 SHIELD_GAGE = 50
 
 
-def create_animations():
-    return {
-        'run': Animation(resource_path("アニメーション/Run.png"), 128, 128, 8, 0.1),
-        'idle': Animation(resource_path("アニメーション/Idle.png"), 128, 128, 4, 0.45),
-        'jump': Animation(resource_path("アニメーション/Jump.png"), 128, 128, 10, 0.85),
-        'walk': Animation(resource_path("アニメーション/Walk.png"), 128, 128, 8, 0.25),
-        'dead': Animation(resource_path("アニメーション/Dead.png"), 128, 128, 3, 0.25),
-        'shield': Animation(resource_path("アニメーション/Shield.png"), 128, 128, 2, 0.25),
-        'attack1': Animation(resource_path("アニメーション/Attack_1.png"), 128, 128, 4, 0.01),
-        'attack2': Animation(resource_path("アニメーション/Attack_2.png"), 128, 128, 3, 1),
-        'attack3': Animation(resource_path("アニメーション/Attack_3.png"), 128, 128, 4, 1),
-        'hurt': Animation(resource_path("アニメーション/Hurt.png"), 128, 128, 3, 0.25)
-    }
-
+def predict_step(body, keys, me):
+    # サーバのstep_playerと同じ順番で、移動 → 重力 → マップ衝突だけを先に進める
+    # （スタンや他プレイヤーとの衝突は予測しないので、ずれたらサーバの状態で直る）
+    if me["alive"] and not me["isShield"]:
+        walk(body, keys)
+    fall(body, GRAVITY * 0.3 if skill_active(me["skills"], "jump_skill") else GRAVITY)
+    collide_map(body, game_map)
+
+
+def reconcile(me, state):
+    # サーバの状態から予測をやり直す: 反映済みの入力は捨てて、残りの入力をもう一度適用する
+    body = Body(pygame.Rect(me["x"], me["y"], *PLAYER_SIZE), state["vel_y"], state["on_ground"], me["facing_right"])
+    while pending_inputs and pending_inputs[0][0] <= state["input_seq"]:
+        pending_inputs.popleft()
+    for _, keys in pending_inputs:
+        predict_step(body, keys, me)
+    return body
+
+
+def lerp(a, b, f):
+    return a + (b - a) * f
+
+
+def interpolate_players(render_time):
+    # 他のプレイヤーは少し遅らせた時刻で、前後のスナップショットの間を線形補間して描く。
+    # パケットが途切れて後ろのスナップショットがないときは、直前の速度でMAX_EXTRAPOLATION秒までだけ先読みする
+    # （バッファにはrecordを持つ。latest_playersのdictは次のスナップショットで書き換わるので前の値は残らない）
+    result = {}
+    for pid in snapshot_buffer[-1][1]:
+        pdata = latest_players[pid]
+        newer = older = before_older = None
+        for t, snap in reversed(snapshot_buffer):
+            if pid not in snap:
+                break
+            if t > render_time:
+                newer = (t, snap[pid])
+            elif older is None:
+                older = (t, snap[pid])
+            else:
+                before_older = (t, snap[pid])
+                break
+        x, y = pdata["x"], pdata["y"]
+        hp_bar, shield_bar = pdata["hp"], pdata["ShieldGage"]
+        if older and newer:
+            (t0, p0), (t1, p1) = older, newer
+            x0, y0, hp0, shield0 = interpolated(p0)
+            x1, y1, hp1, shield1 = interpolated(p1)
+            if abs(x1 - x0) + abs(y1 - y0) < TELEPORT_DISTANCE:
+                f = (render_time - t0) / (t1 - t0)
+                x, y = lerp(x0, x1, f), lerp(y0, y1, f)
+                hp_bar, shield_bar = lerp(hp0, hp1, f), lerp(shield0, shield1, f)
+            pdata = record_to_state(p0)
+        elif older and before_older:
+            (t0, p0), (t1, p1) = before_older, older
+            x0, y0 = interpolated(p0)[:2]
+            x1, y1 = interpolated(p1)[:2]
+            dt = min(render_time - t1, MAX_EXTRAPOLATION)
+            if t1 > t0 and abs(x1 - x0) + abs(y1 - y0) < TELEPORT_DISTANCE:
+                x = x1 + (x1 - x0) / (t1 - t0) * dt
+                y = y1 + (y1 - y0) / (t1 - t0) * dt
+            pdata = record_to_state(p1)
+        elif newer:
+            x, y, hp_bar, shield_bar = interpolated(newer[1])  # バッファより前の時刻 → 一番古いものをそのまま使う
+            pdata = record_to_state(newer[1])
+        result[pid] = {**pdata, "x": round(x), "y": round(y), "hp_bar": hp_bar, "shield_bar": shield_bar}
+    return result
+
+
+# サーバに送るキーの並び（この順番でビットマスクになる）
+KEY_BINDINGS = [
+    pygame.K_LEFT,
+    pygame.K_RIGHT,
+    pygame.K_UP,
+    pygame.K_DOWN,
+    pygame.K_SPACE,
+    pygame.K_s,
+    pygame.K_LSHIFT,
+    pygame.K_j,
+    pygame.K_h,
+    pygame.K_k,
+    pygame.K_l,
+    pygame.K_g,
+    pygame.K_r,
+    pygame.K_z,
+    pygame.K_m,
+]
 
 player_size = (40, 105)
 players = {}
@@ -437,6 +411,20 @@ my_facing_right = True
 animations = create_animations()
 shield_anim_started = False
 respawn_requested = False
+snapshot_history = SnapshotHistory(64)  # 差分の基準用に受け取ったスナップショットを覚えておく
+last_snapshot_seq = 0
+input_seq = 0  # 送った入力の通し番号
+INTERP_DELAY = 0.1         # 他プレイヤーを描く時刻の遅れ（スナップショット数個分）
+MAX_EXTRAPOLATION = 0.25   # スナップショットが途切れたときに先読みする最大秒数
+TELEPORT_DISTANCE = 200    # これ以上離れた2点の間は補間しない（復活・瞬間移動）
+snapshot_buffer = deque(maxlen=32)  # (サーバ時刻, {プレイヤーのid: record}) の受け取ったスナップショット
+latest_players = {}  # 最新のスナップショットのプレイヤーの状態（decode_snapshotがその場で書き換える）
+server_clock = ClockSync()  # サーバの時計との差と往復時間の推定
+session_token = None  # 接続が切れたときに同じプレイヤーに戻るための合言葉
+last_state_at = time.time()
+pending_inputs = deque(maxlen=120)  # サーバにまだ反映されていない (入力番号, キー)
+predicted = None  # 自分のキャラの予測した位置（movement.Body）
+client_skill_effects = []  # サーバから届いたエフェクト（継続時間が過ぎたら消す）
 running = True
 
 while running:
@@ -444,45 +432,99 @@ while running:
         if event.type == pygame.QUIT:
             running = False
 
-    keys = [
-        pygame.key.get_pressed()[pygame.K_LEFT],
-        pygame.key.get_pressed()[pygame.K_RIGHT],
-        pygame.key.get_pressed()[pygame.K_UP],
-        pygame.key.get_pressed()[pygame.K_DOWN],
-        pygame.key.get_pressed()[pygame.K_SPACE],
-        pygame.key.get_pressed()[pygame.K_s],
-        pygame.key.get_pressed()[pygame.K_LSHIFT],
-        pygame.key.get_pressed()[pygame.K_j],
-        pygame.key.get_pressed()[pygame.K_h],
-        pygame.key.get_pressed()[pygame.K_k],
-        pygame.key.get_pressed()[pygame.K_l],
-        pygame.key.get_pressed()[pygame.K_g],
-        pygame.key.get_pressed()[pygame.K_r],
-        pygame.key.get_pressed()[pygame.K_z],
-        pygame.key.get_pressed()[pygame.K_m],
-    ]
+    pressed = pygame.key.get_pressed()
+    keys = [pressed[key] for key in KEY_BINDINGS]
     keys[12] = respawn_requested
 
     try:
         mouse_pos = pygame.mouse.get_pos()
-        send_data = {
-            "keys": keys,
-            "mouse_pos": mouse_pos
-        }
-        client.send(pickle.dumps(send_data))
-        game_state = client.recv(8192)
+        input_seq += 1
+        ping = server_clock.ping(time.time())
+        if ping:
+            conn.send(MSG_PING, ping)
+        # スナップショットが届くまでの片道の分も遅らせて描く（pongが届くまでは仮の時計の差に含まれている）
+        interp_delay = INTERP_DELAY + server_clock.rtt / 2
+        # 他プレイヤーは受信済みの最新スナップショットよりどれだけ前の時刻で描いているか（サーバのラグ補正用）
+        view_delay = 0.0
+        if snapshot_buffer:
+            view_delay = snapshot_buffer[-1][0] - (server_clock.server_now(time.time()) - interp_delay)
+        conn.send(MSG_INPUT, encode_input(input_seq, keys, mouse_pos, last_snapshot_seq, view_delay))
+        pending_inputs.append((input_seq, keys))
+        # 届いている状態のうち一番新しいものだけ使う（届いていなければ前回のまま）
+        game_state = None
+        for msg_type, payload in conn.poll():
+            if msg_type == MSG_STATE:
+                # UDPだと順番が入れ替わることがあるので、古いものは捨てる
+                if snapshot_seq_of(payload) > last_snapshot_seq:
+                    game_state = payload
+            elif msg_type == MSG_EFFECTS:
+                # 開始時刻はサーバの時計なので手元の時計に直す
+                for effect in decode_effects(payload):
+                    effect["start"] = server_clock.to_local(effect["start"]) if server_clock.offset is not None else time.time()
+                    client_skill_effects.append(effect)
+            elif msg_type == MSG_PONG:
+                server_clock.on_pong(payload, time.time())
+            elif msg_type == MSG_SESSION:
+                session_token = payload
+            elif msg_type == MSG_EVENT:
+                kind, pid = decode_event(payload)
+                if kind == EVENT_DEATH:
+                    print(f"Player {pid} died")
+                elif kind == EVENT_RESPAWN and pid == my_player_id:
+                    respawn_requested = False  # 復活したので申請を取り下げる
+        now = time.time()
+        if game_state:
+            last_state_at = now
+        elif now - last_state_at > STATE_TIMEOUT:
+            # TCPは相手が黙って居なくなっても気づけないので、状態が途絶えたら切れたとみなす
+            raise ConnectionError("no state from the server")
+        client_skill_effects = [e for e in client_skill_effects if now - e["start"] < e["duration"]]
 
         if game_state:
-            full_state = pickle.loads(game_state)
+            try:
+                last_snapshot_seq, full_state = decode_snapshot(game_state, snapshot_history)
+            except ValueError as e:
+                # 差分の基準が手元にない → ack 0 で全項目を送り直してもらう。このスナップショットだけ捨て、描画とtickは続ける
+                print(f"スナップショット復元失敗: {e}")
+                last_snapshot_seq = 0
+                game_state = None
+        if game_state:
             traps = full_state.get("traps", [])
 
-            players = {k: v for k, v in full_state.items() if isinstance(k, int)}
-            client_skill_effects = full_state.get("skill_effects", [])
-
-            for pid in players:
-                if "animations" not in players[pid]:
-                    pass
-                    #players[pid]["animations"] = create_animations()
+            latest_players = {k: v for k, v in full_state.items() if isinstance(k, int)}
+            snapshot_buffer.append((full_state["server_time"], snapshot_history.get(last_snapshot_seq)))
+            server_clock.observe(full_state["server_time"], now)
+            if my_player_id in latest_players:
+                predicted = reconcile(latest_players[my_player_id], full_state)
+                if latest_players[my_player_id]["alive"]:
+                    respawn_requested = False   # 復活の出来事を取りこぼしても、生きていれば申請を取り下げる
+        elif predicted and my_player_id in latest_players:
+            predict_step(predicted, keys, latest_players[my_player_id])
+
+        if snapshot_buffer:
+            players = interpolate_players(server_clock.server_now(now) - interp_delay)
+
+        # 自分のキャラは遅らせずに最新の状態を使い、サーバの往復を待たずに予測した位置に描く
+        if predicted and my_player_id in players:
+            players[my_player_id] = {
+                **latest_players[my_player_id],
+                "x": predicted.rect.x,
+                "y": predicted.rect.y,
+                "facing_right": predicted.facing_right,
+            }
+    except (ConnectionError, OSError) as e:
+        print(f"接続が切れました: {e}")
+        conn.close()
+        conn = resume_session(session_token) if session_token else None
+        if conn is None:
+            print("再接続できませんでした")
+            break
+        print("→ 再接続しました")
+        # 前の接続で受け取ったスナップショットは差分の基準に使えず、未確認の入力も新しい接続には届いていない
+        last_snapshot_seq = 0
+        pending_inputs.clear()
+        last_state_at = time.time()
+        continue
     except Exception as e:
         print(f"通信エラー: {e}")
         break
@@ -522,12 +564,8 @@ while running:
         isShield = pdata["isShield"]
         shieldGage = pdata["ShieldGage"]
         can_use_shield = pdata["ShieldRecovering"]
-        skills_common = pdata["skills"]["common"]
-        skills_job = pdata["skills"]["job"]
+        skills = pdata["skills"]
         status = pdata.get("attack_status", "normal")
-        
-
-        skills = {**skills_common, **skills_job}
 
         # HP変化によるダメージテキスト
         prev_hp = prev_hps.get(player_id, hp)
@@ -581,8 +619,8 @@ while running:
                     del shield_animations[player_id]
 
 
-            draw_health_bar(screen, x - offset_x, y - offset_y+40, hp, maxHp)
-            draw_shield_gage(screen, x - offset_x, y - offset_y + 40, shieldGage, max_gage=500)
+            draw_health_bar(screen, x - offset_x, y - offset_y+40, pdata.get("hp_bar", hp), maxHp)
+            draw_shield_gage(screen, x - offset_x, y - offset_y + 40, pdata.get("shield_bar", shieldGage), max_gage=500)
             draw_name(screen, x - offset_x, y - offset_y+40, player_id)
 
 
@@ -597,7 +635,7 @@ while running:
 
 
 
-            if any(skill_info.get("active", False) for skill_info in skills.values()):
+            if any_skill_active(skills):
                 pygame.draw.rect(screen, (255, 255, 0), sprite_rect.inflate(10, 10), 3)
 
             for dt in damage_texts[:]:
@@ -609,7 +647,7 @@ while running:
                     damage_texts.remove(dt)
 
             if player_id == my_player_id:
-                draw_fixed_skill_ui(screen, skills, pdata.get("ShieldGage", 0))
+                draw_fixed_skill_ui(screen, skill_entries(skills), pdata.get("ShieldGage", 0))
 
         draw_skill_effects(screen, effect_animations, client_skill_effects, offset_x, offset_y)
 
@@ -631,5 +669,5 @@ while running:
     pygame.display.flip()
     clock.tick(60)
 
-client.close()
+conn.close()
 pygame.quit()
\ No newline at end of file
@@ -0,0 +1,69 @@
+import struct
+import time
+from collections import deque
+
+from net_protocol import ProtocolError
+
+# --- 時計合わせ ---
+# サーバの時刻（time.time()）はクライアントの時計とずれていることがあるので、NTPと同じやり方で差を推定する。
+# クライアントが送った時刻 t0、サーバが受け取った時刻 t1、返した時刻 t2、クライアントが受け取った時刻 t3 から
+#   往復時間 rtt    = (t3 - t0) - (t2 - t1)
+#   時計の差 offset = ((t1 - t0) + (t2 - t3)) / 2    （サーバの時刻 = 手元の時刻 + offset）
+# 行きと帰りにかかった時間が違うほどoffsetはずれるので、直近の測定のうち往復が一番短かったものを使う。
+PING = struct.Struct("!d")      # クライアント→サーバ: t0
+PONG = struct.Struct("!ddd")    # サーバ→クライアント: t0, t1, t2
+PING_INTERVAL = 0.5
+FAST_PINGS = 4                  # 最初はこの回数だけ間隔を詰めて早く合わせる
+SAMPLE_WINDOW = 16              # 時計の進み方の違いに追いつけるよう、古い測定は捨てる
+RTT_SMOOTHING = 0.125
+
+
+def answer_ping(payload, received_at):
+    # サーバ側: MSG_PING に答える MSG_PONG の中身
+    if len(payload) != PING.size:
+        raise ProtocolError(f"bad ping size: {len(payload)}")
+    (sent_at,) = PING.unpack(payload)
+    return PONG.pack(sent_at, received_at, time.time())
+
+
+class ClockSync:
+    def __init__(self):
+        self.samples = deque(maxlen=SAMPLE_WINDOW)   # (往復時間, 時計の差)
+        self.offset = None    # サーバの時刻 - 手元の時刻
+        self.rtt = 0.0        # 往復時間（なめらかにしたもの）。補間の遅れなどに使う
+        self.min_rtt = None
+        self.next_ping = 0.0
+
+    @property
+    def synced(self):
+        return bool(self.samples)
+
+    def ping(self, now):
+        # 送る時刻になっていれば MSG_PING の中身を返す
+        if now < self.next_ping:
+            return None
+        fast = len(self.samples) < FAST_PINGS
+        self.next_ping = now + (PING_INTERVAL / 5 if fast else PING_INTERVAL)
+        return PING.pack(now)
+
+    def on_pong(self, payload, now):
+        if len(payload) != PONG.size:
+            raise ProtocolError(f"bad pong size: {len(payload)}")
+        sent_at, received_at, replied_at = PONG.unpack(payload)
+        rtt = (now - sent_at) - (replied_at - received_at)
+        if rtt < 0 or sent_at > now:
+            return   # 自分が送った覚えのない時刻
+        self.samples.append((rtt, ((received_at - sent_at) + (replied_at - now)) / 2))
+        self.min_rtt, self.offset = min(self.samples)
+        self.rtt = rtt if len(self.samples) == 1 else self.rtt + (rtt - self.rtt) * RTT_SMOOTHING
+
+    def observe(self, server_time, now):
+        # pongが届くまでの仮の値: スナップショットの時刻から（片道の遅れの分だけずれる）
+        if self.offset is None:
+            self.offset = server_time - now
+
+    def to_local(self, server_time):
+        return server_time - self.offset
+
+    def server_now(self, now):
+        return now + self.offset
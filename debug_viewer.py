@@ -0,0 +1,227 @@
+import argparse
+import socket
+import time
+
+import pygame
+
+from map_transfer import decode_manifest, fetch_map
+from movement import COLLIDE_TILE, GROUND_Y
+from net_protocol import (
+    KEY_COUNT, MSG_DEBUG, MSG_EFFECTS, MSG_INPUT, MSG_MAP, MSG_OBSERVE, MSG_PLAYER_ID, MSG_STATE,
+    FramedConnection, encode_input, expect_message,
+)
+from render import Map, create_animations, draw_health_bar, draw_shield_gage, load_effect_animations, load_map
+from snapshot_codec import SnapshotHistory, decode_debug, decode_effects, decode_snapshot, snapshot_seq_of
+from udp_transport import UdpConnection
+
+# --- デバッグビューア ---
+# 以前はサーバのmain()が自分で全体を描いていたが、描画のCPUはtickと取り合いになるので別のプロセスで描く
+# （サーバは --headless で動かせる）。サーバには観測者として接続し、視界で絞らない全員分のスナップショットと
+# 当たり判定・罠などのデバッグ情報（MSG_DEBUG）を受け取って、クライアントと同じ絵（render.py）で描く。
+# 使い方:
+#   python server.py --headless
+#   python debug_viewer.py                      # 同じマシンからなら鍵はいらない
+#   python debug_viewer.py --host 203.0.113.5 --key 秘密   # サーバを --observer-key 秘密 で起動したとき
+# 操作: 矢印キーでカメラ移動、Tabで次のプレイヤーを追う、Escで追うのをやめる
+#       F1 当たり判定のタイル / F2 罠の範囲 / F3 プレイヤーの当たり判定 / F4 数値 の表示を切り替える
+
+WIDTH, HEIGHT = 992, 800
+CAMERA_SPEED = 12
+PLAYER_DRAW_SIZE = (40, 105)   # client.py と同じ位置に絵を描くための大きさ
+OVERLAY_KEYS = {pygame.K_F1: "collision", pygame.K_F2: "traps", pygame.K_F3: "hitboxes", pygame.K_F4: "stats"}
+
+
+def connect(args):
+    if args.transport == "udp":
+        return UdpConnection.connect(args.host, args.port)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((args.host, args.port))
+    return FramedConnection(sock)
+
+
+def clamp_camera(camera, game_map):
+    max_x = max(0, game_map.width * game_map.tile_width - WIDTH)
+    max_y = max(0, game_map.height * game_map.tile_height - HEIGHT)
+    camera[0] = max(0, min(camera[0], max_x))
+    camera[1] = max(0, min(camera[1], max_y))
+
+
+def draw_collision(surface, game_map, offset_x, offset_y):
+    # サーバのcollide_mapがぶつかるタイルと、これより下には落ちない床の高さ
+    layer = game_map.collide_layer
+    if layer:
+        tile_w, tile_h = game_map.tile_width, game_map.tile_height
+        overlay = pygame.Surface((tile_w, tile_h), pygame.SRCALPHA)
+        overlay.fill((255, 0, 0, 90))
+        start_col, start_row = int(offset_x // tile_w), int(offset_y // tile_h)
+        for row in range(start_row, min(start_row + HEIGHT // tile_h + 2, game_map.height)):
+            for col in range(start_col, min(start_col + WIDTH // tile_w + 2, game_map.width)):
+                if layer["data"][row * game_map.width + col] == COLLIDE_TILE:
+                    surface.blit(overlay, (col * tile_w - offset_x, row * tile_h - offset_y))
+    pygame.draw.line(surface, (255, 0, 0), (0, GROUND_Y - offset_y), (WIDTH, GROUND_Y - offset_y), 1)
+
+
+def draw_players(surface, animations, players, offset_x, offset_y, font):
+    for pid, pdata in players.items():
+        x, y = pdata["x"] - offset_x, pdata["y"] - offset_y
+        if pdata["alive"]:
+            sprite = animations[pdata["animation_state"]].frames[pdata["animation_index"]]
+            if not pdata["facing_right"]:
+                sprite = pygame.transform.flip(sprite, True, False)
+            surface.blit(sprite, sprite.get_rect(center=(x + PLAYER_DRAW_SIZE[0] // 2, y + PLAYER_DRAW_SIZE[1] // 2)))
+        draw_health_bar(surface, x, y + 40, pdata["hp"], pdata["maxHp"])
+        draw_shield_gage(surface, x, y + 40, pdata["ShieldGage"])
+        label = font.render(f"{pid} {pdata['job']}" + ("" if pdata["alive"] else " (dead)"), True, (0, 0, 0), (255, 255, 255))
+        surface.blit(label, label.get_rect(center=(x + PLAYER_DRAW_SIZE[0] // 2, y + 15)))
+
+
+def draw_effects(surface, effect_animations, effects, offset_x, offset_y):
+    now = time.time()
+    for effect in effects:
+        anim = effect_animations.get(effect["type"])
+        frame = anim.get_frame(now - effect["start"]) if anim else None
+        if frame:
+            surface.blit(frame, frame.get_rect(center=(effect["x"] - offset_x, effect["y"] - offset_y)))
+
+
+def draw_traps(surface, traps, offset_x, offset_y, font):
+    for trap in traps:
+        center = (trap["x"] - offset_x, trap["y"] - offset_y)
+        pygame.draw.circle(surface, (255, 100, 0), center, trap["radius"], 2)
+        surface.blit(font.render(f"trap {trap['owner']}", True, (255, 100, 0)), center)
+
+
+def draw_hitboxes(surface, bodies, offset_x, offset_y, font):
+    # 地面に立っていれば緑、空中ならオレンジ。縦の線は1tickで動く量の10倍
+    for pid, body in bodies.items():
+        x, y, width, height = body["rect"]
+        rect = pygame.Rect(x - offset_x, y - offset_y, width, height)
+        color = (0, 255, 0) if body["on_ground"] else (255, 160, 0)
+        pygame.draw.rect(surface, color, rect, 1)
+        pygame.draw.line(surface, color, rect.center, (rect.centerx, rect.centery + body["vel_y"] * 10), 2)
+        surface.blit(font.render(f"vy {body['vel_y']:.1f}", True, color), (rect.right + 2, rect.top))
+
+
+def draw_stats(surface, font, debug, players, snapshot_size, follow):
+    lines = [
+        f"tick {debug['tick_ms']:.2f} ms" if debug else "tick -",
+        f"players {len(players)}  traps {len(debug['traps']) if debug else 0}",
+        f"snapshot {snapshot_size} B",
+        f"follow {follow if follow is not None else '-'}",
+    ]
+    for i, line in enumerate(lines):
+        surface.blit(font.render(line, True, (255, 255, 255), (0, 0, 0)), (8, 8 + i * 18))
+
+
+def main(args):
+    pygame.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Debug Viewer")
+    clock = pygame.time.Clock()
+    font = pygame.font.SysFont(None, 20)
+
+    conn = connect(args)
+    conn.recv_object(MSG_PLAYER_ID)   # 観測者はプレイヤーを持たないので使わない
+    manifest = decode_manifest(expect_message(conn.recv_message(), MSG_MAP))
+    map_files = fetch_map(conn, manifest, args.map_cache, udp=args.transport == "udp")
+    conn.send_object(MSG_OBSERVE, args.key)
+    game_map = Map(load_map(map_files[manifest["files"][0]["name"]]), map_files)
+    animations = create_animations()
+    effect_animations = load_effect_animations()
+
+    history = SnapshotHistory(64)
+    last_seq = 0
+    input_seq = 0
+    players = {}
+    debug = None
+    effects = []
+    snapshot_size = 0
+    overlays = {"collision": True, "traps": True, "hitboxes": True, "stats": True}
+    camera = [0, 0]
+    follow = None
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.KEYDOWN:
+                if event.key in OVERLAY_KEYS:
+                    name = OVERLAY_KEYS[event.key]
+                    overlays[name] = not overlays[name]
+                elif event.key == pygame.K_TAB and players:
+                    ids = sorted(players)
+                    follow = ids[(ids.index(follow) + 1) % len(ids)] if follow in players else ids[0]
+                elif event.key == pygame.K_ESCAPE:
+                    follow = None
+        pressed = pygame.key.get_pressed()
+        dx = (pressed[pygame.K_RIGHT] - pressed[pygame.K_LEFT]) * CAMERA_SPEED
+        dy = (pressed[pygame.K_DOWN] - pressed[pygame.K_UP]) * CAMERA_SPEED
+        if dx or dy:
+            follow = None
+            camera[0] += dx
+            camera[1] += dy
+
+        # キーは押さず、受け取ったスナップショットの番号だけを伝える（差分で送ってもらうため）
+        input_seq += 1
+        try:
+            conn.send(MSG_INPUT, encode_input(input_seq, [False] * KEY_COUNT, (0, 0), last_seq, 0.0))
+            state = None
+            for msg_type, payload in conn.poll():
+                if msg_type == MSG_STATE:
+                    if snapshot_seq_of(payload) > last_seq:
+                        state = payload
+                elif msg_type == MSG_DEBUG:
+                    debug = decode_debug(payload)
+                elif msg_type == MSG_EFFECTS:
+                    # 同じマシンで見ることが多いので、時計合わせはせず受け取った時刻から再生する
+                    for effect in decode_effects(payload):
+                        effect["start"] = time.time()
+                        effects.append(effect)
+        except (ConnectionError, OSError) as e:
+            print(f"接続が切れました: {e}")
+            break
+        if state:
+            try:
+                last_seq, full_state = decode_snapshot(state, history)
+            except ValueError:
+                last_seq = 0   # 差分の基準がない → 全項目を送り直してもらう
+            else:
+                players = {k: v for k, v in full_state.items() if isinstance(k, int)}
+                snapshot_size = len(state)
+        now = time.time()
+        effects = [e for e in effects if now - e["start"] < e["duration"]]
+
+        if follow in players:
+            camera[0] = players[follow]["x"] - WIDTH // 2 + PLAYER_DRAW_SIZE[0] // 2
+            camera[1] = players[follow]["y"] - HEIGHT // 2 + PLAYER_DRAW_SIZE[1] // 2
+        clamp_camera(camera, game_map)
+        offset_x, offset_y = camera
+
+        screen.fill((100, 150, 255))
+        game_map.draw(screen, offset_x, offset_y)
+        if overlays["collision"]:
+            draw_collision(screen, game_map, offset_x, offset_y)
+        draw_players(screen, animations, players, offset_x, offset_y, font)
+        draw_effects(screen, effect_animations, effects, offset_x, offset_y)
+        if overlays["traps"] and debug:
+            draw_traps(screen, debug["traps"], offset_x, offset_y, font)
+        if overlays["hitboxes"] and debug:
+            draw_hitboxes(screen, debug["bodies"], offset_x, offset_y, font)
+        if overlays["stats"]:
+            draw_stats(screen, font, debug, players, snapshot_size, follow)
+        pygame.display.flip()
+        clock.tick(60)
+
+    conn.close()
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="サーバの全体を別プロセスで見るデバッグビューア")
+    parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp", help="サーバと同じものを指定する")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--key", default="local", help="サーバの --observer-key（同じマシンなら不要）")
+    parser.add_argument("--map-cache", default="map_cache",
+                        help="サーバから受け取ったマップを置くフォルダ（client.py と共有できる）")
+    main(parser.parse_args())
@@ -0,0 +1,75 @@
+import copy
+from dataclasses import dataclass, field
+
+import pygame
+
+# --- プレイヤーとスキルの状態 ---
+# 以前はどちらも文字列をキーにしたdictで、キーを打ち間違えても（"attack_cooldwon" など）黙って新しいキーが増えていた。
+# 今は __slots__ を持つ dataclass なので、ここに書いた名前の属性しか持てず、打ち間違えは AttributeError になる。
+# 1人ごとのdictがなくなる分メモリが減り、tickの中で何度も読む属性も速く読める。
+# どちらも同じものかどうかは中身ではなく「同じオブジェクトか」で比べる（eq=False）
+
+
+@dataclass(slots=True, eq=False)
+class SkillState:
+    name: str
+    active: bool = False
+    cooldown: float = 0                 # 次に使えるまでのtick数
+    end_time: float = 0                 # 効果が切れる時刻
+    damaged: float = 0
+    speed: float = 0
+    duration: float = 0
+    multipliers: dict = field(default_factory=dict)           # バフ・デバフで掛ける倍率 {"damaged": 1.8, ...}
+    buffed: bool = False
+    debuffed: bool = False
+    healed: bool = False
+    amount: float = 0
+    next_time: float = 0
+    hits: int = 3
+    interval: float = 0.35
+    attack_remaining: int = 0
+    next_attack_time: float = 0
+    target_id: int | None = None        # 乱刀の相手
+    source_id: int | None = None        # 毒・やけど・再生を付けたプレイヤー
+    stuned: bool = False
+    description: str = ""
+
+    @classmethod
+    def from_data(cls, name, data):
+        # job_data のスキルの定義から作る（ここにない名前のキーが定義にあれば TypeError）
+        return cls(name, **copy.deepcopy(data))
+
+
+def skills_from_data(skills):
+    return {name: SkillState.from_data(name, data) for name, data in skills.items()}
+
+
+@dataclass(slots=True, eq=False)
+class Player:
+    id: int
+    job: str
+    rect: pygame.Rect
+    hp: float
+    maxHp: float
+    defense: float
+    damaged: float
+    animations: dict
+    common: dict                        # {名前: SkillState} ジャンプ・スタン
+    job_skill: dict                     # {名前: SkillState} 職業のスキルと、付けられた毒・やけど・再生
+    vel_y: float = 0
+    on_ground: bool = True
+    facing_right: bool = True
+    alive: bool = True
+    isShield: bool = False
+    ShieldGage: float = 0
+    ShieldRecovering: bool = False      # シールドが切れて回復待ち
+    attack_cooldown: int = 0            # 通常攻撃のクールダウン(tick)
+    animation_state: str = "idle"
+    attack_status: str = "normal"
+    element_type: str = "fire"
+    mouse_pos: tuple = (0, 0)
+    view_time: float = 0.0              # この入力のとき画面に映っていた他プレイヤーの時刻
+    buffed_effects: list = field(default_factory=list)
+    debuff_effects: list = field(default_factory=list)
+    debuff_data: dict = field(default_factory=dict)
+    shield_absorb_ratio: float = 0.5
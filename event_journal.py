@@ -0,0 +1,48 @@
+import itertools
+from collections import deque
+
+# --- 出来事の記録 ---
+# スキルエフェクトや死亡・復活のように「起きたときに一度だけ送る」ものを、増え続ける番号付きで覚えておくリングバッファ。
+# 容量を超えた分と期限が切れた分は先頭から消えるので、長い試合でも溜まり続けない。
+# 送り先ごとに「どの番号まで送ったか」（カーソル）を持っておけば、それぞれが一度ずつだけ受け取れる。
+# カーソルが容量より遅れると、まだ送っていない分が上書きされて消える。missed で確かめて、呼ぶ側で送り直す。
+
+
+class EventJournal:
+    def __init__(self, capacity):
+        self.entries = deque(maxlen=capacity)   # (item, 期限 or None) を番号順に
+        self.ids = itertools.count(1)
+        self.last_id = 0    # 新しく接続した人のカーソルはここから始める（接続前の分は送らない）
+        self.overwritten_id = 0   # 容量を超えて消えた一番新しい番号（期限切れで消えた分は数えない）
+
+    def append(self, item, expires_at=None):
+        # itemに番号("id")を付けて記録する。expires_atを過ぎたら送らなくてよい
+        entries = self.entries
+        if len(entries) == entries.maxlen:
+            self.overwritten_id = entries[0][0]["id"]
+        self.last_id = item["id"] = next(self.ids)
+        entries.append((item, expires_at))
+        return self.last_id
+
+    def expire(self, now):
+        # 期限切れを先頭から消す（1tickに1回）。途中の期限切れは先頭に来たときか容量で消える
+        entries = self.entries
+        while entries and entries[0][1] is not None and entries[0][1] <= now:
+            entries.popleft()
+
+    def since(self, cursor):
+        # cursorより新しいものを古い順に返す。新しいものは末尾にあるので後ろから拾う
+        new_items = []
+        for item, _ in reversed(self.entries):
+            if item["id"] <= cursor:
+                break
+            new_items.append(item)
+        new_items.reverse()
+        return new_items
+
+    def missed(self, cursor):
+        # cursorより新しいのに、送る前に容量を超えて消えたものがあればTrue
+        return cursor < self.overwritten_id
+
+    def __len__(self):
+        return len(self.entries)
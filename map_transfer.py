@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import struct
+
+from net_protocol import MSG_MAP_CHUNK, MSG_MAP_REQUEST, ProtocolError, expect_message
+
+# --- マップの受け渡し ---
+# 以前はサーバのファイルパスを送ってクライアントが自分のmapフォルダから同じ名前を開いていたので、
+# インストールが少しでも違うと読めなかった。
+# 今はサーバがマップJSONとタイルセット画像の一覧（中身のハッシュ付き、マニフェスト）を送り、
+# クライアントは手元のキャッシュにないファイルだけをチャンクに分けて受け取る。
+# キャッシュはハッシュをファイル名にしているので、同じマップ・同じ画像は2回目からは受け取らない。
+#
+# マニフェスト: [マップ全体のハッシュ(32)][ファイル数(2)] + ファイルごとに [ハッシュ(32)][大きさ(4)][名前の長さ(1)][名前]
+# 1つ目のファイルがマップJSON、残りがタイルセット画像
+MANIFEST_HEADER = struct.Struct("!32sH")
+MANIFEST_ENTRY = struct.Struct("!32sIB")
+MAP_REQUEST = struct.Struct("!HIH")   # クライアント→サーバ: ファイル番号, 開始位置, 大きさ
+MAP_CHUNK = struct.Struct("!HI")      # サーバ→クライアント: ファイル番号, 開始位置 + データ
+CHUNK_SIZE = 32 * 1024                # 1回に頼める大きさの上限（TCPではこの大きさで頼む）
+REQUESTS_IN_FLIGHT = 4                # 返事を待たずに出しておく要求の数
+# UDPでは1チャンクが1つのデータグラムになる。MTUを超えるとIPで分割され、1つ落ちただけでチャンクごと再送になるので、
+# 分割されない大きさで頼む。小さいぶん、返事を待たずに出しておく数を増やす
+UDP_CHUNK_SIZE = 1200
+UDP_REQUESTS_IN_FLIGHT = 64
+MAX_MAP_FILES = 16
+MAX_FILE_SIZE = 16 * 1024 * 1024
+
+
+def file_hash(data):
+    return hashlib.sha256(data).digest()
+
+
+def hash_file(path):
+    # 中身を全部は持たずにハッシュと大きさを求める
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(block)
+            size += len(block)
+    return digest.digest(), size
+
+
+# --- サーバ側 ---
+class MapBundle:
+    # サーバが配るマップ一式。起動時はハッシュと大きさだけ計算し、中身は最初に頼まれたときに読む
+    # （キャッシュを持っているクライアントしか来なければ、タイルセット画像はメモリに載らない）
+    def __init__(self, map_path):
+        with open(map_path, "rb") as f:
+            map_json = f.read()
+        self.paths = [map_path]
+        for tileset in json.loads(map_json)["tilesets"]:
+            # クライアントと同じく、画像はマップと同じフォルダにある同じ名前のファイル
+            path = os.path.join(os.path.dirname(map_path), os.path.basename(tileset["image"]))
+            if path not in self.paths:
+                self.paths.append(path)
+        self.data = [None] * len(self.paths)
+        entries = []
+        for path in self.paths:
+            digest, size = hash_file(path)
+            entries.append((digest, size, os.path.basename(path)))
+        self.sizes = [size for _, size, _ in entries]
+        self.map_hash = file_hash(b"".join(digest for digest, _, _ in entries))
+        self.manifest = encode_manifest(self.map_hash, entries)
+
+    def chunk(self, payload):
+        # MSG_MAP_REQUEST に答える MSG_MAP_CHUNK の中身
+        if len(payload) != MAP_REQUEST.size:
+            raise ProtocolError(f"bad map request size: {len(payload)}")
+        index, offset, length = MAP_REQUEST.unpack(payload)
+        if index >= len(self.paths) or offset >= max(1, self.sizes[index]) or not 0 < length <= CHUNK_SIZE:
+            raise ProtocolError(f"bad map request: file {index} offset {offset} length {length}")
+        data = self.data[index]
+        if data is None:
+            with open(self.paths[index], "rb") as f:
+                data = self.data[index] = f.read()
+        return MAP_CHUNK.pack(index, offset) + data[offset:offset + length]
+
+
+def encode_manifest(map_hash, entries):
+    parts = [MANIFEST_HEADER.pack(map_hash, len(entries))]
+    for digest, size, name in entries:
+        name = name.encode("utf-8")
+        parts.append(MANIFEST_ENTRY.pack(digest, size, len(name)) + name)
+    return b"".join(parts)
+
+
+def decode_manifest(payload):
+    # {"hash": マップ全体のハッシュ, "files": [{"hash", "size", "name"}, ...]}
+    try:
+        map_hash, count = MANIFEST_HEADER.unpack_from(payload, 0)
+        if not 0 < count <= MAX_MAP_FILES:
+            raise ProtocolError(f"bad map file count: {count}")
+        pos = MANIFEST_HEADER.size
+        files = []
+        for _ in range(count):
+            digest, size, name_length = MANIFEST_ENTRY.unpack_from(payload, pos)
+            pos += MANIFEST_ENTRY.size
+            name = payload[pos:pos + name_length].decode("utf-8")
+            pos += name_length
+            # 名前はキャッシュのファイル名の拡張子にしか使わないが、パスになりそうなものは受け付けない
+            if size > MAX_FILE_SIZE or not name or name != os.path.basename(name) or name.startswith("."):
+                raise ProtocolError(f"bad map file entry: {name!r} ({size} bytes)")
+            files.append({"hash": digest, "size": size, "name": name})
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f"bad map manifest: {e}")
+    if pos != len(payload) or file_hash(b"".join(f["hash"] for f in files)) != map_hash:
+        raise ProtocolError("bad map manifest")
+    return {"hash": map_hash, "files": files}
+
+
+# --- クライアント側 ---
+def cache_path(cache_dir, entry):
+    # 中身のハッシュをファイル名にする（pygameが形式を判断できるように拡張子は元のまま）
+    return os.path.join(cache_dir, entry["hash"].hex() + os.path.splitext(entry["name"])[1])
+
+
+def is_cached(path, entry):
+    try:
+        with open(path, "rb") as f:
+            return file_hash(f.read()) == entry["hash"]
+    except OSError:
+        return False
+
+
+def fetch_map(conn, manifest, cache_dir, udp=False):
+    # キャッシュにないファイルだけサーバから受け取る。{元のファイル名: 手元のパス} を返す
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = {}
+    missing = []
+    for index, entry in enumerate(manifest["files"]):
+        path = cache_path(cache_dir, entry)
+        paths[entry["name"]] = path
+        if not is_cached(path, entry):
+            missing.append(index)
+    for index in missing:
+        entry = manifest["files"][index]
+        if udp:
+            data = _download(conn, index, entry["size"], UDP_CHUNK_SIZE, UDP_REQUESTS_IN_FLIGHT)
+        else:
+            data = _download(conn, index, entry["size"], CHUNK_SIZE, REQUESTS_IN_FLIGHT)
+        if file_hash(data) != entry["hash"]:
+            raise ProtocolError(f"map file {entry['name']} does not match its hash")
+        path = paths[entry["name"]]
+        with open(path + ".part", "wb") as f:
+            f.write(data)
+        os.replace(path + ".part", path)   # 途中で落ちても壊れたファイルがキャッシュに残らない
+        print(f"マップのファイルを受信: {entry['name']} ({entry['size']} bytes)")
+    return paths
+
+
+def _download(conn, index, size, chunk_size, in_flight):
+    data = bytearray(size)
+    offsets = list(range(0, size, chunk_size))
+    received = 0
+    for offset in offsets[:in_flight]:
+        conn.send(MSG_MAP_REQUEST, MAP_REQUEST.pack(index, offset, chunk_size))
+    next_request = in_flight
+    while received < len(offsets):
+        payload = expect_message(conn.recv_message(), MSG_MAP_CHUNK)
+        if len(payload) < MAP_CHUNK.size:
+            raise ProtocolError(f"bad map chunk size: {len(payload)}")
+        chunk_index, offset = MAP_CHUNK.unpack_from(payload)
+        chunk = memoryview(payload)[MAP_CHUNK.size:]
+        if chunk_index != index or offset not in offsets or len(chunk) != min(chunk_size, size - offset):
+            raise ProtocolError(f"unexpected map chunk: file {chunk_index} offset {offset}")
+        data[offset:offset + len(chunk)] = chunk
+        received += 1
+        if next_request < len(offsets):
+            conn.send(MSG_MAP_REQUEST, MAP_REQUEST.pack(index, offsets[next_request], chunk_size))
+            next_request += 1
+    return bytes(data)
@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+
+import pygame
+
+# --- 移動ルール ---
+# サーバのシミュレーションとクライアントの予測で同じ動きになるように、ここにまとめておく。
+# body は rect, vel_y, on_ground, facing_right を持つもの（サーバでは entities.Player、クライアントの予測では Body）
+SPEED = 4
+JUMP_VELOCITY = -8
+GRAVITY = 0.5
+PLAYER_SIZE = (40, 115)   # サーバ上の当たり判定の大きさ
+FIELD_WIDTH = 992         # 左右に動ける範囲
+GROUND_Y = 800 - 150      # これより下には落ちない
+COLLIDE_TILE = 324        # collideObjレイヤーでぶつかるタイル
+
+
+@dataclass(slots=True, eq=False)
+class Body:
+    rect: pygame.Rect
+    vel_y: float = 0
+    on_ground: bool = True
+    facing_right: bool = True
+
+
+def walk(body, keys):
+    # 左右移動とジャンプ。(動いたか, ジャンプしたか) を返す
+    rect = body.rect
+    moved = False
+    if keys[0] and rect.x > 0:
+        rect.x -= SPEED
+        body.facing_right = False
+        moved = True
+
+    if keys[1] and rect.x + rect.width < FIELD_WIDTH:
+        rect.x += SPEED
+        body.facing_right = True
+        moved = True
+
+    jumped = bool(keys[2] and body.on_ground)
+    if jumped:
+        body.vel_y = JUMP_VELOCITY
+        body.on_ground = False
+    return moved, jumped
+
+
+def fall(body, gravity_force=GRAVITY):
+    rect = body.rect
+    body.vel_y += gravity_force
+    rect.y += body.vel_y
+
+    if rect.bottom >= GROUND_Y:
+        rect.bottom = GROUND_Y
+        body.vel_y = 0
+        body.on_ground = True
+
+
+def collide_map(body, game_map):
+    if not game_map.collide_layer:
+        return
+
+    tile_w, tile_h = game_map.tile_width, game_map.tile_height
+    layer = game_map.collide_layer
+    rect = body.rect
+    left = rect.left // tile_w
+    right = rect.right // tile_w
+    top = rect.top // tile_h
+    bottom = rect.bottom // tile_h
+
+    # 垂直方向の衝突
+    for row in range(top, bottom + 1):
+        for col in range(left, right + 1):
+            if row < 0 or row >= game_map.height or col < 0 or col >= game_map.width:
+                continue
+            tile_index = layer["data"][row * game_map.width + col]
+            if tile_index == COLLIDE_TILE:
+                tile_rect = pygame.Rect(col * tile_w, row * tile_h, tile_w, tile_h)
+                if rect.colliderect(tile_rect):
+                    if body.vel_y > 0 and rect.bottom > tile_rect.top and rect.top < tile_rect.top:
+                        rect.bottom = tile_rect.top
+                        body.vel_y = 0
+                        body.on_ground = True
+                    elif body.vel_y < 0 and rect.top < tile_rect.bottom and rect.bottom > tile_rect.bottom:
+                        rect.top = tile_rect.bottom
+                        body.vel_y = 0
+
+    # 水平方向の衝突（on_ground のときのみ）
+    if body.on_ground:
+        for row in range(top, bottom + 1):
+            for col in range(left, right + 1):
+                if row < 0 or row >= game_map.height or col < 0 or col >= game_map.width:
+                    continue
+                tile_index = layer["data"][row * game_map.width + col]
+                if tile_index == COLLIDE_TILE:
+                    tile_rect = pygame.Rect(col * tile_w, row * tile_h, tile_w, tile_h)
+                    if rect.colliderect(tile_rect):
+                        if rect.right > tile_rect.left and rect.left < tile_rect.left:
+                            rect.right = tile_rect.left
+                        elif rect.left < tile_rect.right and rect.right > tile_rect.right:
+                            rect.left = tile_rect.right
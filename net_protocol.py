@@ -0,0 +1,266 @@
+import select
+import socket
+import struct
+import threading
+from collections import deque
+
+# --- メッセージフレーミング ---
+# TCPは「1回のsendが1回のrecvで届く」ことを保証しないので
+# [ペイロード長(4byte)][種類(1byte)][ペイロード] の形で区切って送る
+HEADER = struct.Struct("!IB")
+HEADER_SIZE = HEADER.size
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024   # これより大きい長さが来たら壊れたストリームとみなす
+RECV_SIZE = 65536
+
+# メッセージの種類
+MSG_PLAYER_ID = 1   # サーバ→クライアント: プレイヤーID
+MSG_MAP = 2         # サーバ→クライアント: マップのマニフェスト（map_transfer.py）
+MSG_JOB = 3         # クライアント→サーバ: 選択した職業
+MSG_INPUT = 4       # クライアント→サーバ: キー入力とマウス座標
+MSG_STATE = 5       # サーバ→クライアント: ゲーム状態
+MSG_EFFECTS = 6     # サーバ→クライアント: 新しく発生したスキルエフェクト
+MSG_EVENT = 7       # サーバ→クライアント: 死亡・復活などの出来事
+MSG_MAP_REQUEST = 8  # クライアント→サーバ: キャッシュにないマップのファイルの一部を要求
+MSG_MAP_CHUNK = 9    # サーバ→クライアント: 要求されたマップのファイルの一部
+MSG_PING = 10        # クライアント→サーバ: 時計合わせの問い合わせ（clock_sync.py）
+MSG_PONG = 11        # サーバ→クライアント: 時計合わせの返事
+MSG_SESSION = 12     # サーバ→クライアント: 再接続したときに同じプレイヤーに戻るための合言葉
+MSG_RESUME = 13      # クライアント→サーバ: 合言葉 / サーバ→クライアント: 戻ったプレイヤーID（空なら期限切れ）
+MSG_OBSERVE = 14     # クライアント→サーバ: 職業の代わりに観測者の鍵（debug_viewer.py）
+MSG_DEBUG = 15       # サーバ→観測者: 当たり判定・罠などのデバッグ情報
+
+
+# --- 入力メッセージ ---
+# 入力番号(4byte), キーのビットマスク(2byte), マウス座標(2byte x 2), 受信済みスナップショット番号(4byte),
+# 他プレイヤーを受信済みスナップショットより何ms遅れた時刻で描いていたか(2byte, ラグ補正用)
+INPUT = struct.Struct("!IHhhIH")
+KEY_COUNT = 15
+
+# --- ハンドシェイクのメッセージ ---
+# 相手から届いたpickleを読むと任意のコードを実行されうるので、決まった形だけを読む。
+# プレイヤーIDは4byte、職業名・観測者の鍵は長さの上限付きのUTF-8文字列（マップはmap_transfer.pyのマニフェスト）
+PLAYER_ID = struct.Struct("!I")
+MAX_NAME_SIZE = {MSG_JOB: 32, MSG_OBSERVE: 64}
+SESSION_TOKEN_SIZE = 16
+MAX_CLIENT_MESSAGE = 64   # クライアント→サーバのメッセージ（入力・職業）の上限。これより長いのは壊れているとみなす
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_message(msg_type, payload):
+    return HEADER.pack(len(payload), msg_type) + payload
+
+
+def encode_object(msg_type, obj):
+    if msg_type == MSG_PLAYER_ID:
+        return PLAYER_ID.pack(obj)
+    if msg_type in MAX_NAME_SIZE:
+        data = obj.encode("utf-8")
+        if len(data) > MAX_NAME_SIZE[msg_type]:
+            raise ProtocolError(f"name too long: {len(data)}")
+        return data
+    raise ProtocolError(f"message type {msg_type} is not a handshake message")
+
+
+def decode_object(msg_type, payload):
+    if msg_type == MSG_PLAYER_ID:
+        if len(payload) != PLAYER_ID.size:
+            raise ProtocolError(f"bad player id size: {len(payload)}")
+        return PLAYER_ID.unpack(payload)[0]
+    limit = MAX_NAME_SIZE.get(msg_type)
+    if limit is None:
+        raise ProtocolError(f"message type {msg_type} is not a handshake message")
+    if not 0 < len(payload) <= limit:
+        raise ProtocolError(f"bad name size: {len(payload)}")
+    try:
+        name = payload.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise ProtocolError(f"bad name: {e}")
+    if not name.isprintable():
+        raise ProtocolError(f"bad name: {name!r}")
+    return name
+
+
+def expect_message(message, expected_type):
+    # 受け取ったメッセージ（Noneなら切断）が期待した種類か確かめてペイロードを返す
+    if message is None:
+        raise ConnectionError("connection closed")
+    msg_type, payload = message
+    if msg_type != expected_type:
+        raise ProtocolError(f"unexpected message type {msg_type} (expected {expected_type})")
+    return payload
+
+
+def unpack_object(message, expected_type):
+    return decode_object(expected_type, expect_message(message, expected_type))
+
+
+def keys_to_mask(keys):
+    mask = 0
+    for i, pressed in enumerate(keys):
+        if pressed:
+            mask |= 1 << i
+    return mask
+
+
+def mask_to_keys(mask):
+    return [bool(mask & (1 << i)) for i in range(KEY_COUNT)]
+
+
+def _clamp16(value):
+    return max(-32768, min(32767, int(value)))
+
+
+def encode_input(seq, keys, mouse_pos, ack, view_delay=0.0):
+    view_delay_ms = max(0, min(65535, int(view_delay * 1000)))
+    return INPUT.pack(seq, keys_to_mask(keys), _clamp16(mouse_pos[0]), _clamp16(mouse_pos[1]), ack, view_delay_ms)
+
+
+def decode_input(payload):
+    # (入力番号, キーのビットマスク, マウス座標, 受信済みスナップショット番号, 描画の遅れ[秒])
+    # 大きさが違うもの・存在しないキーのビットが立っているものは受け付けない
+    if len(payload) != INPUT.size:
+        raise ProtocolError(f"bad input size: {len(payload)}")
+    seq, mask, mouse_x, mouse_y, ack, view_delay_ms = INPUT.unpack(payload)
+    if mask >> KEY_COUNT:
+        raise ProtocolError(f"bad key mask: {mask:#x}")
+    return seq, mask, (mouse_x, mouse_y), ack, view_delay_ms / 1000
+
+
+# --- 使い回す送信バッファ ---
+# スナップショットを毎tick新しいbytesに作り直さず、送り終わったバッファを次のtickで使い回す。
+# tickスレッドが書き込んで接続に渡し、I/Oスレッドが送り終わったら release する（参照カウント）。
+# 参照が残っている間は書き換えないので、送信中のデータが次のtickに上書きされることはない。
+class SendBuffer:
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.data = bytearray(size)
+        self.length = 0      # data の先頭から何バイトが中身か
+        self.refs = 0
+
+    def __len__(self):
+        return self.length
+
+    def retain(self):
+        with self.pool.lock:
+            self.refs += 1
+
+    def release(self):
+        with self.pool.lock:
+            self.refs -= 1
+            if self.refs == 0:
+                self.pool.free.append(self)
+
+
+class BufferPool:
+    def __init__(self, size=4096):
+        self.size = size
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # 参照1（呼び出し側の分）で渡す。使い終わったら release する
+        with self.lock:
+            buf = self.free.pop() if self.free else SendBuffer(self, self.size)
+            buf.refs = 1
+        buf.length = 0
+        return buf
+
+
+def release_parts(parts):
+    for part in parts:
+        if isinstance(part, SendBuffer):
+            part.release()
+
+
+class MessageReader:
+    # recvで届いたバイト列を溜めて、完成したメッセージだけを取り出す
+    def __init__(self, max_size=MAX_MESSAGE_SIZE):
+        self._buffer = bytearray()
+        self.max_size = max_size
+
+    def feed(self, data):
+        self._buffer += data
+        messages = []
+        buf = self._buffer
+        pos = 0
+        while len(buf) - pos >= HEADER_SIZE:
+            length, msg_type = HEADER.unpack_from(buf, pos)
+            if length > self.max_size:
+                raise ProtocolError(f"message too large: {length}")
+            end = pos + HEADER_SIZE + length
+            if len(buf) < end:
+                break   # 途中までしか届いていない
+            messages.append((msg_type, bytes(buf[pos + HEADER_SIZE:end])))
+            pos = end
+        if pos:
+            del buf[:pos]
+        return messages
+
+    def pending_bytes(self):
+        return len(self._buffer)
+
+
+class FramedConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = MessageReader()
+        self.inbox = deque()
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    # --- 送信 ---
+    # 返事を待たずに続けて送ってよい（パイプライン送信）
+    def send(self, msg_type, payload):
+        data = encode_message(msg_type, payload)
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def send_object(self, msg_type, obj):
+        self.send(msg_type, encode_object(msg_type, obj))
+
+    # --- 受信 ---
+    def _fill(self):
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            self.closed = True
+            return False
+        self.inbox.extend(self.reader.feed(data))
+        return True
+
+    def recv_message(self):
+        # メッセージが1つ完成するまで待つ。切断されたらNone
+        while not self.inbox:
+            if self.closed or not self._fill():
+                return None
+        return self.inbox.popleft()
+
+    def recv_object(self, expected_type):
+        return unpack_object(self.recv_message(), expected_type)
+
+    def poll(self):
+        # 今届いている分だけ読んで、完成済みメッセージを全部返す（ブロックしない）
+        while not self.closed:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                break
+            if not self._fill():
+                break
+        if self.closed and not self.inbox:
+            raise ConnectionError("connection closed")
+        messages = list(self.inbox)
+        self.inbox.clear()
+        return messages
+
+    def keep_alive(self):
+        pass   # TCPは何も送らなくても切れない（UdpConnectionと同じ使い方をするため）
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import math
+import random
+import time
+
+# --- 通信状況シミュレータ ---
+# クライアントとサーバの間に挟んで、遅延・揺らぎ・帯域制限・順番の入れ替わり・パケットロスを起こすプロキシ。
+# 使い方:
+#   python server.py
+#   python netsim.py --latency 60 --jitter 15 --loss 0.02 --bandwidth 512
+#   python client.py --port 5051
+# 同じ --seed を指定すれば同じ乱数で再現できる。
+MTU = 1500   # UDPのデータグラムがこれを超えるとIPで分割され、どれか1つ落ちればデータグラムごと届かない
+
+
+class Link:
+    # 片方向の回線。push されたデータを条件に合わせて遅らせてから deliver する
+    def __init__(self, name, args, deliver, ordered):
+        self.name = name
+        self.args = args
+        self.deliver = deliver
+        self.ordered = ordered          # TCPは順番を保つ（ロスは再送待ちの遅れになる）
+        self.loop = asyncio.get_running_loop()
+        self.wire_free_at = 0.0         # 帯域制限: 前のデータを送り終わる時刻
+        self.last_ready = 0.0
+        self.bytes = 0
+        self.packets = 0
+        self.lost = 0
+        self.reordered = 0
+        self.delay_total = 0.0
+
+    def push(self, data):
+        args = self.args
+        now = self.loop.time()
+        loss = args.loss
+        if not self.ordered:
+            fragments = math.ceil((len(data) + 8) / (MTU - 20))   # UDPヘッダ8, IPヘッダ20
+            loss = 1 - (1 - loss) ** fragments
+        if random.random() < loss:
+            self.lost += 1
+            if not self.ordered:
+                return
+            now += args.retransmit / 1000   # TCPはロスしても届くが、再送まで後ろも待たされる
+        if args.bandwidth > 0:
+            self.wire_free_at = max(self.wire_free_at, now) + len(data) * 8 / (args.bandwidth * 1000)
+            now = self.wire_free_at
+        ready = now + max(0.0, args.latency + random.uniform(-args.jitter, args.jitter)) / 1000
+        if self.ordered:
+            ready = max(ready, self.last_ready)
+        elif random.random() < args.reorder:
+            ready += (args.latency + args.jitter) / 1000 + 0.005   # 後から送ったものに追い越させる
+            self.reordered += 1
+        self.last_ready = max(self.last_ready, ready)
+        self.delay_total += ready - self.loop.time()
+        self.packets += 1
+        self.bytes += len(data)
+        self.loop.call_at(ready, self.deliver, data)
+
+    def report(self, interval):
+        line = (f"{self.name:<12} {self.bytes * 8 / interval / 1000:8.1f} kbit/s "
+                f"{self.packets / interval:6.1f} pkt/s  lost {self.lost:4d}  reordered {self.reordered:4d}  "
+                f"avg delay {self.delay_total / max(1, self.packets) * 1000:6.1f} ms")
+        self.bytes = self.packets = self.lost = self.reordered = 0
+        self.delay_total = 0.0
+        return line
+
+
+links = []
+
+
+async def report_forever(interval):
+    while True:
+        await asyncio.sleep(interval)
+        for link in list(links):
+            print(f"[{time.strftime('%H:%M:%S')}] {link.report(interval)}")
+
+
+# --- TCP ---
+async def pipe(reader, link):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        link.push(data)
+
+
+async def handle_tcp(client_reader, client_writer, args):
+    peer = client_writer.get_extra_info("peername")
+    try:
+        server_reader, server_writer = await asyncio.open_connection(args.target_host, args.target_port)
+    except OSError as e:
+        print(f"サーバに接続できません: {e}")
+        client_writer.close()
+        return
+    up = Link(f"{peer[1]} up", args, server_writer.write, ordered=True)
+    down = Link(f"{peer[1]} down", args, client_writer.write, ordered=True)
+    links.extend([up, down])
+    print(f"TCP {peer} connected")
+    try:
+        await asyncio.gather(pipe(client_reader, up), pipe(server_reader, down))
+    except ConnectionError:
+        pass
+    finally:
+        links.remove(up)
+        links.remove(down)
+        # 遅らせている途中のデータを出し切ってから閉じる
+        await asyncio.sleep((args.latency + args.jitter + args.retransmit) / 1000)
+        client_writer.close()
+        server_writer.close()
+        print(f"TCP {peer} closed")
+
+
+# --- UDP ---
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    # プロキシ → サーバ方向のソケット（クライアントごとに1つ）
+    def __init__(self, proxy, client_addr):
+        self.proxy = proxy
+        self.client_addr = client_addr
+        self.transport = None
+        self.last_seen = time.time()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.proxy.peers[self.client_addr][2].push(data)
+
+
+class UdpProxy(asyncio.DatagramProtocol):
+    def __init__(self, args):
+        self.args = args
+        self.transport = None
+        self.peers = {}   # クライアントのアドレス → (サーバ側のプロトコル, 上り, 下り)
+        self.pending = {}   # サーバ側のソケットを作っている途中のアドレス → その間に届いたデータグラム
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        peer = self.peers.get(addr)
+        if peer is None:
+            # 作っている途中に届いた分は溜めておく（クライアントごとにソケットは1つだけ作る）
+            if addr in self.pending:
+                self.pending[addr].append(data)
+            else:
+                self.pending[addr] = [data]
+                asyncio.get_running_loop().create_task(self.open_peer(addr))
+            return
+        peer[0].last_seen = time.time()
+        peer[1].push(data)
+
+    async def open_peer(self, addr):
+        loop = asyncio.get_running_loop()
+        try:
+            _, upstream = await loop.create_datagram_endpoint(
+                lambda: UpstreamProtocol(self, addr), remote_addr=(self.args.target_host, self.args.target_port))
+        except OSError as e:
+            del self.pending[addr]
+            print(f"UDP {addr} failed: {e}")
+            return
+        up = Link(f"{addr[1]} up", self.args, upstream.transport.sendto, ordered=False)
+        down = Link(f"{addr[1]} down", self.args, lambda data: self.transport.sendto(data, addr), ordered=False)
+        self.peers[addr] = (upstream, up, down)
+        links.extend([up, down])
+        print(f"UDP {addr} connected")
+        for data in self.pending.pop(addr):
+            up.push(data)
+
+    async def expire_forever(self, timeout):
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.time()
+            for addr, (upstream, up, down) in list(self.peers.items()):
+                if now - upstream.last_seen > timeout:
+                    upstream.transport.close()
+                    links.remove(up)
+                    links.remove(down)
+                    del self.peers[addr]
+                    print(f"UDP {addr} expired")
+
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+    loop.create_task(report_forever(args.log_interval))
+    if args.transport == "udp":
+        _, proxy = await loop.create_datagram_endpoint(lambda: UdpProxy(args), local_addr=(args.host, args.port))
+        print(f"UDP proxy {args.host}:{args.port} → {args.target_host}:{args.target_port}")
+        await proxy.expire_forever(10.0)
+    else:
+        server = await asyncio.start_server(lambda r, w: handle_tcp(r, w, args), args.host, args.port,
+                                            reuse_address=True)
+        print(f"TCP proxy {args.host}:{args.port} → {args.target_host}:{args.target_port}")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="遅延・ロスなどを起こすローカルプロキシ")
+    parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5051, help="クライアントが接続するポート")
+    parser.add_argument("--target-host", default="127.0.0.1")
+    parser.add_argument("--target-port", type=int, default=5050, help="サーバのポート")
+    parser.add_argument("--latency", type=float, default=50, help="片道の遅延(ms)")
+    parser.add_argument("--jitter", type=float, default=0, help="遅延の揺らぎ ±ms")
+    parser.add_argument("--bandwidth", type=float, default=0, help="片方向の帯域(kbit/s, 0で無制限)")
+    parser.add_argument("--loss", type=float, default=0, help="パケットロス率 (0〜1)")
+    parser.add_argument("--reorder", type=float, default=0, help="UDPで順番を入れ替える割合 (0〜1)")
+    parser.add_argument("--retransmit", type=float, default=200, help="TCPでロスしたときの再送待ち(ms)")
+    parser.add_argument("--log-interval", type=float, default=1.0, help="スループットを表示する間隔(秒)")
+    parser.add_argument("--seed", type=int, default=None, help="乱数の種（同じ条件を再現する）")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,206 @@
+import json
+import os
+import sys
+import time
+
+import pygame
+
+# --- 描画 ---
+# クライアントとデバッグビューア（debug_viewer.py）が同じ絵でマップとプレイヤーを描くための共通部分。
+# pygame.display.set_mode の後で使う（画像の読み込みに convert_alpha を使うため）
+
+
+def resource_path(relative_path):
+    try:
+        base_path = sys._MEIPASS  # PyInstallerが実行ファイルを展開する一時フォルダ
+    except Exception:
+        base_path = os.path.abspath(".")
+
+    return os.path.join(base_path, relative_path)
+
+
+# ----- Mapクラス -----
+class Map:
+    def __init__(self, map_data, image_paths=None):
+        # image_paths: タイルセット画像の名前 → 手元のパス（サーバから受け取ったキャッシュ）。なければmapフォルダから読む
+        self.tile_width = map_data["tilewidth"]
+        self.tile_height = map_data["tileheight"]
+        self.width = map_data["width"]
+        self.height = map_data["height"]
+        self.layers = map_data["layers"]
+
+        self.tilesets = []
+        for tileset in map_data["tilesets"]:
+            name = os.path.basename(tileset["image"])
+            image_path = image_paths[name] if image_paths else os.path.join("map", name)
+            image = pygame.image.load(image_path).convert_alpha()
+            columns = image.get_width() // self.tile_width
+            self.tilesets.append({
+                "firstgid": tileset["firstgid"],
+                "image": image,
+                "columns": columns
+            })
+
+        # 自分の移動を予測するときにサーバと同じ当たり判定を使う
+        self.collide_layer = None
+        for layer in self.layers:
+            if layer.get("name") == "collideObj" and layer.get("type") == "tilelayer":
+                self.collide_layer = layer
+                break
+
+    def get_tile(self, index):
+        if index == 0:
+            return None
+        for tileset in reversed(self.tilesets):
+            if index >= tileset["firstgid"]:
+                local_index = index - tileset["firstgid"]
+                max_index = (tileset["image"].get_width() // self.tile_width) * (tileset["image"].get_height() // self.tile_height)
+                if local_index < 0 or local_index >= max_index:
+                    return None
+                x = (local_index % tileset["columns"]) * self.tile_width
+                y = (local_index // tileset["columns"]) * self.tile_height
+                return tileset["image"].subsurface(pygame.Rect(x, y, self.tile_width, self.tile_height))
+        return None
+
+    def draw(self, surface, offset_x, offset_y):
+        start_col = int(offset_x // self.tile_width)
+        start_row = int(offset_y // self.tile_height)
+        end_col = int((offset_x + surface.get_width()) // self.tile_width) + 1
+        end_row = int((offset_y + surface.get_height()) // self.tile_height) + 1
+
+        for layer in self.layers:
+            if layer["type"] == "tilelayer":
+                for row in range(start_row, min(end_row, self.height)):
+                    for col in range(start_col, min(end_col, self.width)):
+                        tile_index = layer["data"][row * self.width + col]
+                        tile = self.get_tile(tile_index)
+                        if tile:
+                            surface.blit(tile, (
+                                col * self.tile_width - offset_x,
+                                row * self.tile_height - offset_y
+                            ))
+
+
+class Animation:
+    def __init__(self, image_path, frame_width, frame_height, num_frames, speed):
+        sheet = pygame.image.load(image_path).convert_alpha()
+        self.frames = []
+        for i in range(num_frames):
+            rect = pygame.Rect(i * frame_width, 0, frame_width, frame_height)
+            frame = sheet.subsurface(rect).copy()
+            self.frames.append(frame)
+        self.num_frames = num_frames
+        self.index = 0
+        self.speed = speed  # 1フレームあたり何秒？
+        self.last_update = time.time()
+
+    def get_frame(self):
+        current_time = pygame.time.get_ticks()
+        if current_time - self.last_update >= self.speed * 1000:
+            self.index = (self.index + 1) % self.num_frames
+            self.last_update = current_time
+        return self.frames[self.index]
+
+
+# === クライアント用エフェクトアニメーションクラス ===
+class ClientEffectAnimation:
+    def __init__(self, image_path, frame_width, frame_height, num_frames, speed=0.1, scale=1.0):
+        sheet = pygame.image.load(image_path).convert_alpha()
+        self.frames = []
+        self.speed = speed
+        self.frame_count = num_frames
+        self.scale = scale  # ← 追加
+
+        for i in range(num_frames):
+            rect = pygame.Rect(i * frame_width, 0, frame_width, frame_height)
+            frame = sheet.subsurface(rect).copy()
+            if scale != 1.0:
+                frame = pygame.transform.scale(frame, (int(frame_width * scale), int(frame_height * scale)))
+            self.frames.append(frame)
+
+    def get_frame(self, elapsed):
+        frame_index = int(elapsed / self.speed)
+        if frame_index < self.frame_count:
+            return self.frames[frame_index]
+        return None
+
+#シールドのアニメーション(最後まで行ったら最後で止める)
+class HoldLastFrameAnimation:
+    def __init__(self, sheet_path, frame_width, frame_height, num_frames, speed, scale=1.0):
+        self.sheet = pygame.image.load(sheet_path).convert_alpha()
+        self.frames = []
+        for i in range(num_frames):
+            rect = pygame.Rect(i * frame_width, 0, frame_width, frame_height)
+            frame = self.sheet.subsurface(rect).copy()
+            if scale != 1.0:
+                frame = pygame.transform.scale(frame, (int(frame_width * scale), int(frame_height * scale)))
+            self.frames.append(frame)
+
+        self.num_frames = num_frames
+        self.speed = speed
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+
+    def get_frame(self):
+        if self.start_time is None:
+            return self.frames[0]
+        elapsed = time.time() - self.start_time
+        index = int(elapsed / self.speed)
+        if index >= self.num_frames:
+            return self.frames[-1]  # 最後のフレームで止まる
+        return self.frames[index]
+
+
+def load_map(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def draw_health_bar(surface, x, y, hp, max_hp=100, width=40, height=5):
+    ratio = hp / max_hp
+    pygame.draw.rect(surface, (255, 0, 0), (x, y - 10, width, height))
+    pygame.draw.rect(surface, (0, 255, 0), (x, y - 10, width * ratio, height))
+
+
+def draw_shield_gage(surface, x, y, gage, max_gage=500, width=40, height=5):
+    ratio = max(0, min(gage / max_gage, 1))  # 0～1の範囲にクランプ
+    pygame.draw.rect(surface, (100, 100, 100), (x, y - 15, width, height))  # 背景
+    pygame.draw.rect(surface, (0, 200, 255), (x, y - 15, width * ratio, height))  # 青ゲージ
+
+
+def create_animations():
+    return {
+        'run': Animation(resource_path("アニメーション/Run.png"), 128, 128, 8, 0.1),
+        'idle': Animation(resource_path("アニメーション/Idle.png"), 128, 128, 4, 0.45),
+        'jump': Animation(resource_path("アニメーション/Jump.png"), 128, 128, 10, 0.85),
+        'walk': Animation(resource_path("アニメーション/Walk.png"), 128, 128, 8, 0.25),
+        'dead': Animation(resource_path("アニメーション/Dead.png"), 128, 128, 3, 0.25),
+        'shield': Animation(resource_path("アニメーション/Shield.png"), 128, 128, 2, 0.25),
+        'attack1': Animation(resource_path("アニメーション/Attack_1.png"), 128, 128, 4, 0.01),
+        'attack2': Animation(resource_path("アニメーション/Attack_2.png"), 128, 128, 3, 1),
+        'attack3': Animation(resource_path("アニメーション/Attack_3.png"), 128, 128, 4, 1),
+        'hurt': Animation(resource_path("アニメーション/Hurt.png"), 128, 128, 3, 0.25)
+    }
+
+
+ELEMENT_EFFECTS = [
+    "fire", "water", "lightning",
+    "earth", "wind", "ice"
+]
+
+
+def load_effect_animations():
+    return {
+        "stun": ClientEffectAnimation(resource_path("img/effects/stun.png"), 192, 192, 10, 0.05),
+        "wave_strike": ClientEffectAnimation(resource_path("img/effects/wave_strike.png"), 64, 64, 1, 0.08),
+        "all_death_damage": ClientEffectAnimation(resource_path("img/effects/all_death_damage.png"), 120, 120, 7, 0.08),
+        "normal_slash": ClientEffectAnimation(resource_path("img/effects/normal_slash.png"), 120, 120, 5, 0.08),
+        "criticalAttackMulti": ClientEffectAnimation(resource_path("img/effects/criticalAttackMulti.png"), 640, 480, 24, 0.08, scale=0.3),
+        "shadow_move": ClientEffectAnimation(resource_path("img/effects/shadow_move.png"), 320, 120, 8, 0.1),
+        "charge_boost": ClientEffectAnimation(resource_path("img/effects/charge_boost.png"), 120, 120, 5, 0.08),
+        "claymore_trap": ClientEffectAnimation(resource_path("img/effects/claymore_trap.png"), 320, 120, 6, 0.1),
+        "Element_aura": ClientEffectAnimation(resource_path("img/effects/Element_aura.png"), 120, 120, 8, 0.1),
+        **{name: ClientEffectAnimation(resource_path(f"img/effects/{name}.png"), 120, 120, 8, 0.1) for name in ELEMENT_EFFECTS}
+    }
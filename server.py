@@ -1,14 +1,36 @@
 import socket
 import pygame
-import pickle
 import threading
 import json
-import copy
 import time
 import random
 import math
 import sys
 import os
+import argparse
+import itertools
+import traceback
+import secrets
+import hmac
+import ipaddress
+from collections import deque
+from net_protocol import (
+    ProtocolError, MSG_PLAYER_ID, MSG_MAP, MSG_JOB, MSG_INPUT, MSG_STATE, MSG_EFFECTS, MSG_EVENT,
+    MSG_MAP_REQUEST, MSG_MAP_CHUNK, MSG_PING, MSG_PONG, MSG_SESSION, MSG_RESUME, MSG_OBSERVE, MSG_DEBUG,
+    PLAYER_ID, SESSION_TOKEN_SIZE,
+    BufferPool, decode_input, mask_to_keys, release_parts, unpack_object,
+)
+from snapshot_codec import (
+    SnapshotHistory, write_world, write_client_part, encode_effects, encode_event, encode_debug,
+    make_record, make_flags, pack_skills,
+    EVENT_DEATH, EVENT_RESPAWN,
+)
+from async_server import start_in_thread
+from movement import GRAVITY, PLAYER_SIZE, walk, fall, collide_map
+from event_journal import EventJournal
+from map_transfer import MapBundle
+from clock_sync import answer_ping
+from entities import Player, SkillState, skills_from_data
 
 def resource_path(relative_path):
     try:
@@ -29,14 +51,16 @@ class Map:
         self.layers = map_data["layers"]
 
         self.tilesets = []
-        for tileset in map_data["tilesets"]:
-            image = pygame.image.load(tileset["image"]).convert_alpha()
-            columns = image.get_width() // self.tile_width
-            self.tilesets.append({
-                "firstgid": tileset["firstgid"],
-                "image": image,
-                "columns": columns
-            })
+        # ヘッドレスでは描かないのでタイルセットの画像は読まない（当たり判定はレイヤーのデータだけで足りる）
+        if not HEADLESS:
+            for tileset in map_data["tilesets"]:
+                image = pygame.image.load(tileset["image"]).convert_alpha()
+                columns = image.get_width() // self.tile_width
+                self.tilesets.append({
+                    "firstgid": tileset["firstgid"],
+                    "image": image,
+                    "columns": columns
+                })
 
         self.collide_layer = None
         for layer in self.layers:
@@ -79,22 +103,27 @@ class Map:
 
 class Animation:
     def __init__(self, image_path, frame_width, frame_height, num_frames, speed):  # ← speed追加
-        sheet = pygame.image.load(image_path).convert_alpha()
         self.frames = []
-        for i in range(num_frames):
-            rect = pygame.Rect(i * frame_width, 0, frame_width, frame_height)
-            frame = sheet.subsurface(rect).copy()
-            self.frames.append(frame)
+        # ヘッドレスでは絵は読まず、スナップショットで送るコマ番号だけ進める
+        if not HEADLESS:
+            sheet = pygame.image.load(image_path).convert_alpha()
+            for i in range(num_frames):
+                rect = pygame.Rect(i * frame_width, 0, frame_width, frame_height)
+                frame = sheet.subsurface(rect).copy()
+                self.frames.append(frame)
         self.num_frames = num_frames
         self.index = 0
         self.speed = speed  # 1フレームあたり何秒？
         self.last_update = time.time()
 
-    def get_frame(self):
+    def advance(self):
         current_time = time.time()
         if current_time - self.last_update >= self.speed:
             self.index = (self.index + 1) % self.num_frames
             self.last_update = current_time
+
+    def get_frame(self):
+        self.advance()
         return self.frames[self.index]
 
 
@@ -173,11 +202,34 @@ def load_map(path):
     with open(path, "r") as f:
         return json.load(f)
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--transport", choices=["tcp", "udp"], default="tcp",
+                    help="udp: スナップショットと入力をUDPで送る（エフェクト・死亡などは再送付き）")
+parser.add_argument("--tick-rate", type=int, default=60,
+                    help="1秒あたりのシミュレーション・送信回数")
+parser.add_argument("--max-rewind", type=float, default=0.25,
+                    help="ラグ補正で当たり判定を巻き戻す最大秒数")
+parser.add_argument("--resume-grace", type=float, default=30.0,
+                    help="切断したプレイヤーを再接続に備えて残しておく秒数")
+parser.add_argument("--observer-key", default=None,
+                    help="debug_viewer.py が観測者として接続するための鍵（指定しなければ同じマシンからだけ受け付ける）")
+parser.add_argument("--headless", action="store_true",
+                    help="ウィンドウを開かず画像も読まない（VPSなどでネットワークとシミュレーションだけ動かす）")
+args = parser.parse_args()
+TRANSPORT = args.transport
+TICK_RATE = args.tick_rate
+MAX_REWIND = args.max_rewind
+RESUME_GRACE = args.resume_grace
+OBSERVER_KEY = args.observer_key
+HEADLESS = args.headless
+
 # --- pygame初期化 ---
-pygame.init()
-WIDTH, HEIGHT = 992, 800
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-clock = pygame.time.Clock()
+# ヘッドレスではウィンドウを開かない（pygameは当たり判定のRectにだけ使う）
+WIDTH, HEIGHT = 992, 800   # クライアントの画面の大きさ（視界の計算にも使う）
+if not HEADLESS:
+    pygame.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    clock = pygame.time.Clock()
 
 # === 汎用エフェクトアニメーションクラス ===
 class EffectAnimation:
@@ -235,13 +287,19 @@ def update_and_draw_effects(surface, offset_x=0, offset_y=0):
 
 
 def send_skill_effect(name, x, y, duration=0.5):
+    start = time.time()
     skill_effects.append({
         "type": name,
         "x": x,
         "y": y,
-        "start": time.time(),
+        "start": start,
         "duration": duration
-    })
+    }, expires_at=start + duration)
+
+
+# 死亡・復活などはスナップショットとは別に、全員へ一度だけ確実に送る
+def send_game_event(kind, player_id):
+    game_events.append({"kind": kind, "player_id": player_id})
 
 
 element_effects = [
@@ -251,19 +309,20 @@ element_effects = [
 
 
 
-#起動時に一度だけ登録
-register_effect("stun", resource_path("img/effects/stun.png"), 192, 192, 10, 0.05)
-register_effect("wave_strike", resource_path("img/effects/wave_strike.png"), 64, 64, 1, 0.08)
-register_effect("all_death_damage", resource_path("img/effects/all_death_damage.png"), 120, 120, 7, 0.08)
-register_effect("normal_slash", resource_path("img/effects/normal_slash.png"), 120, 120, 5, 0.08)
-register_effect("criticalAttackMulti", resource_path("img/effects/criticalAttackMulti.png"), 640, 480, 24, 0.08)
-register_effect("shadow_move", resource_path("img/effects/shadow_move.png"), 320, 120, 8, 0.1)
-register_effect("charge_boost", resource_path("img/effects/charge_boost.png"), 120, 120, 5, 0.1)
-register_effect("wave_strike", resource_path("img/effects/wave_strike.png"), 120, 120, 7, 0.08)
-register_effect("claymore_trap", resource_path("img/effects/claymore_trap.png"), 320, 120, 6, 0.1)
-register_effect("Element_aura", resource_path("img/effects/Element_aura.png"), 120, 120, 8, 0.1)
-for name in element_effects:
-    register_effect(name, resource_path(f"img/effects/{name}.png"), 120, 120, 8, 0.1)
+#起動時に一度だけ登録（サーバで描くときだけ）
+if not HEADLESS:
+    register_effect("stun", resource_path("img/effects/stun.png"), 192, 192, 10, 0.05)
+    register_effect("wave_strike", resource_path("img/effects/wave_strike.png"), 64, 64, 1, 0.08)
+    register_effect("all_death_damage", resource_path("img/effects/all_death_damage.png"), 120, 120, 7, 0.08)
+    register_effect("normal_slash", resource_path("img/effects/normal_slash.png"), 120, 120, 5, 0.08)
+    register_effect("criticalAttackMulti", resource_path("img/effects/criticalAttackMulti.png"), 640, 480, 24, 0.08)
+    register_effect("shadow_move", resource_path("img/effects/shadow_move.png"), 320, 120, 8, 0.1)
+    register_effect("charge_boost", resource_path("img/effects/charge_boost.png"), 120, 120, 5, 0.1)
+    register_effect("wave_strike", resource_path("img/effects/wave_strike.png"), 120, 120, 7, 0.08)
+    register_effect("claymore_trap", resource_path("img/effects/claymore_trap.png"), 320, 120, 6, 0.1)
+    register_effect("Element_aura", resource_path("img/effects/Element_aura.png"), 120, 120, 8, 0.1)
+    for name in element_effects:
+        register_effect(name, resource_path(f"img/effects/{name}.png"), 120, 120, 8, 0.1)
 
 
 
@@ -288,7 +347,8 @@ def create_animations():
     }
 
 
-shieldsheet = pygame.image.load(resource_path("img/effects/shield.png")).convert_alpha()
+if not HEADLESS:
+    shieldsheet = pygame.image.load(resource_path("img/effects/shield.png")).convert_alpha()
 
 all_map = [
     resource_path("map/field.json"),
@@ -302,34 +362,48 @@ all_map = [
     resource_path("map/battle.json")
 ]
 
-skill_effects = []  # エフェクト保存用リスト
+EFFECT_JOURNAL_SIZE = 512   # 覚えておくエフェクトの数（それより古いもの・終わったものは消える）
+EVENT_JOURNAL_SIZE = 256
+skill_effects = EventJournal(EFFECT_JOURNAL_SIZE)  # エフェクト保存用
+game_events = EventJournal(EVENT_JOURNAL_SIZE)
 traps = []
 
 
 # shieldスプライトは5フレーム分 (i=5〜1)
-player_shields = [get_sprite(shieldsheet, i, 0, 50, 50) for i in range(5, 0, -1)]
-player_size = (40, 115)
+if not HEADLESS:
+    player_shields = [get_sprite(shieldsheet, i, 0, 50, 50) for i in range(5, 0, -1)]
+player_size = PLAYER_SIZE
 players = {}
-SPEED = 4
-JUMP_VELOCITY = -8
-GRAVITY = 0.5
+player_ids = itertools.count()
+SPECTATOR_JOB = "Spectator"   # この職業名で接続すると観戦者になる
+sessions = {}   # player_id → 接続ごとの状態（入力キュー・送信済みスナップショットなど）
+suspended = {}  # player_id → (切断中で止めてあるプレイヤー, 合言葉, 消す時刻)
+session_tokens = {}   # 再開の合言葉 → player_id
+world_lock = threading.Lock()   # players / sessions / エフェクトはtickスレッドと接続スレッドで共有
 SHIELD_GAGE = 500
 SHIELD_COST = 5
+SNAPSHOT_HISTORY = 32   # 差分の基準として覚えておく送信済みスナップショット数
+VIEW_MARGIN = 200        # 画面の外でも毎tick送る幅(px)
+FAR_MARGIN = 1000        # 画面からこれより遠いプレイヤーは送らない(px)
+FAR_UPDATE_INTERVAL = 6  # 余白より外・FAR_MARGINより内のプレイヤーを送る間隔(tick)
+MAX_INPUT_BACKLOG = 3   # 1人分の入力キューに溜めておく最大数（超えたら古い方から捨てる）
+MAX_TICK_CATCHUP = 5    # これ以上tickが遅れたら追いつくのを諦める
 offset_x = 0
 offset_y = 0
-font = pygame.font.SysFont(None, 20)
+font = pygame.font.SysFont(None, 20) if not HEADLESS else None
 HOST = '0.0.0.0'
 PORT = 5050
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-server.bind((HOST, PORT))
-server.listen(5)
+rect_history = deque(maxlen=int(MAX_REWIND * TICK_RATE) + 2)   # (tick, サーバ時刻, {pid: 当たり判定})
+send_buffers = BufferPool()   # スナップショットを書き込むバッファ（送り終わったら次のtickで使い回す）
+last_records = {}   # 前のtickのrecords（変わっていない人は同じタプルを使い回し、差分を作るときに飛ばせるようにする）
 
-print(f"Waiting for connections on {HOST}:{PORT}...")
+print(f"Waiting for connections on {HOST}:{PORT} ({TRANSPORT}, {TICK_RATE} ticks/s"
+      f"{', headless' if HEADLESS else ''})...")
 #selected_map = random.choice(all_map)  #ランダム用
 selected_map = all_map[0]   #初期マップ
 map_data = load_map(selected_map)
+map_bundle = MapBundle(selected_map)   # クライアントに配るマップJSONとタイルセット画像
 game_map = Map(map_data)
 
 
@@ -353,18 +427,18 @@ def draw_name(surface, x, y, player_id, width=40, height=40):
 
 
 def handle_collision(player_id):
-    player_rect = players[player_id]["rect"]
+    player_rect = players[player_id].rect
     
     for other_id, other_data in players.items():
         if other_id != player_id:
-            other_rect = other_data["rect"]
+            other_rect = other_data.rect
             if player_rect.colliderect(other_rect):
                 # 上から着地
                 if (player_rect.bottom > other_rect.top and
                     player_rect.top < other_rect.top and
                     player_rect.centery < other_rect.centery):
                     player_rect.bottom = other_rect.top
-                    players[player_id]["vel_y"] = 0
+                    players[player_id].vel_y = 0
                     # on_groundは他プレイヤーでは設定しない
 
                 # 下からぶつかった（ジャンプ中）
@@ -372,7 +446,7 @@ def handle_collision(player_id):
                       player_rect.bottom > other_rect.bottom and
                       player_rect.centery > other_rect.centery):
                     player_rect.top = other_rect.bottom
-                    players[player_id]["vel_y"] = 0
+                    players[player_id].vel_y = 0
 
                 # 左からぶつかった（→方向）
                 elif (player_rect.right > other_rect.left and
@@ -388,611 +462,849 @@ def handle_collision(player_id):
 
 
 def handle_map_collision(player):
-    if not game_map.collide_layer:
-        return
+    collide_map(player, game_map)
+
+
+def player_record(pdata):
+    return make_record(
+        pdata.rect.x, pdata.rect.y, pdata.job,
+        pdata.hp, pdata.maxHp, pdata.defense, pdata.ShieldGage,
+        make_flags(pdata.alive, pdata.isShield, pdata.ShieldRecovering, pdata.facing_right),
+        pdata.animation_state,
+        pdata.animations[pdata.animation_state].index,
+        pdata.attack_status,
+        pdata.element_type,
+        pdata.mouse_pos,
+        # ✅ 本来のスキルだけ送る
+        pack_skills(pdata.common, pdata.job_skill, job_data[pdata.job]["skills"]),
+    )
+
+
+def step_player(player_id, keys, just_pressed, mouse_pos, view_time=0.0):
+    # 1tick分だけプレイヤーを進める（入力が来た回数ではなくtickの回数で進む）
+    player = players[player_id]
+    current_time = time.time()
+    player.mouse_pos = mouse_pos  # ← 必要であればプレイヤー情報に保持
+    player.view_time = view_time  # この入力のとき画面に映っていた他プレイヤーの時刻
+    
+    just_pressed_13 = just_pressed & (1 << 13) #z
+    just_pressed_14 = just_pressed & (1 << 14) #m
+    if keys[12] and player.alive == False:
+        print(f"サーバで死亡を確認  keys[12]{keys[12]}")
+        print(f"Player {player_id} respawned.")
+        keys[12] = False
+        player.hp = player.maxHp
+        player.rect.x, player.rect.y = 100 + player_id * 100, HEIGHT - player_size[1] - 150
+        player.alive = True
+        send_game_event(EVENT_RESPAWN, player_id)
+        player.vel_y = 0
+        player.ShieldGage = SHIELD_GAGE
+        for skill in player.common.values():
+            skill.active = False
+            skill.cooldown = 10
+            skill.stuned = False
+        for skill in player.job_skill.values():
+            skill.active = False
+            skill.cooldown = 10
+        print(f"復活処理終了 keys[12] = {keys[12]}")
+        #pass
+
+    if player.alive: #生きてたら作動するゾーン
+        # スキル効果終了判定
+        for skill_name, skill in player.common.items():
+            if skill.active and current_time >= skill.end_time:
+                skill.active = False
+                print(f"Player {player_id} {skill_name} ended.")
+        # クールダウン減少
+        for skill in player.common.values():
+            if skill.cooldown > 0:
+                skill.cooldown -= 1
+        
+        # --- 移動処理 ---
+        if not player.common["stun"].stuned and not player.isShield:
+            # 左右移動とジャンプ（クライアントの予測と同じ movement.walk を使う）
+            moved, jumped = walk(player, keys)
+            if jumped:
+                if player.animation_state != "jump":
+                    player.animation_state = "jump"
+                    player.animations["jump"].index = 0
+            elif moved:
+                if player.animation_state != "run":
+                    player.animation_state = "run"
+                    player.animations["run"].index = 0
+            else:
+                if player.animation_state != "idle":
+                    player.animation_state = "idle"
+                    player.animations["idle"].index = 0
+
+        # --- パンチ ---処理
+       # --- パンチ処理 ---
+        if keys[4]:
+            if player.attack_cooldown <= 0:
+                for target_id, target in players.items():
+                    if target_id != player_id and target.hp > 0 and target.alive and not player.isShield:
+                        target_rect = rewound_rect(target_id, player)  # 攻撃した人に見えていた位置
+                        dx = player.rect.centerx - target_rect.centerx
+                        dy = player.rect.centery - target_rect.centery
+                        dist = (dx**2 + dy**2) ** 0.5
+
+                        # 連射モード倍率
+                        cool_multiplier = 1.0
+
+                        # Sniperのover_heat
+                        if player.job == "Sniper":
+                            buff = player.job_skill["over_heat"]
+                            if buff.buffed and current_time < buff.end_time:
+                                cool_multiplier = buff.multipliers.get("attack_cooldown", 1.0)
+
+                        # Berserkerのboost
+                        if player.job == "Berserker":
+                            boost = player.job_skill["boost"]
+                            if boost.buffed and current_time < boost.end_time:
+                                cool_multiplier = boost.multipliers.get("attack_cooldown", 1.0)
+
+                        # 攻撃アニメ
+                        if player.animation_state != "attack1":
+                            player.animation_state = "attack1"
+                            player.animations["attack1"].index = 0
+
+                        if player.animation_state.startswith("attack"):
+                            animation = player.animations["attack1"]
+                            if animation.index >= animation.num_frames - 1:
+                                player.animation_state = "idle"
+                                animation.index = 0
+
+                        # 距離判定
+                        if player.job == "Sniper":
+                            # マウス座標を取得
+                            mx, my = player.mouse_pos  # プレイヤーの送信データにマウス座標が含まれている前提
+
+                            # ターゲットのスクリーン座標を計算（撃った人のカメラ基準）
+                            camera = camera_rect(player.rect)
+                            screen_x = target_rect.x - camera.x
+                            screen_y = target_rect.y - camera.y
+
+                            # マウスがターゲットの当たり判定に入っているか
+                            if pygame.Rect(screen_x, screen_y, target_rect.width, target_rect.height).collidepoint(mx, my):
+                                abnormal_condition(target, target_id, player, player_id)
+                                send_skill_effect("normal_slash", target.rect.centerx, target.rect.centery)
+
+                        elif dist <= 50:
+                            abnormal_condition(target, target_id, player, player_id)
+                            send_skill_effect("normal_slash", target.rect.centerx, target.rect.centery)
+
+                        player.attack_cooldown = max(int(30 * cool_multiplier), 1)  # 0防止
+
+                        # 死亡処理
+                        if target.hp <= 0:
+                            target.animation_state = "dead"
+                            target.animations["dead"].index = 0
+                            target.alive = False
+                            target.hp = 0
+                            send_game_event(EVENT_DEATH, target_id)
+                            #target.rect.x, target.rect.y = 1000000, 1000000
+                            print(f"Player {target_id} died")
+            if player.attack_cooldown > 0:
+                player.attack_cooldown -= 1
+        if player.attack_cooldown > 0:
+            player.attack_cooldown -= 1
+        # --- シールド処理 ---
+        if keys[5]:
+            if not player.ShieldRecovering and player.ShieldGage >= SHIELD_COST:
+                player.isShield = True
+                player.ShieldGage -= SHIELD_COST
+                print(f"Player {player_id} activated shield")
+                if player.animation_state != "shield":
+                    player.animation_state = "shield"
+                    player.animations["shield"].index = 0
+                
+                if player.ShieldGage <= 0:
+                    player.ShieldRecovering = True
+            else:
+                player.isShield = False
+        else:
+            player.isShield = False
+            
+        # --- ジャンプスキル ---
+        if keys[6]:
+            skill = player.common["jump_skill"]
+            if not skill.active and skill.cooldown <= 0:
+                skill.active = True
+                skill.end_time = current_time + 5  # 効果5秒間
+                skill.cooldown = 1200  #1000m/s = 60(1秒で60)      つまり20秒
+                print(f"Player {player_id} activated jump skill!")
+        # --- スタンスキル ---
+        if keys[7]:
+            skill = player.common["stun"]
+            if not skill.active and skill.cooldown <= 0:
+                skill.active = True
+                skill.end_time = current_time + 3
+                skill.cooldown = 900
+                print(f"Player {player_id} activated stun skill")
+                stun_range = 100
+                px, py = player.rect.center
+                for target_id, target in players.items():
+                    if target_id != player_id and target.alive:
+                        tx, ty = target.rect.center
+                        dist = ((px - tx)**2 + (py - ty)**2)**0.5
+                        if dist <= stun_range:
+                            target.common["stun"].stuned = True
+                            send_skill_effect("stun", target.rect.centerx, target.rect.centery)
+                            target.common["stun"].end_time = current_time + 3
+                            print(f"Player {target_id} stunned by player {player_id}!")
+                            
+        if player.common["stun"].stuned:
+            for target_id, target in players.items():
+                stun_skill = target.common["stun"]
+                if stun_skill.stuned:  # stunedがTrueなら
+                    if current_time >= stun_skill.end_time:
+                        stun_skill.stuned = False
+                        print(f"Player {target_id} is stuned")
+                        
+        # --- 回復スキル1 ---     
+        if keys[8]:
+            if player.job == "Player":
+                skill = player.job_skill["heal"]
+                if not skill.active and skill.cooldown <= 0:  #healのクールタイムとか定義
+                    skill.active = True
+                    skill.end_time = current_time + skill.next_time    #0.1秒ごとに回復する
+                    skill.cooldown = 30
+                    print(f"Player {player_id} activated heal skill")
+                elif skill.healed and skill.active:
+                    skill.healed = False
+                    
+                if skill.active:     #ここで実行処理
+                    if not skill.healed:
+                        player.hp += math.floor(random.random() * skill.amount) + 100
+                        skill.healed = True
+                    if player.hp > player.maxHp:
+                        player.hp = player.maxHp
+            else:
+                pass
+        # --- 回復スキル2 ---     
+        if player.job == "Wizard":
+            skill = player.job_skill["heal"]
+            if not skill.active and skill.cooldown <= 0:  #healのクールタイムとか定義
+                skill.active = True
+                skill.cooldown = 30
+                print(f"Player {player_id} activated heal skill")
+                
+            if skill.active:     #ここで実行処理
+                if not skill.healed:
+                    player.hp += skill.amount
+                    skill.healed = True
+                if player.hp > player.maxHp:
+                    player.hp = player.maxHp
+            else:
+                pass
+            if skill.healed and skill.active:
+                skill.healed = False
+                skill.active = False
+
 
-    tile_w, tile_h = game_map.tile_width, game_map.tile_height
-    layer = game_map.collide_layer
-    rect = player["rect"]
-    left = rect.left // tile_w
-    right = rect.right // tile_w
-    top = rect.top // tile_h
-    bottom = rect.bottom // tile_h
-
-    # 垂直方向の衝突
-    for row in range(top, bottom + 1):
-        for col in range(left, right + 1):
-            if row < 0 or row >= game_map.height or col < 0 or col >= game_map.width:
+        # --- Claymore罠の当たり判定 ---
+        for trap in traps[:]:
+            if time.time() - trap["start_time"] > trap["duration"]:
+                traps.remove(trap)
                 continue
-            tile_index = layer["data"][row * game_map.width + col]
-            if tile_index == 324:
-                tile_rect = pygame.Rect(col * tile_w, row * tile_h, tile_w, tile_h)
-                if rect.colliderect(tile_rect):
-                    if player["vel_y"] > 0 and rect.bottom > tile_rect.top and rect.top < tile_rect.top:
-                        rect.bottom = tile_rect.top
-                        player["vel_y"] = 0
-                        player["on_ground"] = True
-                    elif player["vel_y"] < 0 and rect.top < tile_rect.bottom and rect.bottom > tile_rect.bottom:
-                        rect.top = tile_rect.bottom
-                        player["vel_y"] = 0
-
-    # 水平方向の衝突（on_ground のときのみ）
-    if player["on_ground"]:
-        for row in range(top, bottom + 1):
-            for col in range(left, right + 1):
-                if row < 0 or row >= game_map.height or col < 0 or col >= game_map.width:
+            for target_id, target in players.items():
+                if target_id == trap["owner"] or not target.alive:
                     continue
-                tile_index = layer["data"][row * game_map.width + col]
-                if tile_index == 324:
-                    tile_rect = pygame.Rect(col * tile_w, row * tile_h, tile_w, tile_h)
-                    if rect.colliderect(tile_rect):
-                        if rect.right > tile_rect.left and rect.left < tile_rect.left:
-                            rect.right = tile_rect.left
-                        elif rect.left < tile_rect.right and rect.right > tile_rect.right:
-                            rect.left = tile_rect.right
+                dx = target.rect.centerx - trap["x"]
+                dy = target.rect.centery - trap["y"]
+                if dx**2 + dy**2 <= trap["radius"]**2:
+                    damage = trap["damage"] // 2 if target.isShield else trap["damage"]
+                    target.hp -= damage
+                    send_skill_effect("claymore_trap", trap["x"], trap["y"])
+                    traps.remove(trap)
+                    print(f"Player {target_id} triggered a claymore and took {damage} damage.")
+                    break
+
+           
+
+        # --- 職業スキル1 ---
+        if keys[9]:     #attackSkill関数でまとめてる
+            #60が1秒になる  重くなるから正確ではない
+            if player.job == "Warrior":
+                attackSkill(player, player_id, player.job_skill["wave_strike"], 1000)
+            elif player.job == "Wizard":
+                buffSkill(player, player.job_skill["strength_buff"], 1500, 5)                      
+            elif player.job == "Assassin":
+                attackSkill(player, player_id, player.job_skill["shadow_move"], 200)
+            elif player.job == "Player":
+                attackSkill(player, player_id, player.job_skill["create_isGod"], 0)
+            elif player.job == "Sniper":
+                attackSkill(player, player_id, player.job_skill["far_snipe"], 900)
+            
+                
+        # --- 職業スキル2 ---        
+        if keys[10]:
+            if player.job == "Warrior":
+                attackSkill(player, player_id, player.job_skill["chargeBoost"], 400)
+            elif player.job == "Wizard":
+                buffSkill(player, player.job_skill["resistance_buff"], 1200, 10)
+            elif player.job == "Assassin":
+                attackSkill(player, player_id, player.job_skill["criticalAttackMulti"], 400)
+            elif player.job == "Sniper":
+                TrapSkill(player, player_id, player.job_skill["claymore_trap"], 300)
+            elif player.job == "Berserker":
+                buffSkill(player, player.job_skill["boost"], 900, 20)
+        
+        # --- 職業スキル奥義 ---        
+        if keys[11]:
+            if player.job == "Warrior":
+                AttackSuper(player, player_id, player.job_skill["all_death_damage"], 1400)
+            elif player.job == "Wizard":
+                AttackSuper(player, player_id, player.job_skill["Element_aura"], 70)
+            elif player.job == "Assassin":
+                AttackSuper(player, player_id, player.job_skill["dummy"], 600)
+            elif player.job == "Sniper":
+                buffSkill(player, player.job_skill["over_heat"], 900, 5)
+            elif player.job == "Berserker":
+                buffSkill(player, player.job_skill["berserked"], 1200, 20)
+
+        # === Assassin：criticalAttackMulti（乱刀）の進行管理 ===
+        if player.job == "Assassin":
+            rando = player.job_skill["criticalAttackMulti"]
+            if rando.active:
+                tid = rando.target_id
+                target = players.get(tid)
+                # 対象が消えた/死亡なら中断
+                if not target or not target.alive or target.hp <= 0:
+                    rando.active = False
+                else:
+                    send_skill_effect("criticalAttackMulti", target.rect.centerx, target.rect.centery)
+                    # 次ヒットの時間か？
+                    if time.time() >= rando.next_attack_time and rando.attack_remaining > 0:
+                        # 進行中に大きく離れたら中断（任意）
+                        dx_prog = abs(player.rect.centerx - target.rect.centerx)
+                        if dx_prog > 200:
+                            rando.active = False
+                        else:
+                            # 1ヒット分の与ダメ
+                            dmg = rando.damaged
+                            if target.isShield:
+                                target.hp -= dmg / 2
+                            else:
+                                target.hp -= dmg
+
+                            # ヒットごとにアニメを刻む（任意）
+                            player.animation_state = "attack2"
+                            player.animations["attack2"].index = 0
+
+                            # 次回時刻・残回数更新
+                            rando.attack_remaining -= 1
+                            rando.next_attack_time = time.time() + rando.interval
+
+                            # 死亡処理
+                            if target.hp <= 0:
+                                target.animation_state = "dead"
+                                target.animations["dead"].index = 0
+                                target.alive = False
+                                target.hp = 0
+                                send_game_event(EVENT_DEATH, tid)
+                                rando.active = False
+
+                # 全ヒット消化で終了
+                if rando.attack_remaining <= 0:
+                    rando.active = False
+
+
+        if just_pressed_13:
+            current = player.attack_status
+            next_status = {"normal": "poison", "poison": "burn", "burn": "regeneration", "regeneration": "normal"}[current]
+            player.attack_status = next_status
+            print(f"Player {player_id} changed attack status to: {next_status}")
+
+        if just_pressed_14 and player.job == "Wizard":
+            current = player.element_type
+            next_elements = {
+                "fire": "water",
+                "water": "ice",
+                "ice": "lightning",
+                "lightning": "wind",
+                "wind": "earth",
+                "earth": "nitro",
+                "nitro": "heal",
+                "heal": "fire",
+            }
+            player.element_type = next_elements.get(current, "fire")
+            print(f"Player {player_id} (Wizard) changed element to: {player.element_type}")
+
+
+    # クールダウン管理（共通・職業スキル）
+    for skill in player.common.values():
+        if skill.cooldown > 0 and not skill.active:
+            skill.cooldown -= 1
+    
+    for skill in player.job_skill.values():
+        if skill.cooldown > 0 and not skill.active:
+            skill.cooldown -= 1
 
+    # スキル効果終了
+    for skill_name, skill in player.common.items():
+        if skill.active and current_time >= skill.end_time:
+            skill.active = False
 
-def handle_client(client_socket, client_address, player_id):
-    
-    print(f"Player {player_id} connected from {client_address}")
-    client_socket.send(pickle.dumps(player_id))
-    client_socket.send(pickle.dumps(selected_map))
-    job = pickle.loads(client_socket.recv(1024))
-    stats = job_data.get(job, job_data["Player"])
+    update_buff_effects(player)
 
-    player_x, player_y = 100 + player_id * 100, HEIGHT - player_size[1] - 150
 
-    print(f"Player {player_id} selected job: {job}")
-
-    players[player_id] = {
-        "rect": pygame.Rect(player_x, player_y, *player_size),
-        "vel_y": 0,
-        "on_ground": True,
-        "job": job,
-        "damaged": stats["damaged"],
-        "hp": stats["hp"],
-        "defense": stats["defense"],
-        "maxHp": stats["hp"],
-        "alive": True,
-        "animations": create_animations(),
-        "animation_state": "idle",
-        "animation_index": 0,
-        "last_anim_time": time.time(),
-        "facing_right": True,
-        "isShield": False,
-        "ShieldGage": SHIELD_GAGE,
-        "ShieldRecovering": False,
-        "attack_cooldown": 0,
-        "buffed_effects": [],
-        "attack_status": "normal",
-        "element_type": "fire",  # 初期属性
-        "common": {
-            "jump_skill": {"active": False, "cooldown": 0, "end_time": 0},
-            "stun": {"active": False, "stuned": False, "cooldown": 0, "end_time": 0},
-        },
-        "job_skill": copy.deepcopy(stats.get("skills", {})),
-        "mouse_pos": (0,0),
-    }
-    previous_keys = [False] * 15  # 前回のキー状態（長押し検出防止用）
-    try:
-        while True:
-            data = client_socket.recv(1024)
-            if not data:
-                break
-            recv_data = pickle.loads(data)
-            keys = recv_data.get("keys", [False] * 15)
-            mouse_pos = recv_data.get("mouse_pos", (0, 0))  # ← マウス座標の取り出し
 
-            player = players[player_id]
-            player["mouse_pos"] = mouse_pos  # ← 必要であればプレイヤー情報に保持
-            
-            just_pressed_13 = keys[13] and not previous_keys[13] #z
-            just_pressed_14 = keys[14] and not previous_keys[14] #m
-            player = players[player_id]
-            if keys[12] and player["alive"] == False:
-                print(f"サーバで死亡を確認  keys[12]{keys[12]}")
-                print(f"Player {player_id} respawned.")
-                keys[12] = False
-                player["hp"] = player["maxHp"]
-                player["rect"].x, player["rect"].y = 100 + player_id * 100, HEIGHT - player_size[1] - 150
-                player["alive"] = True
-                player["vel_y"] = 0
-                player["ShieldGage"] = SHIELD_GAGE
-                for skill in player["common"].values():
-                    skill["active"] = False
-                    skill["cooldown"] = 10
-                    skill["stuned"] = False if "stuned" in skill else skill.get("stuned", False)
-                for skill in player["job_skill"].values():
-                    skill["active"] = False
-                    skill["cooldown"] = 10
-                print(f"復活処理終了 keys[12] = {keys[12]}")
-                #pass
-
-            if player["alive"]: #生きてたら作動するゾーン
-                current_time = time.time()
-                # スキル効果終了判定
-                for skill_name, skill in player["common"].items():
-                    if skill["active"] and current_time >= skill["end_time"]:
-                        skill["active"] = False
-                        print(f"Player {player_id} {skill_name} ended.")
-                # クールダウン減少
-                for skill in player["common"].values():
-                    if skill["cooldown"] > 0:
-                        skill["cooldown"] -= 1
-                
-                # --- 移動処理 ---
-                moved = False
-                if not player["common"]["stun"]["stuned"] and not player["isShield"]:
-                    if keys[0] and player["rect"].x > 0:
-                        player["rect"].x -= SPEED
-                        player["facing_right"] = False
-                        moved = True
-
-                    if keys[1] and player["rect"].x + player["rect"].width < WIDTH:
-                        player["rect"].x += SPEED
-                        player["facing_right"] = True
-                        moved = True
-
-                    if keys[2] and player["on_ground"]:
-                        player["vel_y"] = JUMP_VELOCITY
-                        player["on_ground"] = False
-                        if player["animation_state"] != "jump":
-                            player["animation_state"] = "jump"
-                            player["animations"]["jump"].index = 0
-                    elif moved:
-                        if player["animation_state"] != "run":
-                            player["animation_state"] = "run"
-                            player["animations"]["run"].index = 0
-                    else:
-                        if player["animation_state"] != "idle":
-                            player["animation_state"] = "idle"
-                            player["animations"]["idle"].index = 0
-
-                # --- パンチ ---処理
-               # --- パンチ処理 ---
-                if keys[4]:
-                    if player["attack_cooldown"] <= 0:
-                        for target_id, target in players.items():
-                            if target_id != player_id and target["hp"] > 0 and target["alive"] and not player["isShield"]:
-                                dx = player["rect"].centerx - target["rect"].centerx
-                                dy = player["rect"].centery - target["rect"].centery
-                                dist = (dx**2 + dy**2) ** 0.5
-
-                                # 連射モード倍率
-                                cool_multiplier = 1.0
-
-                                # Sniperのover_heat
-                                if player["job"] == "Sniper":
-                                    buff = player["job_skill"].get("over_heat", {})
-                                    if buff.get("buffed", False) and current_time < buff.get("end_time", 0):
-                                        cool_multiplier = buff.get("multipliers", {}).get("attack_cooldown", 1.0)
-
-                                # Berserkerのboost
-                                if player["job"] == "Berserker":
-                                    boost = player["job_skill"].get("boost", {})
-                                    if boost.get("buffed", False) and current_time < boost.get("end_time", 0):
-                                        cool_multiplier = boost.get("multipliers", {}).get("attack_cooldown", 1.0)
-
-                                # 攻撃アニメ
-                                if player["animation_state"] != "attack1":
-                                    player["animation_state"] = "attack1"
-                                    player["animations"]["attack1"].index = 0
-
-                                if player["animation_state"].startswith("attack"):
-                                    animation = player["animations"]["attack1"]
-                                    if animation.index >= animation.num_frames - 1:
-                                        player["animation_state"] = "idle"
-                                        animation.index = 0
-
-                                # 距離判定
-                                if player["job"] == "Sniper":
-                                    # マウス座標を取得
-                                    mx, my = player.get("mouse_pos", (0, 0))  # プレイヤーの送信データにマウス座標が含まれている前提
-
-                                    # ターゲットのスクリーン座標を計算
-                                    target_rect = target["rect"]
-                                    screen_x = target_rect.x - offset_x
-                                    screen_y = target_rect.y - offset_y
-
-                                    # マウスがターゲットの当たり判定に入っているか
-                                    if pygame.Rect(screen_x, screen_y, target_rect.width, target_rect.height).collidepoint(mx, my):
-                                        abnormal_condition(target, target_id, player, player_id)
-                                        send_skill_effect("normal_slash", target["rect"].centerx, target["rect"].centery)
-
-                                elif dist <= 50:
-                                    abnormal_condition(target, target_id, player, player_id)
-                                    send_skill_effect("normal_slash", target["rect"].centerx, target["rect"].centery)
-
-                                player["attack_cooldown"] = max(int(30 * cool_multiplier), 1)  # 0防止
-
-                                # 死亡処理
-                                if target["hp"] <= 0:
-                                    target["animation_state"] = "dead"
-                                    target["animations"]["dead"].index = 0
-                                    target["alive"] = False
-                                    target["hp"] = 0
-                                    #target["rect"].x, target["rect"].y = 1000000, 1000000
-                                    print(f"Player {target_id} died")
-                    if player["attack_cooldown"] > 0:
-                        player["attack_cooldown"] -= 1
-                if player["attack_cooldown"] > 0:
-                    player["attack_cooldown"] -= 1
-                # --- シールド処理 ---
-                if keys[5]:
-                    if not player["ShieldRecovering"] and player["ShieldGage"] >= SHIELD_COST:
-                        player["isShield"] = True
-                        player["ShieldGage"] -= SHIELD_COST
-                        print(f"Player {player_id} activated shield")
-                        if player["animation_state"] != "shield":
-                            player["animation_state"] = "shield"
-                            player["animations"]["shield"].index = 0
-                        
-                        if player["ShieldGage"] <= 0:
-                            player["ShieldRecovering"] = True
-                    else:
-                        player["isShield"] = False
+    for pid, pdata in players.items():
+        if pdata.debuff_effects:
+            new_effects = []
+            for effect in pdata.debuff_effects:
+                if current_time >= effect["end_time"]:
+                    for stat in effect["multipliers"]:
+                        original_key = "original_" + stat
+                        if original_key in pdata.debuff_data:
+                            setattr(pdata, stat, pdata.debuff_data.pop(original_key))
+                            print(f"Player {pid} {stat} debuff ended and restored to: {getattr(pdata, stat)}")
                 else:
-                    player["isShield"] = False
-                    
-                # --- ジャンプスキル ---
-                if keys[6]:
-                    skill = player["common"]["jump_skill"]
-                    if not skill["active"] and skill["cooldown"] <= 0:
-                        skill["active"] = True
-                        skill["end_time"] = current_time + 5  # 効果5秒間
-                        skill["cooldown"] = 1200  #1000m/s = 60(1秒で60)      つまり20秒
-                        print(f"Player {player_id} activated jump skill!")
-                # --- スタンスキル ---
-                if keys[7]:
-                    skill = player["common"]["stun"]
-                    if not skill["active"] and skill["cooldown"] <= 0:
-                        skill["active"] = True
-                        skill["end_time"] = current_time + 3
-                        skill["cooldown"] = 900
-                        print(f"Player {player_id} activated stun skill")
-                        stun_range = 100
-                        px, py = player["rect"].center
-                        for target_id, target in players.items():
-                            if target_id != player_id and target["alive"]:
-                                tx, ty = target["rect"].center
-                                dist = ((px - tx)**2 + (py - ty)**2)**0.5
-                                if dist <= stun_range:
-                                    target["common"]["stun"]["stuned"] = True
-                                    send_skill_effect("stun", target["rect"].centerx, target["rect"].centery)
-                                    target["common"]["stun"]["end_time"] = current_time + 3
-                                    print(f"Player {target_id} stunned by player {player_id}!")
-                                    
-                if player["common"]["stun"]["stuned"]:
-                    for target_id, target in players.items():
-                        stun_skill = target["common"]["stun"]
-                        if stun_skill.get("stuned", False):  # stunedがTrueなら
-                            if current_time >= stun_skill["end_time"]:
-                                stun_skill["stuned"] = False
-                                print(f"Player {target_id} is stuned")
-                                
-                # --- 回復スキル1 ---     
-                if keys[8]:
-                    if player["job"] == "Player":
-                        skill = player["job_skill"]["heal"]
-                        if not skill["active"] and skill["cooldown"] <= 0:  #healのクールタイムとか定義
-                            skill["active"] = True
-                            skill["end_time"] = current_time + skill["next_time"]    #0.1秒ごとに回復する
-                            skill["cooldown"] = 30
-                            print(f"Player {player_id} activated heal skill")
-                        elif skill["healed"] and skill["active"]:
-                            skill["healed"] = False
-                            
-                        if skill["active"]:     #ここで実行処理
-                            if not skill["healed"]:
-                                player["hp"] += math.floor(random.random() * skill["amount"]) + 100
-                                skill["healed"] = True
-                            if player["hp"] > player["maxHp"]:
-                                player["hp"] = player["maxHp"]
-                    else:
-                        pass
-                # --- 回復スキル2 ---     
-                if player["job"] == "Wizard":
-                    skill = player["job_skill"]["heal"]
-                    if not skill["active"] and skill["cooldown"] <= 0:  #healのクールタイムとか定義
-                        skill["active"] = True
-                        skill["cooldown"] = 30
-                        print(f"Player {player_id} activated heal skill")
-                        
-                    if skill["active"]:     #ここで実行処理
-                        if not skill["healed"]:
-                            player["hp"] += skill["amount"]
-                            skill["healed"] = True
-                        if player["hp"] > player["maxHp"]:
-                            player["hp"] = player["maxHp"]
+                    new_effects.append(effect)
+            pdata.debuff_effects = new_effects
+
+    for target_id, target in players.items():
+        for effect in ["poison", "burn", "regeneration"]:
+            status = target.job_skill.get(effect)
+            if status is not None and status.active:
+                if time.time() >= status.end_time:
+                    status.active = False
+                else:
+                    source_id = status.source_id  # 付与者ID
+                    if source_id is None:
+                        # source_id未設定なら自己消費としてtargetを使う（安全策）
+                        source_id = target_id
+                    source_player = players.get(source_id)
+                    if source_player is None:
+                        continue  # 付与者が居なければスキップ
+
+                    if source_player.ShieldGage > 5 and not source_player.ShieldRecovering:
+                        if effect == "poison":
+                            target.hp -= 2
+                        elif effect == "burn":
+                            target.hp -= 3
+                        elif effect == "regeneration":
+                            target.hp = min(target.hp + 5, target.maxHp)
+                        source_player.ShieldGage -= 5
+
+                        if target.hp <= 0:
+                            target.animation_state = "dead"
+                            target.animations["dead"].index = 0
+                            target.alive = False
+                            status.active = False
+                            target.hp = 0
+                            send_game_event(EVENT_DEATH, target_id)
+                            print(f"Player {target_id} died")
                     else:
-                        pass
-                    if skill["healed"] and skill["active"]:
-                        skill["healed"] = False
-                        skill["active"] = False
-
-
-                # --- Claymore罠の当たり判定 ---
-                for trap in traps[:]:
-                    if time.time() - trap["start_time"] > trap["duration"]:
-                        traps.remove(trap)
-                        continue
-                    for target_id, target in players.items():
-                        if target_id == trap["owner"] or not target["alive"]:
-                            continue
-                        dx = target["rect"].centerx - trap["x"]
-                        dy = target["rect"].centery - trap["y"]
-                        if dx**2 + dy**2 <= trap["radius"]**2:
-                            damage = trap["damage"] // 2 if target["isShield"] else trap["damage"]
-                            target["hp"] -= damage
-                            send_skill_effect("claymore_trap", trap["x"], trap["y"])
-                            traps.remove(trap)
-                            print(f"Player {target_id} triggered a claymore and took {damage} damage.")
-                            break
-
-                   
-
-                # --- 職業スキル1 ---
-                if keys[9]:     #attackSkill関数でまとめてる
-                    #60が1秒になる  重くなるから正確ではない
-                    if player["job"] == "Warrior":
-                        attackSkill(player, player_id, player["job_skill"]["wave_strike"], 1000)
-                    elif player["job"] == "Wizard":
-                        buffSkill(player, player["job_skill"]["strength_buff"], 1500, 5)                      
-                    elif player["job"] == "Assassin":
-                        attackSkill(player, player_id, player["job_skill"]["shadow_move"], 200)
-                    elif player["job"] == "Player":
-                        attackSkill(player, player_id, player["job_skill"]["create_isGod"], 0)
-                    elif player["job"] == "Sniper":
-                        attackSkill(player, player_id, player["job_skill"]["far_snipe"], 900)
-                    
-                        
-                # --- 職業スキル2 ---        
-                if keys[10]:
-                    if player["job"] == "Warrior":
-                        attackSkill(player, player_id, player["job_skill"]["chargeBoost"], 400)
-                    elif player["job"] == "Wizard":
-                        buffSkill(player, player["job_skill"]["resistance_buff"], 1200, 10)
-                    elif player["job"] == "Assassin":
-                        attackSkill(player, player_id, player["job_skill"]["criticalAttackMulti"], 400)
-                    elif player["job"] == "Sniper":
-                        TrapSkill(player, player_id, player["job_skill"]["claymore_trap"], 300)
-                    elif player["job"] == "Berserker":
-                        buffSkill(player, player["job_skill"]["boost"], 900, 20)
-                
-                # --- 職業スキル奥義 ---        
-                if keys[11]:
-                    if player["job"] == "Warrior":
-                        AttackSuper(player, player_id, player["job_skill"]["all_death_damage"], 1400)
-                    elif player["job"] == "Wizard":
-                        AttackSuper(player, player_id, player["job_skill"]["Element_aura"], 70)
-                    elif player["job"] == "Assassin":
-                        AttackSuper(player, player_id, player["job_skill"]["dummy"], 600)
-                    elif player["job"] == "Sniper":
-                        buffSkill(player, player["job_skill"]["over_heat"], 900, 5)
-                    elif player["job"] == "Berserker":
-                        buffSkill(player, player["job_skill"]["berserked"], 1200, 20)
-
-                # === Assassin：criticalAttackMulti（乱刀）の進行管理 ===
-                if player["job"] == "Assassin":
-                    rando = player["job_skill"].get("criticalAttackMulti", {})
-                    if rando.get("active"):
-                        tid = rando.get("target_id")
-                        target = players.get(tid)
-                        send_skill_effect("criticalAttackMulti", target["rect"].centerx, target["rect"].centery)
-                        # 対象が消えた/死亡なら中断
-                        if not target or not target["alive"] or target["hp"] <= 0:
-                            rando["active"] = False
-                        else:
-                            # 次ヒットの時間か？
-                            if time.time() >= rando.get("next_attack_time", 0) and rando.get("attack_remaining", 0) > 0:
-                                # 進行中に大きく離れたら中断（任意）
-                                dx_prog = abs(player["rect"].centerx - target["rect"].centerx)
-                                if dx_prog > 200:
-                                    rando["active"] = False
-                                else:
-                                    # 1ヒット分の与ダメ
-                                    dmg = rando.get("damaged", 500)
-                                    if target["isShield"]:
-                                        target["hp"] -= dmg / 2
-                                    else:
-                                        target["hp"] -= dmg
-
-                                    # ヒットごとにアニメを刻む（任意）
-                                    player["animation_state"] = "attack2"
-                                    player["animations"]["attack2"].index = 0
-
-                                    # 次回時刻・残回数更新
-                                    rando["attack_remaining"] -= 1
-                                    rando["next_attack_time"] = time.time() + rando.get("interval", 0.35)
-
-                                    # 死亡処理
-                                    if target["hp"] <= 0:
-                                        target["animation_state"] = "dead"
-                                        target["animations"]["dead"].index = 0
-                                        target["alive"] = False
-                                        target["hp"] = 0
-                                        rando["active"] = False
-
-                        # 全ヒット消化で終了
-                        if rando.get("attack_remaining", 0) <= 0:
-                            rando["active"] = False
-
-
-                if just_pressed_13:
-                    current = player["attack_status"]
-                    next_status = {"normal": "poison", "poison": "burn", "burn": "regeneration", "regeneration": "normal"}[current]
-                    player["attack_status"] = next_status
-                    print(f"Player {player_id} changed attack status to: {next_status}")
-
-                if just_pressed_14 and player["job"] == "Wizard":
-                    current = player.get("element_type", "fire")
-                    next_elements = {
-                        "fire": "water",
-                        "water": "ice",
-                        "ice": "lightning",
-                        "lightning": "wind",
-                        "wind": "earth",
-                        "earth": "nitro",
-                        "nitro": "heal",
-                        "heal": "fire",
-                    }
-                    player["element_type"] = next_elements.get(current, "fire")
-                    print(f"Player {player_id} (Wizard) changed element to: {player['element_type']}")
-
-
-            # クールダウン管理（共通・職業スキル）
-            for skill in player["common"].values():
-                if skill["cooldown"] > 0 and not skill["active"]:
-                    skill["cooldown"] -= 1
+                        source_player.ShieldRecovering = True
+                        status.active = False
+
+    if player.ShieldGage < SHIELD_GAGE:
+        player.ShieldGage += SHIELD_COST/2
+    if player.ShieldRecovering and player.ShieldGage >= 30:
+        player.ShieldRecovering = False
+        
             
-            for skill in player["job_skill"].values():
-                if skill["cooldown"] > 0 and not skill["active"]:
-                    skill["cooldown"] -= 1
-
-            # スキル効果終了
-            for skill_name, skill in player["common"].items():
-                if skill["active"] and current_time >= skill["end_time"]:
-                    skill["active"] = False
-
-            update_buff_effects(player)
-
-
-
-            for pid, pdata in players.items():
-                if "debuff_effects" in pdata:
-                    new_effects = []
-                    for effect in pdata["debuff_effects"]:
-                        if current_time >= effect["end_time"]:
-                            for stat in effect["multipliers"]:
-                                original_key = "original_" + stat
-                                if "debuff_data" in pdata and original_key in pdata["debuff_data"]:
-                                    pdata[stat] = pdata["debuff_data"][original_key]
-                                    del pdata["debuff_data"][original_key]
-                                    print(f"Player {pid} {stat} debuff ended and restored to: {pdata[stat]}")
-                        else:
-                            new_effects.append(effect)
-                    pdata["debuff_effects"] = new_effects
+    # --- 重力処理 ---
+    # --- ジャンプスキルを考慮した重力処理 ---
+    jump_skill = player.common["jump_skill"]
+    if jump_skill.active and current_time <= jump_skill.end_time:
+        gravity_force = GRAVITY * 0.3  # 軽くする
+    else:
+        gravity_force = GRAVITY
+        jump_skill.active = False  # 時間切れでOFF
+
+    fall(player, gravity_force)
+  
+    handle_map_collision(player)        #位置入れ替えたら治った笑
+    handle_collision(player_id)         #位置入れ替えたら治った笑
+
+
+def create_player(player_id, job):
+    stats = job_data.get(job, job_data["Player"])
 
-            for target_id, target in players.items():
-                for effect in ["poison", "burn", "regeneration"]:
-                    status = target["job_skill"].get(effect, {})
-                    if status.get("active", False):
-                        if time.time() >= status.get("end_time", 0):
-                            status["active"] = False
-                        else:
-                            source_id = status.get("source_id")  # 付与者ID
-                            if source_id is None:
-                                # source_id未設定なら自己消費としてtargetを使う（安全策）
-                                source_id = target_id
-                            source_player = players.get(source_id)
-                            if source_player is None:
-                                continue  # 付与者が居なければスキップ
-
-                            if source_player["ShieldGage"] > 5 and not source_player["ShieldRecovering"]:
-                                if effect == "poison":
-                                    target["hp"] -= 2
-                                elif effect == "burn":
-                                    target["hp"] -= 3
-                                elif effect == "regeneration":
-                                    target["hp"] = min(target["hp"] + 5, target["maxHp"])
-                                source_player["ShieldGage"] -= 5
-
-                                if target["hp"] <= 0:
-                                    target["animation_state"] = "dead"
-                                    target["animations"]["dead"].index = 0
-                                    target["alive"] = False
-                                    status["active"] = False
-                                    target["hp"] = 0
-                                    print(f"Player {target_id} died")
-                            else:
-                                source_player["ShieldRecovering"] = True
-                                status["active"] = False
+    player_x, player_y = 100 + player_id * 100, HEIGHT - player_size[1] - 150
 
-            if player["ShieldGage"] < SHIELD_GAGE:
-                player["ShieldGage"] += SHIELD_COST/2
-            if player["ShieldRecovering"] and player["ShieldGage"] >= 30:
-                player["ShieldRecovering"] = False
-                
-                    
-            # --- 重力処理 ---
-            # --- ジャンプスキルを考慮した重力処理 ---
-            if player["common"]["jump_skill"]["active"] and current_time <= player["common"]["jump_skill"]["end_time"]:
-                gravity_force = GRAVITY * 0.3  # 軽くする
-            else:
-                gravity_force = GRAVITY
-                player["common"]["jump_skill"]["active"] = False  # 時間切れでOFF
-
-            player["vel_y"] += gravity_force
-            player["rect"].y += player["vel_y"]
-
-
-            if player["rect"].bottom >= HEIGHT - 150:
-                player["rect"].bottom = HEIGHT - 150
-                player["vel_y"] = 0
-                player["on_ground"] = True
-          
-            handle_map_collision(player)        #位置入れ替えたら治った笑
-            handle_collision(player_id)         #位置入れ替えたら治った笑
-
-            # ゲーム状態送信（軽量化）
-            game_state = {}
-            for pid, pdata in players.items():
-                game_state[pid] = {
-                    "x": pdata["rect"].x,
-                    "y": pdata["rect"].y,
-                    "job": pdata["job"],
-                    "hp": pdata["hp"],
-                    "maxHp": pdata["maxHp"],
-                    "defense": pdata["defense"],
-                    "alive": pdata["alive"],
-                    "isShield": pdata["isShield"],
-                    "ShieldGage": pdata["ShieldGage"],
-                    "ShieldRecovering": pdata["ShieldRecovering"],
-                    "animation_state": pdata["animation_state"],
-                    "animation_index": pdata["animations"][pdata["animation_state"]].index,
-                    "facing_right": pdata["facing_right"],
-                    "attack_status": pdata.get("attack_status", "normal"),
-                    "element_type": pdata.get("element_type", "fire"),
-
-                    "skills": {
-                        "common": {
-                            name: {
-                                "active": s["active"],
-                                "cooldown": s["cooldown"]
-                            } for name, s in pdata["common"].items()
-                        },
-                        "job": {
-                            name: {
-                                "active": s["active"],
-                                "cooldown": s["cooldown"]
-                            } for name, s in pdata["job_skill"].items()
-                            if name in job_data[pdata["job"]]["skills"]  # ✅ 本来のスキルだけ送る
-                        }
-                    },
-                    "mouse_pos": pdata["mouse_pos"],
-                }
-            # skill_effects を送信データに含める
-            game_state["skill_effects"] = [
-
-                e for e in skill_effects if time.time() - e["start"] < e["duration"]
-            ]
-            visible_traps = [
-                {"x": t["x"], "y": t["y"], "radius": t["radius"]}
-                for t in traps if t["owner"] == player_id
-            ]
-            game_state["traps"] = visible_traps
+    return Player(
+        id=player_id,
+        job=job,
+        rect=pygame.Rect(player_x, player_y, *player_size),
+        hp=stats["hp"],
+        maxHp=stats["hp"],
+        defense=stats["defense"],
+        damaged=stats["damaged"],
+        animations=create_animations(),
+        common={"jump_skill": SkillState("jump_skill"), "stun": SkillState("stun")},
+        job_skill=skills_from_data(stats["skills"]),
+        ShieldGage=SHIELD_GAGE,
+    )
+
+
+def new_session(conn, token):
+    return {
+        "conn": conn,
+        "token": token,   # 再接続したときに同じプレイヤーに戻るための合言葉（観戦者・観測者はNone）
+        "observer": False,   # 観測者（debug_viewer.py）は全員・全部の罠とデバッグ情報を受け取る
+        "inputs": deque(),
+        "previous_mask": 0,   # 前回のキー状態（長押し検出防止用）
+        "mouse_pos": (0, 0),
+        "view_time": 0.0,
+        "last_input_seq": 0,  # 受け取った最新の入力番号
+        "applied_input_seq": 0,  # シミュレーションに反映済みの入力番号
+        "acked_seq": 0,
+        "history": SnapshotHistory(SNAPSHOT_HISTORY),   # tick → そのとき送ったrecords
+        "last_view": {},
+        # 接続前のエフェクト・出来事は送らない
+        "effect_cursor": skill_effects.last_id,
+        "event_cursor": game_events.last_id,
+    }
 
 
+def resume_player(token, conn):
+    # 再開の合言葉に対応するプレイヤーを新しい接続に付け替える。できなければNone（world_lockの中で呼ぶ）
+    player_id = session_tokens.get(token)
+    if player_id is None:
+        return None
+    if player_id in suspended:
+        players[player_id] = suspended.pop(player_id)[0]
+    elif player_id in sessions:
+        # 古い接続が切れたことにサーバがまだ気づいていない。古い方を閉じて引き継ぐ
+        sessions[player_id]["conn"].close()
+    else:
+        return None
+    sessions[player_id] = new_session(conn, token)
+    return player_id
+
 
-            client_socket.send(pickle.dumps(game_state))
-            previous_keys = keys[:] 
-    except ConnectionResetError:
+def observer_allowed(key, client_address):
+    # 鍵を決めていなければ同じマシンからの接続だけ、決めていれば鍵が合う接続だけを観測者にする
+    if OBSERVER_KEY is None:
+        return ipaddress.ip_address(client_address[0]).is_loopback
+    return hmac.compare_digest(key.encode("utf-8"), OBSERVER_KEY.encode("utf-8"))
+
+
+def expire_suspended(now):
+    # 猶予が過ぎても戻ってこなかったプレイヤーを消す（world_lockの中で呼ぶ）
+    for player_id, (player, token, expires_at) in list(suspended.items()):
+        if now >= expires_at:
+            del suspended[player_id]
+            session_tokens.pop(token, None)
+            print(f"Player {player_id} did not come back; removed.")
+
+
+async def handle_client(conn, client_address):
+    # 接続ごとに1つのタスク。受け取った入力をキューに積むだけで、シミュレーションと送信はtickスレッドが行う
+    player_id = next(player_ids)
+    print(f"Player {player_id} connected from {client_address}")
+    session = None
+    resumable = True
+    try:
+        conn.send_object(MSG_PLAYER_ID, player_id)
+        conn.send(MSG_MAP, map_bundle.manifest)
+        # 職業が決まるまでに、クライアントはキャッシュにないマップのファイルを要求してくる
+        # UDPでは再送待ちのMSG_JOBより先に入力や時計合わせが届くことがあるので、それまでのものは捨てる
+        # 再接続したクライアントは職業の代わりに再開の合言葉を送ってくる（職業選択・マップの読み込みを飛ばす）
+        while session is None:
+            message = await conn.recv_message()
+            if message is not None and message[0] in (MSG_INPUT, MSG_PING):
+                continue
+            if message is not None and message[0] == MSG_MAP_REQUEST:
+                conn.send(MSG_MAP_CHUNK, map_bundle.chunk(message[1]))
+                continue
+            if message is not None and message[0] == MSG_RESUME:
+                if len(message[1]) != SESSION_TOKEN_SIZE:
+                    raise ProtocolError(f"bad session token size: {len(message[1])}")
+                with world_lock:
+                    resumed_id = resume_player(message[1], conn)
+                    if resumed_id is not None:
+                        session = sessions[resumed_id]
+                if resumed_id is None:
+                    conn.send(MSG_RESUME, b"")   # 期限切れ。クライアントは職業を選び直す
+                    continue
+                print(f"Player {player_id} resumed as player {resumed_id}")
+                player_id = resumed_id
+                conn.send(MSG_RESUME, PLAYER_ID.pack(player_id))
+                break
+            if message is not None and message[0] == MSG_OBSERVE:
+                if not observer_allowed(unpack_object(message, MSG_OBSERVE), client_address):
+                    raise ProtocolError("observer not allowed")
+                print(f"Player {player_id} is observing")
+                session = new_session(conn, None)
+                session["observer"] = True
+                with world_lock:
+                    sessions[player_id] = session
+                break
+            job = unpack_object(message, MSG_JOB)
+            if job not in job_data and job != SPECTATOR_JOB:
+                raise ProtocolError(f"unknown job {job!r}")
+            print(f"Player {player_id} selected job: {job}")
+            # 観戦者はプレイヤーを持たず、スナップショットを受け取るだけ
+            player = create_player(player_id, job) if job != SPECTATOR_JOB else None
+            token = secrets.token_bytes(SESSION_TOKEN_SIZE) if player is not None else None
+            session = new_session(conn, token)
+            with world_lock:
+                if player is not None:
+                    players[player_id] = player
+                    session_tokens[token] = player_id
+                sessions[player_id] = session
+            if token is not None:
+                conn.send(MSG_SESSION, token)
+        while True:
+            message = await conn.recv_message()
+            if message is None:
+                break
+            msg_type, payload = message
+            if msg_type == MSG_PING:
+                # 受け取ってすぐ返すので、受け取った時刻と返す時刻はほぼ同じ
+                conn.send(MSG_PONG, answer_ping(payload, time.time()))
+                continue
+            if msg_type != MSG_INPUT:
+                continue
+            input_seq, key_mask, mouse_pos, acked_seq, view_delay = decode_input(payload)
+            # ここで書き換えるのはこの接続だけの値で、dequeのappendはスレッドセーフなので
+            # tickの処理中でもロックを待たずに受信を続けられる
+            session["acked_seq"] = max(session["acked_seq"], acked_seq)
+            if input_seq <= session["last_input_seq"]:
+                continue  # 古い入力・重複は捨てる
+            session["last_input_seq"] = input_seq
+            session["inputs"].append((input_seq, key_mask, mouse_pos, acked_seq, view_delay))
+    except ConnectionError:
         print(f"Player {player_id} disconnected unexpectedly.")
+    except ProtocolError as e:
+        print(f"Player {player_id} sent a malformed message: {e}")
+        resumable = False
     finally:
-        if player_id in players:
-            del players[player_id]
-        client_socket.close()
-        print(f"Player {player_id} disconnected.")
+        # 切断・エラー・サーバ終了のどれでも必ずここで片付ける
+        # プレイヤーはすぐには消さず、猶予の間は止めたまま取っておく（再接続したら続きから）
+        suspended_for = None
+        with world_lock:
+            # 再開で別の接続に引き継がれていれば、プレイヤーはもうこの接続のものではない
+            if session is not None and sessions.get(player_id) is session:
+                del sessions[player_id]
+                player = players.pop(player_id, None)
+                if player is not None and resumable:
+                    suspended[player_id] = (player, session["token"], time.time() + RESUME_GRACE)
+                    suspended_for = RESUME_GRACE
+                else:
+                    session_tokens.pop(session["token"], None)
+        conn.close()
+        print(f"Player {player_id} disconnected. "
+              f"(snapshots coalesced: {conn.coalesced}, messages dropped: {conn.dropped})"
+              + (f" Kept for {suspended_for:g} s." if suspended_for else ""))
+
+
+def apply_inputs(player_id, session):
+    # 1tickにつき入力を1つ使う。溜まりすぎた分は古い方から捨てる
+    inputs = session["inputs"]
+    while len(inputs) > MAX_INPUT_BACKLOG:
+        inputs.popleft()
+    if inputs:
+        input_seq, key_mask, mouse_pos, acked_seq, view_delay = inputs.popleft()
+        session["applied_input_seq"] = input_seq
+        session["mouse_pos"] = mouse_pos
+        session["view_time"] = view_time_of(acked_seq, view_delay)
+    else:
+        key_mask = session["previous_mask"]  # 入力が届いていないtickは押しっぱなし扱い
+    just_pressed = key_mask & ~session["previous_mask"]
+    session["previous_mask"] = key_mask
+    step_player(player_id, mask_to_keys(key_mask), just_pressed, session["mouse_pos"], session["view_time"])
+
+
+# --- ラグ補正 ---
+# クライアントは他プレイヤーを少し前の時刻で描いているので、狙って撃った時点の位置で当たり判定をする。
+# 巻き戻すのはMAX_REWIND秒まで（それより古い画面を見ている人は、その分だけ不利になる）
+def view_time_of(acked_seq, view_delay):
+    # 受信済みスナップショットの時刻から、クライアントが描いていた時刻（サーバ時刻）を求める
+    for tick, server_time, _ in reversed(rect_history):
+        if tick <= acked_seq:
+            return server_time - view_delay
+    return 0.0  # 履歴より古い → 巻き戻せる限界まで
+
+
+def rewound_rect(target_id, shooter):
+    # shooterの画面に映っていた時点のtargetの当たり判定（前後のtickの間は線形補間）
+    current = players[target_id].rect
+    view_time = max(shooter.view_time, time.time() - MAX_REWIND)
+    newer = None
+    for _, server_time, rects in reversed(rect_history):
+        rect = rects.get(target_id)
+        if rect is None:
+            break
+        if server_time <= view_time:
+            if newer is None:
+                return current
+            newer_time, newer_rect = newer
+            f = (view_time - server_time) / (newer_time - server_time)
+            return pygame.Rect(
+                round(rect.x + (newer_rect.x - rect.x) * f),
+                round(rect.y + (newer_rect.y - rect.y) * f),
+                rect.width, rect.height,
+            )
+        newer = (server_time, rect)
+    return newer[1] if newer else current
+
+
+def camera_rect(rect):
+    # クライアントと同じ計算で、そのプレイヤーの画面に映る範囲を求める
+    offset_x = rect.x - WIDTH // 2 + player_size[0] // 2
+    offset_y = rect.y - HEIGHT // 2 + player_size[1] // 2
+    max_offset_x = game_map.width * game_map.tile_width - WIDTH
+    max_offset_y = game_map.height * game_map.tile_height - HEIGHT
+    offset_x = max(0, min(offset_x, max_offset_x))
+    offset_y = max(0, min(offset_y, max_offset_y))
+    return pygame.Rect(offset_x, offset_y, WIDTH, HEIGHT)
+
+
+def interest_view(tick, viewer_id, session, records, camera):
+    # 画面＋余白の中は毎tick、その外側はFAR_UPDATE_INTERVALごと、さらに遠くは送らない
+    near = camera.inflate(VIEW_MARGIN * 2, VIEW_MARGIN * 2)
+    far = camera.inflate(FAR_MARGIN * 2, FAR_MARGIN * 2)
+    last_view = session["last_view"]
+    view = {}
+    for pid, pdata in players.items():
+        center = pdata.rect.center
+        if pid == viewer_id or near.collidepoint(center):   # 自分は画面の外（マップの外）にいても必ず送る
+            view[pid] = records[pid]
+        elif far.collidepoint(center):
+            if pid in last_view and (tick + pid) % FAR_UPDATE_INTERVAL:
+                view[pid] = last_view[pid]  # 今回は更新しない（前に送った値のまま）
+            else:
+                view[pid] = records[pid]
+    if len(view) == len(records) and all(view[pid] is record for pid, record in records.items()):
+        return records  # 全員が近くにいるなら他の人と同じものを使い回せる
+    return view
+
+
+def broadcast(tick, server_time, tick_ms):
+    # 全員が見えている人どうしは、共通の部分を1tickに1回だけ作って同じバイト列を送る
+    records = {}
+    for pid, pdata in players.items():
+        record = player_record(pdata)
+        previous = last_records.get(pid)
+        records[pid] = previous if record == previous else record
+    last_records.clear()
+    last_records.update(records)
+    deltas = {}          # このtickで作った差分（基準とrecordが同じなら送り先が違っても使い回す）
+    world_payloads = {}  # 基準にしたrecords → 共通の部分（基準が同じ人どうしで使い回す）
+    buffers = []         # このtickで借りたSendBuffer（送り終わったらプールに戻る）
+    skill_effects.expire(server_time)
+    effect_payloads = {}  # 送るエフェクトのid → 送るバイト列
+    event_payloads = {}
+    debug_payload = None   # 観測者が何人いても1tickに1回だけ作る
+    for player_id, session in list(sessions.items()):
+        conn = session["conn"]
+        player = players.get(player_id)
+        camera = camera_rect(player.rect) if player else None  # 観戦者は全体を受け取る
+        near = camera.inflate(VIEW_MARGIN * 2, VIEW_MARGIN * 2) if camera else None
+        try:
+            # 新しいエフェクト・出来事は一度だけ送る（UDPのときは再送付きのチャネル）
+            new_effects = skill_effects.since(session["effect_cursor"])
+            if new_effects:
+                session["effect_cursor"] = new_effects[-1]["id"]
+                if near:
+                    new_effects = [e for e in new_effects if near.collidepoint(e["x"], e["y"])]
+            if new_effects:
+                key = tuple(e["id"] for e in new_effects)
+                if key not in effect_payloads:
+                    effect_payloads[key] = encode_effects(
+                        (e["type"], e["x"], e["y"], e["start"], e["duration"]) for e in new_effects
+                    )
+                conn.send(MSG_EFFECTS, effect_payloads[key])
+            if game_events.missed(session["event_cursor"]):
+                # 送る前に消えた死亡・復活がある。基準なしの全体のスナップショットを送って状態を合わせ直す
+                print(f"Player {player_id} missed game events after #{session['event_cursor']}; resending the full state.")
+                session["history"] = SnapshotHistory(SNAPSHOT_HISTORY)
+            for event in game_events.since(session["event_cursor"]):
+                session["event_cursor"] = event["id"]
+                if event["id"] not in event_payloads:
+                    event_payloads[event["id"]] = encode_event(event["kind"], event["player_id"])
+                conn.send(MSG_EVENT, event_payloads[event["id"]])
+
+            # クライアントが受け取り済みのスナップショットとの差分だけ送る
+            history = session["history"]
+            baseline_seq = session["acked_seq"]
+            baseline = history.get(baseline_seq)
+            if baseline is None:
+                baseline_seq = 0
+            view = interest_view(tick, player_id, session, records, camera) if camera else records
+            world_payload = world_payloads.get(id(baseline)) if view is records else None
+            if world_payload is None:
+                world_payload = send_buffers.acquire()
+                buffers.append(world_payload)
+                world_payload.length = write_world(
+                    world_payload.data, tick, view, baseline_seq, baseline, server_time, deltas
+                )
+                if view is records:
+                    world_payloads[id(baseline)] = world_payload
+            visible_traps = [
+                (t["x"], t["y"], t["radius"])
+                for t in traps
+                if session["observer"] or t["owner"] == player_id and (near is None or near.collidepoint(t["x"], t["y"]))
+            ]
+            client_part = send_buffers.acquire()
+            buffers.append(client_part)
+            client_part.length = write_client_part(
+                client_part.data, session["applied_input_seq"], visible_traps,
+                player.vel_y if player else 0.0, player.on_ground if player else True,
+            )
+            # 共通部分と送り先ごとの部分はつなげずにそのまま渡す（送信側でsendmsgにまとめる）
+            conn.send_parts(MSG_STATE, [world_payload, client_part])
+            history.add(tick, view)
+            session["last_view"] = view
+            if session["observer"]:
+                if debug_payload is None:
+                    debug_payload = encode_debug(
+                        tick_ms,
+                        [(pid, p.rect, p.vel_y, p.on_ground) for pid, p in players.items()],
+                        [(t["x"], t["y"], t["radius"], t["owner"]) for t in traps],
+                    )
+                conn.send(MSG_DEBUG, debug_payload)
+        except (ConnectionError, OSError):
+            pass  # 切断はI/Oスレッド側で片付ける
+    release_parts(buffers)
+
+
+def game_loop():
+    # 固定レートのtick: 入力を反映 → 全員を1回ずつ進める → 全員に送信
+    interval = 1.0 / TICK_RATE
+    tick = 0
+    tick_ms = 0.0   # 前のtickの処理にかかった時間（観測者に送る）
+    next_tick = time.perf_counter()
+    while True:
+        next_tick += interval
+        with world_lock:
+            tick_started = time.perf_counter()
+            tick += 1
+            for player_id, session in list(sessions.items()):
+                if player_id in players:
+                    try:
+                        apply_inputs(player_id, session)
+                    except Exception:
+                        # 1人の処理で例外が出てもtickスレッドごと止めない。その人だけ切断する
+                        traceback.print_exc()
+                        sessions.pop(player_id, None)
+                        players.pop(player_id, None)
+                        session_tokens.pop(session["token"], None)
+                        session["conn"].close()
+                else:
+                    session["inputs"].clear()   # 観戦者・観測者の入力は受信済みの番号を伝えるためだけのもの
+            if HEADLESS:
+                # 描画ループがないので、スナップショットで送るアニメーションのコマはここで進める
+                for pdata in players.values():
+                    if pdata.alive:
+                        pdata.animations.get(pdata.animation_state, pdata.animations["idle"]).advance()
+            server_time = time.time()
+            if suspended:
+                expire_suspended(server_time)
+            broadcast(tick, server_time, tick_ms)
+            rect_history.append((tick, server_time, {pid: pdata.rect.copy() for pid, pdata in players.items()}))
+            tick_ms = (time.perf_counter() - tick_started) * 1000
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -interval * MAX_TICK_CATCHUP:
+            next_tick = time.perf_counter()  # 大きく遅れたら追いつこうとせず仕切り直す
 
 
 def calculate_damage_with_shield(raw_damage, target, multiplier=1.0, ignore_defense=False, min_ratio=0.1):
@@ -1003,7 +1315,7 @@ def calculate_damage_with_shield(raw_damage, target, multiplier=1.0, ignore_defe
     # 2. 防御計算
     if not ignore_defense:
         def_mult = get_defense_multiplier(target)
-        defense_mul = 100 / (100 + target["defense"] * def_mult)
+        defense_mul = 100 / (100 + target.defense * def_mult)
         defense_mul = max(defense_mul, min_ratio)
         damage *= defense_mul
 
@@ -1011,17 +1323,17 @@ def calculate_damage_with_shield(raw_damage, target, multiplier=1.0, ignore_defe
     damage = max(damage, 1.0)
 
     # 4. シールド処理
-    if target.get("isShield") and target.get("ShieldGage", 0) > 0:
-        absorb_ratio = target.get("shield_absorb_ratio", 0.5)
+    if target.isShield and target.ShieldGage > 0:
+        absorb_ratio = target.shield_absorb_ratio
         absorb = damage * absorb_ratio
         hp_damage = damage - absorb
 
-        # ShieldGage 減少と状態変化
-        target["ShieldGage"] -= absorb
-        if target["ShieldGage"] <= 0:
-            target["ShieldGage"] = 0
-            target["isShield"] = False
-            target["ShieldRecovering"] = True
+        # シールドゲージ減少と状態変化
+        target.ShieldGage -= absorb
+        if target.ShieldGage <= 0:
+            target.ShieldGage = 0
+            target.isShield = False
+            target.ShieldRecovering = True
 
         return max(1, int(math.floor(hp_damage)))
 
@@ -1029,16 +1341,9 @@ def calculate_damage_with_shield(raw_damage, target, multiplier=1.0, ignore_defe
 
 
 def get_damage_multiplier(player):
+    # バフの倍率は update_buffed_stats で player.damaged に掛けてあるので、ここではデバフだけ
     multiplier = 1.0
-
-    # バフ
-    for skill in player["job_skill"].values():
-        if skill.get("buffed"):
-            mults = skill.get("applied_multipliers", {})
-            multiplier *= mults.get("damaged", 1.0)
-
-    # デバフ
-    for debuff in player.get("debuff_effects", []):
+    for debuff in player.debuff_effects:
         if time.time() <= debuff["end_time"]:
             mults = debuff.get("multipliers", {})
             multiplier *= mults.get("damaged", 1.0)
@@ -1048,55 +1353,56 @@ def get_damage_multiplier(player):
 
 def get_defense_multiplier(player):
     multiplier = 1.0
-    for debuff in player.get("debuff_effects", []):
+    for debuff in player.debuff_effects:
         if time.time() <= debuff["end_time"]:
             multiplier *= debuff["multipliers"].get("defense", 1.0)
     return multiplier
 
 
 def handle_death(p):
-    if p["hp"] <= 0:
-        p["animation_state"] = "dead"
-        p["animations"]["dead"].index = 0
-        p["alive"] = False
-        p["hp"] = 0
+    if p.hp <= 0:
+        if p.alive:
+            send_game_event(EVENT_DEATH, p.id)
+        p.animation_state = "dead"
+        p.animations["dead"].index = 0
+        p.alive = False
+        p.hp = 0
 
 
 def update_buff_effects(player):
     current_time = time.time()
-    effects = player.get("buffed_effects", [])
+    effects = player.buffed_effects
     new_effects = []
 
     for effect in effects:
         if current_time < effect["end_time"]:
             new_effects.append(effect)
         else:
-            print(f"[BUFF END] {player['job']} {effect['multipliers']}")
+            print(f"[BUFF END] {player.job} {effect['multipliers']}")
             if "source" in effect:
-                effect["source"]["active"] = False
-                effect["source"]["buffed"] = False
+                effect["source"].active = False
+                effect["source"].buffed = False
 
     if len(effects) != len(new_effects):
-        player["buffed_effects"] = new_effects
+        player.buffed_effects = new_effects
         update_buffed_stats(player)
 
 
 def update_buffed_stats(player):
-    job_stats = job_data.get(player["job"], {})
+    job_stats = job_data.get(player.job, {})
     base_damaged = job_stats.get("damaged", 1)
     base_defense = job_stats.get("defense", 1)
-    base_attack_cooldown = job_stats.get("attack_cooldown", 1)
 
+    # attack_cooldown はパンチの処理が over_heat・boost から直接読む（奥義の over_heat は buffed_effects に入らない）
     total_multipliers = {"damaged": 1.0, "defense": 1.0, "attack_cooldown": 1.0}
-    for effect in player.get("buffed_effects", []):
+    for effect in player.buffed_effects:
         for stat, multiplier in effect.get("multipliers", {}).items():
             total_multipliers[stat] *= multiplier
 
-    player["damaged"] = int(base_damaged * total_multipliers["damaged"])
-    player["defense"] = int(base_defense * total_multipliers["defense"])
-    player["attack_cooldwon"] = int(base_attack_cooldown * total_multipliers["attack_cooldown"])
+    player.damaged = int(base_damaged * total_multipliers["damaged"])
+    player.defense = int(base_defense * total_multipliers["defense"])
 
-    print(f"[BUFF RECALC] {player['job']} damaged: {player['damaged']}, defense: {player['defense']}, attack_cooldown: {player['attack_cooldown']}")
+    print(f"[BUFF RECALC] {player.job} damaged: {player.damaged}, defense: {player.defense}")
 
 #奥義とかのスキル管理
 def AttackSuper(player, player_id, skill, cooltime):
@@ -1104,66 +1410,63 @@ def AttackSuper(player, player_id, skill, cooltime):
     multiplier = get_damage_multiplier(player)
 
     # Sniper専用処理：奥義時に連射モード開始
-    if player["job"] == "Sniper":
-        over_heat = player["job_skill"]["over_heat"]
-        if not over_heat["active"] and over_heat["cooldown"] <= 0:
-            over_heat.update({
-                "active": True,
-                "buffed": True,
-                "end_time": current_time + 5,
-                "cooldown": 0
-            })
+    if player.job == "Sniper":
+        over_heat = player.job_skill["over_heat"]
+        if not over_heat.active and over_heat.cooldown <= 0:
+            over_heat.active = True
+            over_heat.buffed = True
+            over_heat.end_time = current_time + 5
+            over_heat.cooldown = 0
             print(f"Player {player_id} activated over_heat!")
 
-    if skill["cooldown"] > 0:
+    if skill.cooldown > 0:
         return
 
     for target_id, target in players.items():
-        if target_id == player_id or not target["alive"]:
+        if target_id == player_id or not target.alive:
             continue
 
-        dx = player["rect"].centerx - target["rect"].centerx
-        dy = player["rect"].centery - target["rect"].centery
+        target_rect = rewound_rect(target_id, player)  # スキルを使った人に見えていた位置
+        dx = player.rect.centerx - target_rect.centerx
+        dy = player.rect.centery - target_rect.centery
         dist = (dx**2 + dy**2) ** 0.5
 
-        if player["job"] == "Warrior" and dist <= 500:
-            send_skill_effect("all_death_damage", target["rect"].centerx, target["rect"].centery)
-            send_skill_effect("all_death_damage", player["rect"].centerx, player["rect"].centery)
-            damage = calculate_damage_with_shield(skill["damaged"], target, multiplier=get_damage_multiplier(player))
-            target["hp"] -= damage
+        if player.job == "Warrior" and dist <= 500:
+            send_skill_effect("all_death_damage", target.rect.centerx, target.rect.centery)
+            send_skill_effect("all_death_damage", player.rect.centerx, player.rect.centery)
+            damage = calculate_damage_with_shield(skill.damaged, target, multiplier=get_damage_multiplier(player))
+            target.hp -= damage
 
-            self_damage = calculate_damage_with_shield(skill["damaged"] / 1.2, player, multiplier)
-            player["hp"] -= self_damage
+            self_damage = calculate_damage_with_shield(skill.damaged / 1.2, player, multiplier)
+            player.hp -= self_damage
             
 
-        elif player["job"] == "Assassin" and abs(dx) <= 75:
+        elif player.job == "Assassin" and abs(dx) <= 75:
             speed = job_data["Assassin"]["skills"]["dummy"]["speed"]
-            direction = 1 if player["rect"].x < target["rect"].x else -1
-            player["rect"].x += min(abs(dx), speed) * direction
-            damage = calculate_damage_with_shield(skill["damaged"], target, multiplier=get_damage_multiplier(player))
-            target["hp"] -= damage
+            direction = 1 if player.rect.x < target.rect.x else -1
+            player.rect.x += min(abs(dx), speed) * direction
+            damage = calculate_damage_with_shield(skill.damaged, target, multiplier=get_damage_multiplier(player))
+            target.hp -= damage
             
 
 
-        elif player["job"] == "Wizard" and abs(dx) <= 120:
-            damage = calculate_damage_with_shield(skill["damaged"], target, multiplier=get_damage_multiplier(player))
-            target["hp"] -= damage
-            apply_element_effect(player, target, skill)
+        elif player.job == "Wizard" and abs(dx) <= 120:
+            damage = calculate_damage_with_shield(skill.damaged, target, multiplier=get_damage_multiplier(player))
+            target.hp -= damage
+            apply_element_effect(player, player_id, target, skill)
             
 
-        elif player["job"] == "Sniper":
-            over_heat = player["job_skill"]["over_heat"]
-            if over_heat["active"] and current_time >= over_heat["end_time"]:
-                over_heat.update({
-                    "active": False,
-                    "buffed": False,
-                    "cooldown": max(cooltime, 900) * 2
-                })
-                print(f"Player {player_id} over_heat ended. Cooldown set to {over_heat['cooldown']}")
+        elif player.job == "Sniper":
+            over_heat = player.job_skill["over_heat"]
+            if over_heat.active and current_time >= over_heat.end_time:
+                over_heat.active = False
+                over_heat.buffed = False
+                over_heat.cooldown = max(cooltime, 900) * 2
+                print(f"Player {player_id} over_heat ended. Cooldown set to {over_heat.cooldown}")
 
 
-        skill["cooldown"] = cooltime
-        skill["active"] = False
+        skill.cooldown = cooltime
+        skill.active = False
         handle_death(target)
         handle_death(player)
 
@@ -1173,86 +1476,85 @@ def attackSkill(player, player_id, skill, cooltime):
     current_time = time.time()
     multiplier = get_damage_multiplier(player)
 
-    if skill["cooldown"] > 0:
+    if skill.cooldown > 0:
         return
 
     for target_id, target in players.items():
-        if target_id == player_id or not target["alive"]:
+        if target_id == player_id or not target.alive:
             continue
 
-        dx = player["rect"].centerx - target["rect"].centerx
-        dy = player["rect"].centery - target["rect"].centery
+        target_rect = rewound_rect(target_id, player)  # スキルを使った人に見えていた位置
+        dx = player.rect.centerx - target_rect.centerx
+        dy = player.rect.centery - target_rect.centery
         dist = (dx**2 + dy**2) ** 0.5
 
         # === Assassin ===
-        if player["job"] == "Assassin":
-            if skill == job_data["Assassin"]["skills"]["criticalAttackMulti"] and abs(dx) <= 100:
-                skill.update({
-                    "active": True,
-                    "target_id": target_id,
-                    "attack_remaining": skill.get("hits", 3),
-                    "interval": skill.get("interval", 0.35),
-                    "next_attack_time": time.time() + skill.get("interval", 0.35),
-                    "end_time": time.time() + skill.get("hits", 3) * skill.get("interval", 0.35) + 0.05,
-                    "cooldown": cooltime
-                })
-                player["common"]["stun"]["stuned"] = True
-                player["common"]["stun"]["end_time"] = skill["end_time"]
-                player["animation_state"] = "attack2"
-                player["animations"]["attack2"].index = 0
+        if player.job == "Assassin":
+            if skill.name == "criticalAttackMulti" and abs(dx) <= 100:
+                skill.active = True
+                skill.target_id = target_id
+                skill.attack_remaining = skill.hits
+                skill.next_attack_time = time.time() + skill.interval
+                skill.end_time = time.time() + skill.hits * skill.interval + 0.05
+                skill.cooldown = cooltime
+                player.common["stun"].stuned = True
+                player.common["stun"].end_time = skill.end_time
+                player.animation_state = "attack2"
+                player.animations["attack2"].index = 0
                 continue
 
-            elif skill == job_data["Assassin"]["skills"]["shadow_move"] and dist < 800:
-                send_skill_effect("shadow_move", player["rect"].centerx, player["rect"].centery)
-                damage = calculate_damage_with_shield(skill["damaged"], target, multiplier=get_damage_multiplier(player))
-                target["hp"] -= damage
+            elif skill.name == "shadow_move" and dist < 800:
+                send_skill_effect("shadow_move", player.rect.centerx, player.rect.centery)
+                damage = calculate_damage_with_shield(skill.damaged, target, multiplier=get_damage_multiplier(player))
+                target.hp -= damage
 
-                player["rect"].x, player["rect"].y = target["rect"].x, target["rect"].y
-                target["common"]["stun"].update({"stuned": True, "end_time": time.time() + 0.1})
+                player.rect.x, player.rect.y = target.rect.x, target.rect.y
+                target.common["stun"].stuned = True
+                target.common["stun"].end_time = time.time() + 0.1
                 continue
 
-        elif player["job"] == "Sniper" and abs(dx) <= 2000:
-            send_skill_effect("all_death_damage", target["rect"].centerx, target["rect"].centery)
-            damage = calculate_damage_with_shield(skill["damaged"], target, multiplier=get_damage_multiplier(player))
-            target["hp"] -= damage
+        elif player.job == "Sniper" and abs(dx) <= 2000:
+            send_skill_effect("all_death_damage", target.rect.centerx, target.rect.centery)
+            damage = calculate_damage_with_shield(skill.damaged, target, multiplier=get_damage_multiplier(player))
+            target.hp -= damage
 
             
 
-        elif player["job"] == "Warrior":
-            skill["active"] = True
-            if abs(dx) <= 400 and player["job_skill"]["chargeBoost"]["active"]:
-                speed = player["job_skill"]["chargeBoost"]["speed"]
-                direction = 1 if player["rect"].x < target["rect"].x else -1
-                player["rect"].x += min(abs(dx), speed) * direction
+        elif player.job == "Warrior":
+            skill.active = True
+            if abs(dx) <= 400 and player.job_skill["chargeBoost"].active:
+                speed = player.job_skill["chargeBoost"].speed
+                direction = 1 if player.rect.x < target.rect.x else -1
+                player.rect.x += min(abs(dx), speed) * direction
 
-                if abs(player["rect"].x - target["rect"].x) <= speed + 50:
-                    damage = calculate_damage_with_shield(skill["damaged"], target, multiplier=get_damage_multiplier(player))
-                    target["hp"] -= damage
+                if abs(player.rect.x - target.rect.x) <= speed + 50:
+                    damage = calculate_damage_with_shield(skill.damaged, target, multiplier=get_damage_multiplier(player))
+                    target.hp -= damage
 
-                    send_skill_effect("charge_boost", target["rect"].centerx, target["rect"].centery)
+                    send_skill_effect("charge_boost", target.rect.centerx, target.rect.centery)
                     
-                    player["job_skill"]["chargeBoost"]["active"] = False
+                    player.job_skill["chargeBoost"].active = False
             elif abs(dx) <= 200:
-                damage = calculate_damage_with_shield(skill["damaged"], target, multiplier=get_damage_multiplier(player))
-                target["hp"] -= damage
+                damage = calculate_damage_with_shield(skill.damaged, target, multiplier=get_damage_multiplier(player))
+                target.hp -= damage
 
-                send_skill_effect("wave_strike", target["rect"].centerx, target["rect"].centery)
+                send_skill_effect("wave_strike", target.rect.centerx, target.rect.centery)
                 
 
-        elif player["job"] == "Player" and dist <= 1000:
-            send_skill_effect("all_death_damage", target["rect"].centerx, target["rect"].centery)
+        elif player.job == "Player" and dist <= 1000:
+            send_skill_effect("all_death_damage", target.rect.centerx, target.rect.centery)
             skill_god = job_data["Player"]["skills"]["create_isGod"]
             skill_god["active"] = True
-            if target["hp"] + 50 < target["maxHp"]:
-                target["hp"] += 50
+            if target.hp + 50 < target.maxHp:
+                target.hp += 50
             else:
-                target["hp"] = target["maxHp"]
-            player["rect"].x, player["rect"].y = target["rect"].x, target["rect"].y
+                target.hp = target.maxHp
+            player.rect.x, player.rect.y = target.rect.x, target.rect.y
             skill_god["active"] = False
             
 
-        skill["cooldown"] = cooltime
-        skill["active"] = False
+        skill.cooldown = cooltime
+        skill.active = False
         handle_death(target)
         handle_death(player)
 
@@ -1260,65 +1562,59 @@ def attackSkill(player, player_id, skill, cooltime):
 #バフスキルの管理
 def buffSkill(player, skill, cooltime, duration):
     current_time = time.time()
-    if skill["cooldown"] <= 0:
-        skill["active"] = True
-        skill["buffed"] = True
-        skill["cooldown"] = cooltime
-        skill["end_time"] = current_time + duration
+    if skill.cooldown <= 0:
+        skill.active = True
+        skill.buffed = True
+        skill.cooldown = cooltime
+        skill.end_time = current_time + duration
 
-        multipliers = skill.get("multipliers", {})
+        multipliers = skill.multipliers
 
-        if "buffed_effects" not in player:
-            player["buffed_effects"] = []
-
-        player["buffed_effects"].append({
-            "end_time": skill["end_time"],
+        player.buffed_effects.append({
+            "end_time": skill.end_time,
             "multipliers": multipliers,
             "source": skill
         })
 
         update_buffed_stats(player)
-        print(f"[BUFF] {player['job']} {multipliers}")
+        print(f"[BUFF] {player.job} {multipliers}")
 
 
 def debuffSkill(user, target, skill, cooltime, duration):
     current_time = time.time()
-    if skill.get("cooldown", 0) > 0:
+    if skill.cooldown > 0:
         return
 
-    skill["cooldown"] = cooltime
+    skill.cooldown = cooltime
     debuff = {
         "end_time": current_time + duration,
-        "multipliers": skill.get("multipliers", {})
+        "multipliers": skill.multipliers
     }
 
-    if "debuff_effects" not in target:
-        target["debuff_effects"] = []
-
-    target["debuff_effects"].append(debuff)
-    print(f"[DEBUFF] {user['job']} → {target['job']} {debuff['multipliers']}")
+    target.debuff_effects.append(debuff)
+    print(f"[DEBUFF] {user.job} → {target.job} {debuff['multipliers']}")
 
 
 def TrapSkill(player, player_id, skill, cooltime, duration=10):
     current_time = time.time()
 
-    if skill["cooldown"] > 0:
+    if skill.cooldown > 0:
         return  # クールダウン中
 
     # スキル発動
-    skill["active"] = True
-    skill["cooldown"] = cooltime
-    skill["end_time"] = current_time + duration  # 罠の有効時間（例：10秒）
+    skill.active = True
+    skill.cooldown = cooltime
+    skill.end_time = current_time + duration  # 罠の有効時間（例：10秒）
 
     trap = {
-        "x": player["rect"].centerx,
-        "y": player["rect"].bottom,
+        "x": player.rect.centerx,
+        "y": player.rect.bottom,
         "radius": 60,
-        "damage": skill["damaged"],
+        "damage": skill.damaged,
         "owner": player_id,
         "start_time": current_time,
         "owner": player_id,
-        "duration": skill["duration"],
+        "duration": skill.duration,
     }
     traps.append(trap)
     print(f"Player {player_id} set a claymore trap.")
@@ -1327,43 +1623,43 @@ def TrapSkill(player, player_id, skill, cooltime, duration=10):
 #状態異常の管理
 def abnormal_condition(target, target_id, player, player_id):
     print(f"Player {player_id} activated punch!")
-    damage = calculate_damage_with_shield(player["damaged"], target, multiplier=get_damage_multiplier(player))
-    target["hp"] -= damage
+    damage = calculate_damage_with_shield(player.damaged, target, multiplier=get_damage_multiplier(player))
+    target.hp -= damage
 
-    status = player.get("attack_status", "normal")
+    status = player.attack_status
     if status == "poison":
-        target["job_skill"]["poison"] = {"active": True, "cooldown": 0, "end_time": time.time() + 2, "source_id": player_id}
+        target.job_skill["poison"] = SkillState("poison", active=True, end_time=time.time() + 2, source_id=player_id)
         print(f"Player {target_id} is poisoned!")
     elif status == "burn":
-        target["job_skill"]["burn"] = {"active": True, "cooldown": 0, "end_time": time.time() + 1, "source_id": player_id}
+        target.job_skill["burn"] = SkillState("burn", active=True, end_time=time.time() + 1, source_id=player_id)
         print(f"Player {target_id} is burned!")
     elif status == "regeneration":
-        target["job_skill"]["regeneration"] = {"active": True, "cooldown": 0, "end_time": time.time() + 3, "source_id": player_id}
+        target.job_skill["regeneration"] = SkillState("regeneration", active=True, end_time=time.time() + 3, source_id=player_id)
         print(f"Player {target_id} is regenerated!")
 
 
-def apply_element_effect(player, target, skill):
-    element = player.get("element_type", "fire")
+def apply_element_effect(player, player_id, target, skill):
+    element = player.element_type
 
     # Wizard以外はスキップ（保険）
-    if player.get("job") != "Wizard":
+    if player.job != "Wizard":
         return
 
-    if not target.get("alive", True):
+    if not target.alive:
         return
-    send_skill_effect(element, target["rect"].centerx, target["rect"].centery)
+    send_skill_effect(element, target.rect.centerx, target.rect.centery)
     if element == "fire":
         # 小さい火ダメージを追加
-        target["job_skill"]["burn"] = {"active": True, "cooldown": 0, "end_time": time.time() + 1, "source_id": player_id}
+        target.job_skill["burn"] = SkillState("burn", active=True, end_time=time.time() + 1, source_id=player_id)
     elif element == "ice":
         # スロー効果（速度半減など、ここではスタンで代用）
-        target["common"]["stun"]["stuned"] = True
-        target["common"]["stun"]["end_time"] = time.time() + 1.0
+        target.common["stun"].stuned = True
+        target.common["stun"].end_time = time.time() + 1.0
     elif element == "lightning":
         # 小確率スタン
         if random.random() < 0.6:
-            target["common"]["stun"]["stuned"] = True
-            target["common"]["stun"]["end_time"] = time.time() + 0.5
+            target.common["stun"].stuned = True
+            target.common["stun"].end_time = time.time() + 0.5
     elif element == "water":
 
         pass
@@ -1371,28 +1667,28 @@ def apply_element_effect(player, target, skill):
         pass
     elif element == "wind":
         # 多段HIT向き（ここでは追加1ダメージ）
-        target["hp"] -= 1
+        target.hp -= 1
     elif element == "nitro":
         # 5%の確率で大ダメージ（危険枠）
         if random.random() < 0.5:
-            target["hp"] -= skill["damaged"] / 2;
+            target.hp -= skill.damaged / 2;
     elif element == "heal":
-        if player["hp"] + skill["damaged"] / 3 <= player["maxHp"]:
-            player["hp"] += skill["damaged"] / 3
+        if player.hp + skill.damaged / 3 <= player.maxHp:
+            player.hp += skill.damaged / 3
         else:
-            player["hp"] = player["maxHp"]
-
-
-def accept_connections():
-    player_id = 0
-    while True:
-        client_sock, client_addr = server.accept()
-        threading.Thread(target=handle_client, args=(client_sock, client_addr, player_id), daemon=True).start()
-        player_id += 1
+            player.hp = player.maxHp
 
 
 def main():
-    threading.Thread(target=accept_connections, daemon=True).start()
+    start_in_thread(HOST, PORT, TRANSPORT, handle_client)
+    if HEADLESS:
+        # 描かないので、tickをそのままメインスレッドで回す
+        try:
+            game_loop()
+        except KeyboardInterrupt:
+            pass
+        return
+    threading.Thread(target=game_loop, daemon=True).start()
     running = True
     while running:
         clock.tick(60)
@@ -1407,29 +1703,31 @@ def main():
         if game_map:
             game_map.draw(screen, offset_x, offset_y)
 
-        for pid, pdata in players.items():
-            if pdata["alive"]:
-                state = pdata.get("animation_state", "idle")
-                animation = pdata["animations"].get(state, pdata["animations"]["idle"])
+        with world_lock:
+            visible_players = list(players.items())
+        for pid, pdata in visible_players:
+            if pdata.alive:
+                state = pdata.animation_state
+                animation = pdata.animations.get(state, pdata.animations["idle"])
                 sprite = animation.get_frame()
-                if not pdata.get("facing_right", True):
+                if not pdata.facing_right:
                     sprite = pygame.transform.flip(sprite, True, False)
             
-                rect = pdata["rect"]
+                rect = pdata.rect
                 sprite_rect = sprite.get_rect(center=(
                     rect.x - offset_x + rect.width // 2,
                     rect.y - offset_y + rect.height // 2
                 ))
                 screen.blit(sprite, sprite_rect)
-                draw_health_bar(screen, rect.x - offset_x, rect.y - offset_y+40, pdata["hp"], pdata["maxHp"])
-                draw_shield_gage(screen, rect.x - offset_x, rect.y - offset_y+40, pdata["ShieldGage"])
+                draw_health_bar(screen, rect.x - offset_x, rect.y - offset_y+40, pdata.hp, pdata.maxHp)
+                draw_shield_gage(screen, rect.x - offset_x, rect.y - offset_y+40, pdata.ShieldGage)
                 draw_name(screen, rect.x - offset_x, rect.y - offset_y+40, pid)
 
-                if pdata["isShield"]:
-                    shield_sprite = player_shields[int(pdata["ShieldGage"] / 10) % len(player_shields)]
+                if pdata.isShield:
+                    shield_sprite = player_shields[int(pdata.ShieldGage / 10) % len(player_shields)]
                     screen.blit(shield_sprite, (rect.x - 5 - offset_x, rect.y - offset_y+35))
                 # スキル中なら枠など表示
-                if any(skill_info.get("active", False) for skill_info in pdata["common"].values()):
+                if any(skill_info.active for skill_info in pdata.common.values()):
                     pygame.draw.rect(screen, (255, 255, 0), rect.inflate(10, 10), 3)
                     
         pygame.display.flip()
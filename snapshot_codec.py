@@ -0,0 +1,578 @@
+import struct
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import compress
+from operator import itemgetter, ne
+
+# --- ゲーム状態のバイナリ形式 ---
+# pickleだとキー名の文字列が毎回プレイヤーの数だけ乗るので、
+# 項目の並びを固定して数値だけを詰める。文字列の値は下の表の番号で送る。
+# 表の順番を変えるとサーバとクライアントで食い違うので、追加は必ず末尾に。
+
+JOBS = ["Warrior", "Wizard", "Assassin", "Player", "Sniper", "Berserker", "Gambler"]
+ANIMATION_STATES = ["idle", "run", "jump", "walk", "dead", "shield", "attack1", "attack2", "attack3", "hurt"]
+ATTACK_STATUSES = ["normal", "poison", "burn", "regeneration"]
+ELEMENT_TYPES = ["fire", "water", "ice", "lightning", "wind", "earth", "nitro", "heal"]
+
+COMMON_SKILLS = ["jump_skill", "stun"]
+SKILLS = COMMON_SKILLS + [
+    "wave_strike", "chargeBoost", "all_death_damage",
+    "heal", "strength_buff", "resistance_buff", "Element_aura",
+    "criticalAttackMulti", "shadow_move", "dummy",
+    "create_isGod",
+    "far_snipe", "claymore_trap", "over_heat",
+    "berserked", "boost",
+]
+
+EFFECTS = [
+    "stun", "wave_strike", "all_death_damage", "normal_slash", "criticalAttackMulti",
+    "shadow_move", "charge_boost", "claymore_trap", "Element_aura",
+    "fire", "water", "ice", "lightning", "wind", "earth", "nitro", "heal",
+]
+
+
+def _index_table(names):
+    return {name: i for i, name in enumerate(names)}
+
+
+JOB_INDEX = _index_table(JOBS)
+ANIMATION_INDEX = _index_table(ANIMATION_STATES)
+ATTACK_STATUS_INDEX = _index_table(ATTACK_STATUSES)
+ELEMENT_INDEX = _index_table(ELEMENT_TYPES)
+SKILL_INDEX = _index_table(SKILLS)
+EFFECT_INDEX = _index_table(EFFECTS)
+
+# flagsのビット
+FLAG_ALIVE = 1
+FLAG_SHIELD = 2
+FLAG_SHIELD_RECOVERING = 4
+FLAG_FACING_RIGHT = 8
+
+SKILL_ACTIVE = 0x80   # スキル番号の最上位ビットを発動中フラグに使う
+
+# プレイヤー1人分の並び。recordでは skills の位置にスキルの個数、その後ろに (番号, クールダウン) が平らに続く
+# （1人分を pack(pid, mask, *record) の1回で詰められるように入れ子にしない）
+RECORD_FIELDS = (
+    "x", "y", "job", "hp", "maxHp", "defense", "ShieldGage", "flags",
+    "animation_state", "animation_index", "attack_status", "element_type",
+    "mouse_x", "mouse_y", "skills",
+)
+
+# 各項目の型（skillsは 個数 + (番号, クールダウン) の並びで別扱い）
+FIELD_FORMATS = ("i", "i", "B", "f", "i", "i", "f", "B", "B", "B", "B", "B", "h", "h")
+SKILLS_FIELD = len(FIELD_FORMATS)
+SKILLS_BIT = 1 << SKILLS_FIELD
+FULL_MASK = (1 << len(RECORD_FIELDS)) - 1
+FIELD_BITS = tuple(1 << i for i in range(SKILLS_FIELD))
+
+# スナップショット = [全員共通の部分][送り先ごとの部分]
+# 共通の部分は1tickに1回だけ作って全員に同じバイト列を送り、送り先ごとの部分は後ろに付け足す。
+# 共通: スナップショット番号(=サーバのtick), 基準にした番号(0なら基準なし), サーバ時刻,
+#       送るプレイヤー数, 消えたプレイヤー数
+# 基準から変わっていないプレイヤーは送らない（受け取った側は基準の値をそのまま使う）。
+# 基準にはいたが今回いなくなったプレイヤーは、idだけを「消えた」として送る。
+SNAPSHOT_HEADER = struct.Struct("!IIdHH")
+REMOVED = struct.Struct("!I")                       # 消えたプレイヤーのid（idは接続ごとに増え続けるので4byte）
+# 送り先ごと: 反映済みの入力番号, 本人の縦速度, 本人が接地しているか（この2つは予測の巻き戻し用）,
+#             罠の数（罠は仕掛けた本人にしか見えない）
+CLIENT_HEADER = struct.Struct("!If?H")
+PLAYER_HEADER_FORMAT = "!IH"                        # id, 変化した項目のビットマスク
+SKILL_FORMAT = "BH"                                 # 番号(+発動中ビット), クールダウン
+TRAP = struct.Struct("!iiH")                        # x, y, 半径
+
+# スナップショットとは別に、一度だけ確実に届けるもの
+EFFECT = struct.Struct("!Biidf")                    # 種類, x, y, 開始時刻, 継続時間
+EVENT = struct.Struct("!BI")                        # 出来事の種類, プレイヤーid
+EVENT_DEATH = 1
+EVENT_RESPAWN = 2
+
+# 観測者（debug_viewer.py）にだけ毎tick送るもの: 前のtickの処理時間(ms), プレイヤー数, 罠の数
+# + プレイヤーごとの当たり判定と縦速度・接地 + すべての罠と仕掛けた人
+DEBUG_HEADER = struct.Struct("!fHH")
+DEBUG_BODY = struct.Struct("!IiiHHf?")              # id, 当たり判定のx, y, 幅, 高さ, 縦速度, 接地
+DEBUG_TRAP = struct.Struct("!iiHI")                 # x, y, 半径, 仕掛けた人
+
+_record_structs = {}
+
+
+def record_struct(mask, skill_count=0):
+    # (マスク, スキルの個数) ごとに、ヘッダからスキルまでを1つのStructにしておき、1人分を1回のpack/unpackで済ませる
+    # 返すのは (Struct, 対象の項目番号, recordから対象の項目だけをタプルで取り出す関数)
+    key = mask << 8 | skill_count
+    entry = _record_structs.get(key)
+    if entry is None:
+        fields = tuple(i for i in range(SKILLS_FIELD) if mask & (1 << i))
+        fmt = PLAYER_HEADER_FORMAT + "".join(FIELD_FORMATS[i] for i in fields)
+        if mask & SKILLS_BIT:
+            fmt += "B" + SKILL_FORMAT * skill_count
+        if len(fields) == 1:
+            getter = lambda record, i=fields[0]: (record[i],)
+        else:
+            getter = itemgetter(*fields) if fields else lambda record: ()
+        entry = _record_structs[key] = (struct.Struct(fmt), fields, getter)
+    return entry
+
+
+class SnapshotHistory:
+    # 送った/受け取ったスナップショットを番号付きで少しだけ覚えておく（差分の基準用）
+    # 受け取る側は、プレイヤーごとのdictを1つずつだけ持ち、最新のスナップショットの値をその場で書き込む
+    # （players: id → dict, shown_seq: playersが今どのスナップショットの値か。0ならまだ何もない）
+    def __init__(self, size):
+        self.size = size
+        self.snapshots = OrderedDict()
+        self.players = {}
+        self.shown_seq = 0
+
+    def add(self, seq, records):
+        self.snapshots[seq] = records
+        while len(self.snapshots) > self.size:
+            self.snapshots.popitem(last=False)
+
+    def get(self, seq):
+        return self.snapshots.get(seq)
+
+
+def _clamp16(value):
+    return max(-32768, min(32767, int(value)))
+
+
+def pack_skills(common, job_skills, job_skill_names):
+    # 職業本来のスキルだけを 番号(+発動中ビット), クールダウン の順に平らに並べる
+    skills = []
+    for name, s in common.items():
+        _pack_skill(skills, name, s)
+    for name, s in job_skills.items():
+        if name in job_skill_names:
+            _pack_skill(skills, name, s)
+    return tuple(skills)
+
+
+def _pack_skill(skills, name, skill):
+    index = SKILL_INDEX[name]
+    if skill.active:
+        index |= SKILL_ACTIVE
+    skills.append(index)
+    skills.append(max(0, min(65535, int(skill.cooldown))))
+
+
+def make_flags(alive, is_shield, shield_recovering, facing_right):
+    flags = 0
+    if alive:
+        flags |= FLAG_ALIVE
+    if is_shield:
+        flags |= FLAG_SHIELD
+    if shield_recovering:
+        flags |= FLAG_SHIELD_RECOVERING
+    if facing_right:
+        flags |= FLAG_FACING_RIGHT
+    return flags
+
+
+def make_record(x, y, job, hp, max_hp, defense, shield_gage, flags,
+                animation_state, animation_index, attack_status, element_type,
+                mouse_pos, skills):
+    return (
+        int(x), int(y),
+        JOB_INDEX.get(job, JOB_INDEX["Player"]),
+        float(hp), int(max_hp), int(defense), float(shield_gage), flags,
+        ANIMATION_INDEX.get(animation_state, 0),
+        min(255, int(animation_index)),
+        ATTACK_STATUS_INDEX.get(attack_status, 0),
+        ELEMENT_INDEX.get(element_type, 0),
+        _clamp16(mouse_pos[0]), _clamp16(mouse_pos[1]),
+        len(skills) // 2,
+    ) + skills
+
+
+# --- エンコード ---
+# 前回から変わった項目だけを送る。baseがNoneなら全項目。
+# サーバは変わっていないプレイヤーには前のtickのrecordをそのまま使うので、止まっている人の分は
+# 差分なら world_parts の base is record だけで飛ばせ、全項目なら前に詰めたバイト列がそのまま使える。
+# 中身で比べる（タプルのハッシュを毎回計算する）と作り直すのと変わらないので、キャッシュはオブジェクトの同一性で引く。
+# recordはエントリが持っているので、idが別のオブジェクトに使い回されることはない
+_full_cache = {}   # プレイヤーのid → (record, 全項目のバイト列)
+MAX_FULL_CACHE = 4096
+
+
+def encode_player(pid, record, base=None, deltas=None):
+    # baseと何も変わっていなければNone
+    if base is None:
+        entry = _full_cache.get(pid)
+        if entry is not None and entry[0] is record:
+            return entry[1]
+        count = record[SKILLS_FIELD]
+        st = (_record_structs.get(FULL_MASK << 8 | count) or record_struct(FULL_MASK, count))[0]
+        data = st.pack(pid, FULL_MASK, *record)
+        if len(_full_cache) >= MAX_FULL_CACHE:
+            _full_cache.clear()
+        _full_cache[pid] = (record, data)
+        return data
+    return encode_delta(pid, record, base, deltas)
+
+
+def diff_mask(record, base):
+    # 2つのrecordで違う項目のビットマスク
+    if record[:SKILLS_FIELD] == base[:SKILLS_FIELD]:
+        # 止まっていてクールダウンだけが減っている人が多いので、先にまとめて比べる
+        return SKILLS_BIT if record != base else 0
+    mask = sum(compress(FIELD_BITS, map(ne, record, base)))
+    if record[SKILLS_FIELD:] != base[SKILLS_FIELD:]:
+        mask |= SKILLS_BIT
+    return mask
+
+
+def encode_delta(pid, record, base, deltas=None):
+    # deltas: 同じtickの中で使い回す {id(record): (プレイヤーのid, base, バイト列, record)}。
+    # 送り先ごとに見えている人が違っても、同じrecordと同じ基準の組み合わせは1回だけ作る
+    if deltas is not None:
+        entry = deltas.get(id(record))
+        if entry is not None and entry[1] is base and entry[0] == pid:
+            return entry[2]
+    mask = diff_mask(record, base)
+    if mask & SKILLS_BIT:
+        count = record[SKILLS_FIELD]
+        st, fields, getter = _record_structs.get(mask << 8 | count) or record_struct(mask, count)
+        data = st.pack(pid, mask, *getter(record), *record[SKILLS_FIELD:])
+    elif mask:
+        st, fields, getter = _record_structs.get(mask << 8) or record_struct(mask)
+        data = st.pack(pid, mask, *getter(record))
+    else:
+        data = None
+    if deltas is not None:
+        deltas[id(record)] = (pid, base, data, record)
+    return data
+
+
+def clear_caches():
+    # 詰めたバイト列のキャッシュを捨てる（ベンチマークで最初の1回を測るとき用）
+    _full_cache.clear()
+
+
+def world_parts(seq, records, baseline_seq=0, baseline=None, server_time=0.0, deltas=None):
+    # 全員共通の部分をバイト列のリストで返す（先頭がヘッダ）
+    if baseline is None:
+        baseline_seq = 0
+        baseline = {}
+    parts = [b""]
+    for pid, record in records.items():
+        base = baseline.get(pid)
+        if base is not record:
+            data = encode_player(pid, record, base, deltas)
+            if data is not None:
+                parts.append(data)
+    sent = len(parts) - 1
+    for pid in baseline:
+        if pid not in records:
+            parts.append(REMOVED.pack(pid))
+    parts[0] = SNAPSHOT_HEADER.pack(seq, baseline_seq, server_time, sent, len(parts) - 1 - sent)
+    return parts
+
+
+def write_world(out, seq, records, baseline_seq=0, baseline=None, server_time=0.0, deltas=None):
+    # encode_worldと同じ内容を、使い回すbytearray outの先頭から書き込んで長さを返す
+    data = b"".join(world_parts(seq, records, baseline_seq, baseline, server_time, deltas))
+    out[:len(data)] = data
+    return len(data)
+
+
+def _reserve(out, size):
+    # 使い回しのバッファが足りなければ倍々で広げる（最初の数tickだけ）
+    if len(out) < size:
+        out.extend(bytes(max(size, len(out) * 2) - len(out)))
+
+
+def write_client_part(out, input_seq, traps, vel_y=0.0, on_ground=True):
+    # encode_client_partと同じ内容をoutの先頭から書き込んで長さを返す
+    _reserve(out, CLIENT_HEADER.size + TRAP.size * len(traps))
+    CLIENT_HEADER.pack_into(out, 0, input_seq, vel_y, on_ground, len(traps))
+    pos = CLIENT_HEADER.size
+    for x, y, radius in traps:
+        TRAP.pack_into(out, pos, int(x), int(y), int(radius))
+        pos += TRAP.size
+    return pos
+
+
+def encode_world(seq, records, baseline_seq=0, baseline=None, server_time=0.0):
+    # 全員共通の部分。records: {pid: record}
+    # baseline: クライアントが受け取り済みのスナップショット（baseline_seqの時点のrecords）
+    return b"".join(world_parts(seq, records, baseline_seq, baseline, server_time))
+
+
+def client_parts(input_seq, traps, vel_y=0.0, on_ground=True):
+    parts = [b""]
+    for x, y, radius in traps:
+        parts.append(TRAP.pack(int(x), int(y), int(radius)))
+    parts[0] = CLIENT_HEADER.pack(input_seq, vel_y, on_ground, len(parts) - 1)
+    return parts
+
+
+def encode_client_part(input_seq, traps, vel_y=0.0, on_ground=True):
+    # 送り先ごとの部分。input_seq: このスナップショットに反映済みの入力番号, traps: [(x, y, 半径)]
+    return b"".join(client_parts(input_seq, traps, vel_y, on_ground))
+
+
+def encode_snapshot(seq, records, traps, baseline_seq=0, baseline=None, input_seq=0, server_time=0.0):
+    return b"".join(world_parts(seq, records, baseline_seq, baseline, server_time) + client_parts(input_seq, traps))
+
+
+def encode_effects(effects):
+    # effects: [(種類, x, y, 開始, 継続)]
+    return b"".join(EFFECT.pack(EFFECT_INDEX[name], int(x), int(y), start, duration)
+                    for name, x, y, start, duration in effects)
+
+
+def encode_event(kind, pid):
+    return EVENT.pack(kind, pid)
+
+
+def encode_debug(tick_ms, bodies, traps):
+    # bodies: [(id, 当たり判定のRect, 縦速度, 接地)], traps: [(x, y, 半径, 仕掛けた人)]
+    bodies = [DEBUG_BODY.pack(pid, rect.x, rect.y, rect.width, rect.height, vel_y, on_ground)
+              for pid, rect, vel_y, on_ground in bodies]
+    traps = [DEBUG_TRAP.pack(int(x), int(y), int(radius), owner) for x, y, radius, owner in traps]
+    return DEBUG_HEADER.pack(tick_ms, len(bodies), len(traps)) + b"".join(bodies) + b"".join(traps)
+
+
+# --- デコード ---
+_PLAYER_HEADER = struct.Struct(PLAYER_HEADER_FORMAT)
+_body_structs = {}
+_full_bodies = [None] * 256   # スキルの個数 → 全項目のStruct（いちばん多いので辞書を引かずに済むように）
+_FULL_COUNT_OFFSET = struct.calcsize("!" + "".join(FIELD_FORMATS))
+
+
+def body_struct(mask, skill_count=0):
+    # record_structのヘッダ（id, マスク）を除いた部分。unpackした結果がそのまま項目の値の並びになる
+    # 返すのは (Struct, 対象の項目番号, スキルの個数が何byte目にあるか)
+    key = mask << 8 | skill_count
+    entry = _body_structs.get(key)
+    if entry is None:
+        fields = tuple(i for i in range(SKILLS_FIELD) if mask & (1 << i))
+        fmt = "!" + "".join(FIELD_FORMATS[i] for i in fields)
+        count_offset = struct.calcsize(fmt)
+        if mask & SKILLS_BIT:
+            fmt += "B" + SKILL_FORMAT * skill_count
+        entry = _body_structs[key] = (struct.Struct(fmt), fields, count_offset)
+    return entry
+
+
+def decode_player(data, pos, baseline):
+    # (id, 変化した項目のマスク, record, 次の位置) を返す
+    pid, mask = _PLAYER_HEADER.unpack_from(data, pos)
+    pos += _PLAYER_HEADER.size
+    if mask == FULL_MASK:
+        # スキルの個数は項目のすぐ後ろにある。個数が分かれば残りも1回で読める
+        count = data[pos + _FULL_COUNT_OFFSET]
+        st = _full_bodies[count]
+        if st is None:
+            st = _full_bodies[count] = body_struct(FULL_MASK, count)[0]
+        return pid, mask, st.unpack_from(data, pos), pos + st.size
+    if mask & SKILLS_BIT:
+        count = data[pos + (_body_structs.get(mask << 8) or body_struct(mask))[2]]
+        st, fields, _ = _body_structs.get(mask << 8 | count) or body_struct(mask, count)
+    else:
+        st, fields, _ = _body_structs.get(mask << 8) or body_struct(mask)
+    values = st.unpack_from(data, pos)
+    pos += st.size
+
+    base = baseline.get(pid)
+    if base is None:
+        raise ValueError(f"delta for player {pid} without baseline")
+    if not mask:
+        return pid, mask, base, pos
+    record = list(base)
+    for field, value in zip(fields, values):
+        record[field] = value
+    if mask & SKILLS_BIT:
+        record[SKILLS_FIELD:] = values[len(fields):]
+    return pid, mask, tuple(record), pos
+
+
+# flags → (alive, isShield, ShieldRecovering, facing_right)
+_FLAG_STATES = tuple(
+    (bool(f & FLAG_ALIVE), bool(f & FLAG_SHIELD), bool(f & FLAG_SHIELD_RECOVERING), bool(f & FLAG_FACING_RIGHT))
+    for f in range(256)
+)
+
+
+def record_to_state(record):
+    # クライアントが使うdictの形に戻す。
+    # skillsは (番号+発動中ビット, クールダウン) の平らな並びのまま渡す（skill_entries / skill_active で読む）。
+    # 以前の {"common": {名前: {"active", "cooldown"}}, "job": ...} はスキル1つごとにdictを作るので、
+    # 毎回全部作るとそれだけでpickleより遅くなっていた
+    alive, is_shield, shield_recovering, facing_right = _FLAG_STATES[record[7]]
+    return {
+        "x": record[0],
+        "y": record[1],
+        "job": JOBS[record[2]],
+        "hp": record[3],
+        "maxHp": record[4],
+        "defense": record[5],
+        "alive": alive,
+        "isShield": is_shield,
+        "ShieldGage": record[6],
+        "ShieldRecovering": shield_recovering,
+        "animation_state": ANIMATION_STATES[record[8]],
+        "animation_index": record[9],
+        "facing_right": facing_right,
+        "attack_status": ATTACK_STATUSES[record[10]],
+        "element_type": ELEMENT_TYPES[record[11]],
+        "skills": record[SKILLS_FIELD + 1:],
+        "mouse_pos": record[12:14],
+    }
+
+
+def skill_entries(skills):
+    # state["skills"] → [(名前, 発動中か, クールダウン)]（共通スキルが先）
+    return [(SKILLS[index & ~SKILL_ACTIVE], bool(index & SKILL_ACTIVE), cooldown)
+            for index, cooldown in zip(skills[::2], skills[1::2])]
+
+
+def skill_active(skills, name):
+    index = SKILL_INDEX[name]
+    for i in skills[::2]:
+        if i & ~SKILL_ACTIVE == index:
+            return bool(i & SKILL_ACTIVE)
+    return False
+
+
+def any_skill_active(skills):
+    return any(i & SKILL_ACTIVE for i in skills[::2])
+
+
+# recordの項目 → (dictのキー, 番号から値に戻す表)。flags・mouse_x/y・skills は update_state で別に扱う
+FLAGS_FIELD = RECORD_FIELDS.index("flags")
+MOUSE_X_FIELD = RECORD_FIELDS.index("mouse_x")   # mouse_y はその次
+MOUSE_BITS = 3 << MOUSE_X_FIELD
+_STATE_FIELDS = {
+    0: ("x", None), 1: ("y", None), 2: ("job", JOBS), 3: ("hp", None), 4: ("maxHp", None),
+    5: ("defense", None), 6: ("ShieldGage", None), 8: ("animation_state", ANIMATION_STATES),
+    9: ("animation_index", None), 10: ("attack_status", ATTACK_STATUSES), 11: ("element_type", ELEMENT_TYPES),
+}
+_SIMPLE_MASK = sum(1 << i for i in _STATE_FIELDS)
+
+# 他のプレイヤーを前後のスナップショットの間で補間するときに使う項目 (x, y, hp, ShieldGage) をrecordから取り出す
+interpolated = itemgetter(0, 1, 3, 6)
+
+
+@lru_cache(maxsize=None)
+def _simple_fields(mask):
+    return tuple((i, *_STATE_FIELDS[i]) for i in _STATE_FIELDS if mask & (1 << i))
+
+
+def update_state(state, record, mask):
+    # maskの項目だけをrecordの値でその場で書き換える（たいていは位置とアニメーションのコマだけ）
+    for i, key, table in _simple_fields(mask & _SIMPLE_MASK):
+        state[key] = record[i] if table is None else table[record[i]]
+    if mask & (1 << FLAGS_FIELD):
+        alive, is_shield, shield_recovering, facing_right = _FLAG_STATES[record[FLAGS_FIELD]]
+        state["alive"] = alive
+        state["isShield"] = is_shield
+        state["ShieldRecovering"] = shield_recovering
+        state["facing_right"] = facing_right
+    if mask & MOUSE_BITS:
+        state["mouse_pos"] = record[MOUSE_X_FIELD:MOUSE_X_FIELD + 2]
+    if mask & SKILLS_BIT:
+        state["skills"] = record[SKILLS_FIELD + 1:]
+
+
+def snapshot_seq_of(data):
+    return SNAPSHOT_HEADER.unpack_from(data, 0)[0]
+
+
+def decode_snapshot(data, history):
+    # 受け取ったスナップショットを基準と合わせて完全な状態に戻し、historyに記録する
+    # 返すプレイヤーのdictはhistoryが持っているもので、次のdecode_snapshotで書き換わる
+    # （前のスナップショットの値が要るなら history.get(seq) のrecordを使う）
+    seq, baseline_seq, server_time, player_count, removed_count = SNAPSHOT_HEADER.unpack_from(data, 0)
+    pos = SNAPSHOT_HEADER.size
+    baseline = {}
+    if baseline_seq:
+        baseline = history.get(baseline_seq)
+        if baseline is None:
+            raise ValueError(f"unknown baseline snapshot {baseline_seq}")
+    # 送られてこなかった（基準から変わっていない）プレイヤーは、基準のときのrecordをそのまま使う
+    records = dict(baseline)
+    players = history.players
+    if baseline_seq == history.shown_seq:
+        # プレイヤーごとのdictがちょうど基準の値（最初は空と基準なし）→ 送られてきたマスクの項目だけをその場で書き換える
+        try:
+            for _ in range(player_count):
+                pid, mask, record, pos = decode_player(data, pos, baseline)
+                records[pid] = record
+                if mask == FULL_MASK:
+                    players[pid] = record_to_state(record)
+                else:
+                    update_state(players[pid], record, mask)
+        except ValueError:
+            players.clear()   # 途中まで書き換えたdictは捨てて、次のスナップショットで作り直す
+            history.shown_seq = 0
+            raise
+        for _ in range(removed_count):
+            pid = REMOVED.unpack_from(data, pos)[0]
+            records.pop(pid, None)
+            players.pop(pid, None)
+            pos += REMOVED.size
+    else:
+        # 基準が受け取った最新より古い（確認が届くまでの間）→ dictが今表しているrecordと比べ直す
+        shown = history.get(history.shown_seq) or {}
+        for _ in range(player_count):
+            pid, mask, record, pos = decode_player(data, pos, baseline)
+            records[pid] = record
+        for _ in range(removed_count):
+            records.pop(REMOVED.unpack_from(data, pos)[0], None)
+            pos += REMOVED.size
+        for pid, record in records.items():
+            old = shown.get(pid)
+            if old is record:
+                continue
+            if old is None:
+                players[pid] = record_to_state(record)
+            else:
+                update_state(players[pid], record, diff_mask(record, old))
+        if len(players) != len(records):
+            for pid in [pid for pid in players if pid not in records]:
+                del players[pid]
+    history.add(seq, records)
+    history.shown_seq = seq
+
+    state = dict(players)
+    input_seq, vel_y, on_ground, trap_count = CLIENT_HEADER.unpack_from(data, pos)
+    pos += CLIENT_HEADER.size
+    traps = []
+    for _ in range(trap_count):
+        x, y, radius = TRAP.unpack_from(data, pos)
+        pos += TRAP.size
+        traps.append({"x": x, "y": y, "radius": radius})
+    state["traps"] = traps
+    state["input_seq"] = input_seq
+    state["vel_y"] = vel_y
+    state["on_ground"] = on_ground
+    state["server_time"] = server_time
+    return seq, state
+
+
+def decode_effects(data):
+    effects = []
+    for kind, x, y, start, duration in EFFECT.iter_unpack(data):
+        effects.append({"type": EFFECTS[kind], "x": x, "y": y, "start": start, "duration": duration})
+    return effects
+
+
+def decode_event(data):
+    return EVENT.unpack(data)
+
+
+def decode_debug(data):
+    tick_ms, body_count, trap_count = DEBUG_HEADER.unpack_from(data, 0)
+    pos = DEBUG_HEADER.size
+    bodies = {}
+    for _ in range(body_count):
+        pid, x, y, width, height, vel_y, on_ground = DEBUG_BODY.unpack_from(data, pos)
+        bodies[pid] = {"rect": (x, y, width, height), "vel_y": vel_y, "on_ground": on_ground}
+        pos += DEBUG_BODY.size
+    traps = []
+    for _ in range(trap_count):
+        x, y, radius, owner = DEBUG_TRAP.unpack_from(data, pos)
+        traps.append({"x": x, "y": y, "radius": radius, "owner": owner})
+        pos += DEBUG_TRAP.size
+    return {"tick_ms": tick_ms, "bodies": bodies, "traps": traps}
@@ -0,0 +1,243 @@
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from net_protocol import (
+    MSG_EFFECTS, MSG_EVENT, MSG_JOB, MSG_MAP, MSG_MAP_CHUNK, MSG_MAP_REQUEST, MSG_OBSERVE, MSG_PLAYER_ID,
+    MSG_RESUME, MSG_SESSION, ProtocolError, encode_object, unpack_object,
+)
+
+# --- UDP通信 ---
+# 位置やHPのスナップショットは新しいのが来たら古いのは要らないので、
+# TCPのように1つ落ちたら後ろが全部待たされる（head-of-line blocking）のを避けてUDPで送る。
+# 職業選択・スキルエフェクト・死亡/復活のような「1回きり」のものだけ、
+# 番号付き＋ack＋再送の小さな順序保証チャネルで送る。
+#
+# データグラム: [種類(1byte)][番号(4byte)][メッセージ種類(1byte)][ペイロード]
+DATAGRAM = struct.Struct("!BIB")
+KIND_UNRELIABLE = 0
+KIND_RELIABLE = 1
+KIND_ACK = 2       # 番号 = ここまで全部受け取った、という累積ack
+KIND_BYE = 3
+
+MSG_HELLO = 100    # 接続開始（reliableで送るので届くまで再送される）
+
+# 順序保証で送るメッセージ
+RELIABLE_TYPES = {
+    MSG_HELLO, MSG_PLAYER_ID, MSG_MAP, MSG_JOB, MSG_EVENT, MSG_EFFECTS, MSG_MAP_REQUEST, MSG_MAP_CHUNK,
+    MSG_SESSION, MSG_RESUME, MSG_OBSERVE,
+}
+
+MAX_DATAGRAM = 65507
+RESEND_INTERVAL = 0.15   # ackが返ってこなければ再送するまでの秒数
+FAST_RESEND_ACKS = 3     # 同じackがこれだけ続いたら（後ろは届いているのに1つ抜けている）待たずに再送する
+TIMEOUT = 5.0            # これだけ何も届かなければ切断とみなす
+KEEPALIVE_INTERVAL = 1.0  # これだけ何も送っていなければackを送って、生きていることを相手に伝える
+POLL_INTERVAL = 0.02
+RECEIVE_WINDOW = 256      # これより先の番号は溜めずに捨てる（届いた順に覚えておく量の上限）
+
+
+class ReliableChannel:
+    # 送った側: ackが来るまで覚えておいて再送 / 受けた側: 番号順に並べ直して渡す
+    def __init__(self):
+        self.next_send_seq = 1
+        self.unacked = OrderedDict()   # 番号 → [データグラム, 最後に送った時刻]
+        self.last_ack = 0
+        self.duplicate_acks = 0
+        self.next_recv_seq = 1
+        self.out_of_order = {}
+
+    def wrap(self, msg_type, payload, now):
+        seq = self.next_send_seq
+        self.next_send_seq += 1
+        datagram = DATAGRAM.pack(KIND_RELIABLE, seq, msg_type) + payload
+        self.unacked[seq] = [datagram, now]
+        return datagram
+
+    def on_ack(self, ack, now):
+        # 抜けているものをすぐ再送するときはそのデータグラムを返す
+        if ack == self.last_ack and self.unacked:
+            self.duplicate_acks += 1
+            if self.duplicate_acks == FAST_RESEND_ACKS:
+                entry = next(iter(self.unacked.values()))
+                entry[1] = now
+                return entry[0]
+            return None
+        self.last_ack = max(self.last_ack, ack)
+        self.duplicate_acks = 0
+        while self.unacked:
+            seq = next(iter(self.unacked))
+            if seq > ack:
+                break
+            del self.unacked[seq]
+        return None
+
+    def due(self, now):
+        resend = []
+        for entry in self.unacked.values():
+            if now - entry[1] >= RESEND_INTERVAL:
+                entry[1] = now
+                resend.append(entry[0])
+        return resend
+
+    def receive(self, seq, msg_type, payload):
+        # 順番どおりに渡せるメッセージのリストを返す（重複・先走りは溜めるか捨てる）
+        if seq < self.next_recv_seq or seq >= self.next_recv_seq + RECEIVE_WINDOW:
+            return []
+        self.out_of_order[seq] = (msg_type, payload)
+        delivered = []
+        while self.next_recv_seq in self.out_of_order:
+            delivered.append(self.out_of_order.pop(self.next_recv_seq))
+            self.next_recv_seq += 1
+        return delivered
+
+    def ack_datagram(self):
+        return DATAGRAM.pack(KIND_ACK, self.next_recv_seq - 1, 0)
+
+
+class UdpConnection:
+    # FramedConnectionと同じ使い方（send/recv_message/recv_object/poll/close）ができるUDP版
+    def __init__(self, sock, addr, owns_socket):
+        self.sock = sock
+        self.addr = addr
+        self.owns_socket = owns_socket   # クライアント側は自分でソケットを読む
+        self.channel = ReliableChannel()
+        self.inbox = queue.Queue()
+        self.closed = False
+        self.last_recv = self.last_send = time.time()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, host, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+        conn = cls(sock, (host, port), owns_socket=True)
+        conn.send(MSG_HELLO, b"")
+        return conn
+
+    # --- 送信 ---
+    def _send_raw(self, datagram):
+        if len(datagram) > MAX_DATAGRAM:
+            raise ProtocolError(f"datagram too large: {len(datagram)}")
+        self.last_send = time.time()
+        try:
+            if self.owns_socket:
+                self.sock.send(datagram)
+            else:
+                self.sock.sendto(datagram, self.addr)
+        except OSError:
+            pass   # UDPなので送れなくても再送かタイムアウトに任せる
+
+    def send(self, msg_type, payload):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        if msg_type in RELIABLE_TYPES:
+            with self._lock:
+                datagram = self.channel.wrap(msg_type, payload, time.time())
+        else:
+            datagram = DATAGRAM.pack(KIND_UNRELIABLE, 0, msg_type) + payload
+        self._send_raw(datagram)
+
+    def send_object(self, msg_type, obj):
+        self.send(msg_type, encode_object(msg_type, obj))
+
+    # --- 受信 ---
+    def handle_datagram(self, data):
+        if len(data) < DATAGRAM.size:
+            return
+        kind, seq, msg_type = DATAGRAM.unpack_from(data)
+        payload = data[DATAGRAM.size:]
+        self.last_recv = time.time()
+        if kind == KIND_UNRELIABLE:
+            self.inbox.put_nowait((msg_type, payload))
+        elif kind == KIND_RELIABLE:
+            with self._lock:
+                delivered = self.channel.receive(seq, msg_type, payload)
+                ack = self.channel.ack_datagram()
+            self._send_raw(ack)
+            for message in delivered:
+                if message[0] != MSG_HELLO:
+                    self.inbox.put_nowait(message)
+        elif kind == KIND_ACK:
+            with self._lock:
+                resend = self.channel.on_ack(seq, self.last_recv)
+            if resend is not None:
+                self._send_raw(resend)
+        elif kind == KIND_BYE:
+            self.closed = True
+
+    def update(self, now):
+        # 再送・生存確認・切断判定（定期的に呼ぶ）
+        with self._lock:
+            resend = self.channel.due(now)
+            if not resend and now - self.last_send >= KEEPALIVE_INTERVAL:
+                resend.append(self.channel.ack_datagram())
+        for datagram in resend:
+            self._send_raw(datagram)
+        if now - self.last_recv > TIMEOUT:
+            self.closed = True
+
+    def _read_socket(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(MAX_DATAGRAM)
+        except (socket.timeout, BlockingIOError):
+            return False
+        except ConnectionRefusedError:
+            return False   # サーバがまだ居ない/落ちた → タイムアウトで判定
+        self.handle_datagram(data)
+        return True
+
+    def recv_message(self):
+        # メッセージが1つ届くまで待つ。切断されたらNone
+        while True:
+            try:
+                return self.inbox.get_nowait()
+            except queue.Empty:
+                pass
+            if self.closed:
+                return None
+            if self.owns_socket:
+                self._read_socket(POLL_INTERVAL)
+                self.update(time.time())
+            else:
+                try:
+                    return self.inbox.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+
+    def recv_object(self, expected_type):
+        return unpack_object(self.recv_message(), expected_type)
+
+    def poll(self):
+        # 今届いている分だけ読んで、届いたメッセージを全部返す（ブロックしない）
+        if self.owns_socket:
+            while self._read_socket(0):
+                pass
+            self.update(time.time())
+        messages = []
+        while True:
+            try:
+                messages.append(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        if self.closed and not messages:
+            raise ConnectionError("connection closed")
+        return messages
+
+    def keep_alive(self):
+        # メッセージを待っていない間（職業選択の画面など）に呼ぶ。届いたものは読んでおき、ackと再送を続ける
+        if self.owns_socket:
+            while self._read_socket(0):
+                pass
+            self.update(time.time())
+
+    def close(self):
+        if not self.closed:
+            self._send_raw(DATAGRAM.pack(KIND_BYE, 0, 0))
+        self.closed = True
+        if self.owns_socket:
+            self.sock.close()